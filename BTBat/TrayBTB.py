@@ -1,249 +1,2844 @@
+from __future__ import annotations
+
+import time
+
+# отметка начала импорта модуля — от неё считает --profile-startup
+_MODULE_T0 = time.perf_counter()
+
+import argparse
 import asyncio
+import importlib
 import logging
+import logging.handlers
 import subprocess
-import re
-import pystray
 import os
 import threading
 import sys
 import shutil
-import win32com.client
+import queue
+import base64
+import math
+import atexit
+from array import array
+from collections import OrderedDict, deque
+import json
+import random
 import concurrent.futures
-import time
-import pythoncom
-from pystray import MenuItem as item
-from PIL import Image, ImageDraw
-from winotify import Notification as WinNotification, audio
+from abc import ABC, abstractmethod
 from enum import Enum
-from typing import List, Dict, Optional
+from typing import TYPE_CHECKING, Callable, Iterator, List, Dict, Optional, Tuple
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
+from contextlib import contextmanager
+
+if TYPE_CHECKING:
+    import pystray
+    from PIL import Image
+
+NO_WINDOW = 0
+if sys.platform == "win32" and hasattr(subprocess, "CREATE_NO_WINDOW"):
+    NO_WINDOW = subprocess.CREATE_NO_WINDOW
+
+fulltime = str(datetime.now())
+
+if sys.platform == "win32":
+    try:
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    except Exception:
+        pass
+
+def _pystray():
+    # pystray при импорте поднимает backend трея — импортируем только когда нужен трей/меню
+    import pystray
+    return pystray
+
+def item(*args, **kwargs) -> pystray.MenuItem:
+    return _pystray().MenuItem(*args, **kwargs)
+
+@dataclass(frozen=True)
+class BatStatus:
+    level: Optional[int]
+    last_update: float
+    error_count: int = 0
+
+@dataclass
+class PollStats:
+    polls: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    cancelled: int = 0
+    skipped_in_flight: int = 0
+    last_latency: float = 0.0
+    max_latency: float = 0.0
+    total_latency: float = 0.0
+
+    def record(self, latency: float):
+        self.polls += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+    @property
+    def avg_latency(self) -> float:
+        return self.total_latency / self.polls if self.polls else 0.0
+
+    def summary(self) -> str:
+        return (
+            f"polls={self.polls} failures={self.failures} timeouts={self.timeouts} "
+            f"cancelled={self.cancelled} skipped={self.skipped_in_flight} "
+            f"avg={self.avg_latency * 1000:.1f}ms max={self.max_latency * 1000:.1f}ms"
+        )
+
+class StartupProfiler:
+    """Per-phase startup timings for --profile-startup (no-op when disabled)."""
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.phases: List[tuple] = []
+        self.marks: List[tuple] = []
+        self._reported = False
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - started))
+
+    def mark(self, name: str):
+        """Record the time elapsed since the module started importing."""
+        if self.enabled:
+            self.marks.append((name, time.perf_counter() - _MODULE_T0))
+
+    def report(self):
+        """Print and log the collected timings once."""
+        if not self.enabled or self._reported:
+            return
+        self._reported = True
+        lines = ["Startup profile:"]
+        lines += [f"  phase {name:<28} {dt * 1000:8.1f} ms" for name, dt in self.phases]
+        lines += [f"  at    {name:<28} {t * 1000:8.1f} ms" for name, t in self.marks]
+        text = "\n".join(lines)
+        print(text)
+        log_handler.log.info(text)
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+
+@dataclass
+class Histogram:
+    bounds: tuple
+    counts: List[int]
+    total: float = 0.0
+    count: int = 0
+    max: float = 0.0
+
+
+class Metrics:
+    """
+    Counters and latency histograms for the hot paths (WMI, PowerShell, parsing,
+    icons, menu, notifications). Disabled by default: inc()/observe() return at
+    once and timer() hands out a shared no-op context manager.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._histograms: Dict[str, Histogram] = {}
+
+    def inc(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = self._histograms[name] = Histogram(self.BUCKETS, [0] * (len(self.BUCKETS) + 1))
+            i = 0
+            while i < len(hist.bounds) and seconds > hist.bounds[i]:
+                i += 1
+            hist.counts[i] += 1
+            hist.total += seconds
+            hist.count += 1
+            hist.max = max(hist.max, seconds)
+
+    def timer(self, name: str):
+        """`with metrics.timer("name"):` records the block duration into histogram `name`."""
+        if not self.enabled:
+            return _NOOP_TIMER
+        return _Timer(self, name)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "time": time.time(),
+                "counters": dict(self._counters),
+                "histograms": {
+                    name: {
+                        "count": h.count, "sum": h.total, "max": h.max,
+                        "buckets": dict(zip([str(b) for b in h.bounds] + ["+Inf"], h.counts)),
+                    }
+                    for name, h in self._histograms.items()
+                },
+            }
+
+    def to_prometheus(self, prefix: str = "traybtb_") -> str:
+        data = self.snapshot()
+        lines = []
+        for name, value in sorted(data["counters"].items()):
+            lines.append(f"# TYPE {prefix}{name} counter")
+            lines.append(f"{prefix}{name} {value}")
+        for name, h in sorted(data["histograms"].items()):
+            metric = f"{prefix}{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in h["buckets"].items():
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum {h['sum']}")
+            lines.append(f"{metric}_count {h['count']}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        data = self.snapshot()
+        parts = [f"{name}={value:g}" for name, value in sorted(data["counters"].items())]
+        parts += [
+            f"{name}={h['count']}x avg={h['sum'] / h['count'] * 1000:.1f}ms max={h['max'] * 1000:.1f}ms"
+            for name, h in sorted(data["histograms"].items()) if h["count"]
+        ]
+        return " ".join(parts)
+
+
+class MetricsExporter:
+    """
+    Periodically writes the metrics snapshot to `path`: Prometheus text format
+    for *.prom files (node_exporter textfile collector), JSON otherwise.
+    """
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = 15.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="TrayBTB-metrics", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        self.write()
+
+    def write(self):
+        if self.path.endswith(".prom"):
+            text = self.metrics.to_prometheus()
+        else:
+            text = json.dumps(self.metrics.snapshot(), indent=1)
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            # пишем во временный файл и подменяем — читатель не увидит файл наполовину
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log_handler.log.warning(f"Failed to write metrics: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler that also rolls the file over once it is max_age seconds old."""
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, max_age: float):
+        super().__init__(filename, mode="a", maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.max_age = max_age
+        self._opened_at = time.time()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.max_age and time.time() - self._opened_at >= self.max_age:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self._opened_at = time.time()
+
+
+class RepeatThrottle(logging.Filter):
+    """
+    Passes the first occurrence of a message and swallows identical ones for
+    `window` seconds; the first repeat after the window carries the count,
+    e.g. "Failed to get battery level (x240 in last 4m)". `clock` is
+    injectable so windows can be driven by a simulated clock.
+    """
+
+    def __init__(self, window: float = 60.0, max_keys: int = 256,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__()
+        self.window = window
+        self.max_keys = max_keys
+        self.clock = clock
+        self._lock = threading.Lock()
+        # ключ -> [начало окна, сколько проглочено]
+        self._seen: "OrderedDict[tuple, list]" = OrderedDict()
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        now = self.clock()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None and now - entry[0] < self.window:
+                entry[1] += 1
+                self.suppressed += 1
+                return False
+            if entry is not None and entry[1]:
+                record.msg = f"{message} (x{entry[1] + 1} in last {self._span(now - entry[0])})"
+                record.args = None
+            self._seen[key] = [now, 0]
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_keys:
+                self._seen.popitem(last=False)
+        return True
+
+    def pending(self) -> List[tuple]:
+        """(level, summary) of repeats swallowed in still-open windows (written on shutdown)."""
+        now = self.clock()
+        with self._lock:
+            return [
+                (level, f"{message} (x{count} more in last {self._span(now - started)})")
+                for (_, level, message), (started, count) in self._seen.items() if count
+            ]
+
+    @staticmethod
+    def _span(seconds: float) -> str:
+        return f"{seconds / 60:.0f}m" if seconds >= 60 else f"{seconds:.0f}s"
+
+
+class Logs:
+    def __init__(self):
+        # сам файл логов создаётся в setup(), чтобы импорт модуля не трогал диск
+        self.log = logging.getLogger("TrayBTB")
+        self.logLevel = logging.INFO
+        self.log.setLevel(self.logLevel)
+        self.handler: Optional[logging.Handler] = None
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self.throttle = RepeatThrottle()
+        # ротация: по размеру и по возрасту файла; хранение: не больше max_files файлов и не старше max_days
+        self.max_bytes = 1024 * 1024
+        self.backup_count = 5
+        self.max_file_age = 24 * 3600
+        self.max_files = 30
+        self.max_days = 14
+
+    def setup(self, directory: str = "logs"):
+        if self.handler is not None:
+            return
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.prune(directory)
+        logFileStart = os.path.join(directory, "TrayBTB_")
+        logFileExt = ".log"
+        self.logFileName = logFileStart+fulltime[:fulltime.rfind('.')].replace(" ","_").replace(":","-")+logFileExt
+        self.handler = RotatingLogHandler(self.logFileName, self.max_bytes, self.backup_count, self.max_file_age)
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
+        self.handler.setFormatter(formatter)
+        # поток, который пишет в лог, только кладёт запись в очередь — диск трогает QueueListener
+        log_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(self.throttle)
+        self.listener = logging.handlers.QueueListener(log_queue, self.handler)
+        self.listener.start()
+        self.log.addHandler(queue_handler)
+        atexit.register(self.close)
+        self.log.info("Logging initialized")
+
+    def prune(self, directory: str):
+        """Delete log files older than max_days and all but the newest max_files."""
+        try:
+            paths = [
+                os.path.join(directory, name) for name in os.listdir(directory)
+                if name.startswith("TrayBTB_") and ".log" in name
+            ]
+            paths.sort(key=os.path.getmtime, reverse=True)
+            cutoff = time.time() - self.max_days * 24 * 3600
+            for i, path in enumerate(paths):
+                if i >= self.max_files or os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+        except Exception as e:
+            print(f"Log cleanup failed: {e}")
+
+    def close(self):
+        """Write pending repeat summaries and stop the writer thread."""
+        if self.listener is None:
+            return
+        # сначала дописываем очередь, потом итоги по повторам
+        self.listener.stop()
+        self.listener = None
+        for level, summary in self.throttle.pending():
+            self.handler.handle(self.log.makeRecord(self.log.name, level, __file__, 0, summary, None, None))
+        self.handler.close()
+
+    def changeLogLevel(self, level: int):
+        self.log.setLevel(level)
+    
+class DeviceState(Enum):
+    UPDATING = 0
+    NO_DEVICE = 1
+    DEVICE_CHOSEN = 2
+
+
+@dataclass(frozen=True)
+class AppState:
+    """Immutable snapshot of the state shared by the tray, poller and discovery threads."""
+    state: DeviceState = DeviceState.NO_DEVICE
+    devices: Tuple[Dict, ...] = ()
+    chosen_device: str = ""
+    chosen_device_id: str = ""
+    # статус выбранного устройства (неизменяемый) — публикуется после каждого опроса
+    battery_status: BatStatus = field(default_factory=lambda: BatStatus(level=None, last_update=0))
+
+
+class StateStore:
+    """
+    Holds the current AppState. Reads are lock-free (one attribute read of an
+    immutable snapshot); every write goes through update()/modify(), which
+    serialise writers, publish the new snapshot atomically and then notify
+    subscribers outside the lock.
+    """
+
+    def __init__(self, initial: Optional[AppState] = None):
+        self._current = initial or AppState()
+        self._write_lock = threading.Lock()
+        self._subscribers: List[Callable[[AppState, AppState], None]] = []
+        self.version = 0
+
+    @property
+    def current(self) -> AppState:
+        return self._current
+
+    def update(self, **changes) -> AppState:
+        return self.modify(lambda snapshot: replace(snapshot, **changes))[1]
+
+    def modify(self, fn: Callable[[AppState], AppState]) -> Tuple[AppState, AppState]:
+        """Atomic read-modify-write: fn gets the current snapshot and returns the next one."""
+        with self._write_lock:
+            old = self._current
+            new = fn(old)
+            if new == old:
+                return old, old
+            self._current = new
+            self.version += 1
+        for callback in list(self._subscribers):
+            try:
+                callback(old, new)
+            except Exception as e:
+                try:
+                    log_handler.log.debug(f"State subscriber failed: {e}")
+                except Exception:
+                    pass
+        return old, new
+
+    def subscribe(self, callback: Callable[[AppState, AppState], None]) -> Callable[[], None]:
+        """callback(old, new) runs in the writer's thread after each published change."""
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback)
+
+# Протокол результатов между приложением и PowerShell (воркер, пакетный и одиночный опрос):
+# по одной JSON-строке с префиксом "@@" на каждый InstanceId в порядке запроса,
+#   @@{"seq": <n>, "id": "<InstanceId>", "status": "ok"|"none"|"error", "level": <0..100>|null,
+#      "error": "<text>"|null, "code": <HRESULT>|null}
+#   ok    — уровень батареи
+#   none  — у устройства нет DEVPKEY_Device_BatteryLevel
+#   error — Get-PnpDeviceProperty упал
+# и завершающая строка кадра @@{"seq": <n>, "end": true, "count": <число записей>}.
+# Строки без префикса "@@" игнорируются (мусор от PowerShell в stdout); строки с префиксом
+# разбираются строго — битый или неполный кадр отбрасывается целиком (ProtocolError).
+PS_RESULT_FUNCTION = r"""
+function Write-ProbeResult([int]$seq, [string]$id) {
+    $rec = [ordered]@{ seq = $seq; id = $id; status = 'none'; level = $null; error = $null; code = $null }
+    try {
+        $data = (Get-PnpDeviceProperty -InstanceId $id -KeyName 'DEVPKEY_Device_BatteryLevel' -ErrorAction Stop).Data
+        if ($data -ne $null) { $rec.status = 'ok'; $rec.level = [int]$data }
+    } catch {
+        $rec.status = 'error'; $rec.error = $_.Exception.Message; $rec.code = $_.Exception.HResult
+    }
+    [Console]::Out.WriteLine('@@' + (ConvertTo-Json -InputObject $rec -Compress))
+}
+function Write-ProbeEnd([int]$seq, [int]$count) {
+    [Console]::Out.WriteLine('@@' + (ConvertTo-Json -InputObject ([ordered]@{ seq = $seq; end = $true; count = $count }) -Compress))
+    [Console]::Out.Flush()
+}
+"""
+
+# Скрипт постоянного PowerShell-воркера: запросы построчно из stdin
+# ("<seq>\t<InstanceId>[\t<InstanceId>...]"), ответ — кадр результатов с этим seq.
+PS_WORKER_SCRIPT = r"""
+[Console]::InputEncoding = [Text.Encoding]::UTF8
+[Console]::OutputEncoding = [Text.Encoding]::UTF8
+""" + PS_RESULT_FUNCTION + r"""
+while (($line = [Console]::In.ReadLine()) -ne $null) {
+    $parts = $line.Split("`t")
+    $seq = [int]$parts[0]
+    for ($i = 1; $i -lt $parts.Length; $i++) { Write-ProbeResult $seq $parts[$i] }
+    Write-ProbeEnd $seq ($parts.Length - 1)
+}
+"""
+
+
+class ProtocolError(ValueError):
+    """A malformed, unexpected or incomplete result frame from a PowerShell query."""
+
+
+@dataclass(frozen=True)
+class ProbeResult:
+    seq: int
+    id: str
+    status: str  # 'ok' | 'none' | 'error'
+    level: Optional[int] = None
+    error: Optional[str] = None
+    code: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class ProbeEnd:
+    seq: int
+    count: int
+
+
+_RESULT_KEYS = frozenset(("seq", "id", "status", "level", "error", "code"))
+_END_KEYS = frozenset(("seq", "end", "count"))
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_probe_record(line: str):
+    """Strictly parse one '@@{...}' line into a ProbeResult or ProbeEnd."""
+    if not line.startswith("@@"):
+        raise ProtocolError("missing @@ marker")
+    try:
+        obj = json.loads(line[2:])
+    except ValueError as e:
+        raise ProtocolError(f"garbled record: {e}") from None
+    if not isinstance(obj, dict):
+        raise ProtocolError("record is not an object")
+    seq = obj.get("seq")
+    if not _is_int(seq) or seq < 0:
+        raise ProtocolError(f"bad seq: {seq!r}")
+    if "end" in obj:
+        count = obj.get("count")
+        if set(obj) != _END_KEYS or obj["end"] is not True or not _is_int(count) or count < 0:
+            raise ProtocolError(f"bad end record: {obj!r}")
+        return ProbeEnd(seq, count)
+    if not set(obj) <= _RESULT_KEYS or not {"id", "status"} <= set(obj):
+        raise ProtocolError(f"bad result keys: {sorted(obj)}")
+    device_id, status = obj["id"], obj["status"]
+    level, error, code = obj.get("level"), obj.get("error"), obj.get("code")
+    if not isinstance(device_id, str) or not device_id:
+        raise ProtocolError(f"bad id: {device_id!r}")
+    if status == "ok":
+        if not _is_int(level) or not 0 <= level <= 100:
+            raise ProtocolError(f"bad level for {device_id}: {level!r}")
+    elif status in ("none", "error"):
+        if level is not None:
+            raise ProtocolError(f"level in '{status}' record for {device_id}")
+    else:
+        raise ProtocolError(f"bad status: {status!r}")
+    if error is not None and not isinstance(error, str):
+        raise ProtocolError(f"bad error for {device_id}: {error!r}")
+    if code is not None and not _is_int(code):
+        raise ProtocolError(f"bad code for {device_id}: {code!r}")
+    return ProbeResult(seq, device_id, status, level, error, code)
+
+
+def collect_probe_frame(results: List[ProbeResult], end: ProbeEnd, ids: List[str]) -> Dict[str, ProbeResult]:
+    """Check that a frame answers exactly `ids`, in order, and index it by id."""
+    if end.count != len(results) or len(results) != len(ids):
+        raise ProtocolError(f"partial frame: {len(results)} records, end count {end.count}, {len(ids)} ids")
+    for result, device_id in zip(results, ids):
+        if result.seq != end.seq or result.id != device_id:
+            raise ProtocolError(f"unexpected record {result.seq}/{result.id} for {end.seq}/{device_id}")
+    return {result.id: result for result in results}
+
+
+def parse_probe_output(text: str, ids: List[str], seq: int = 0) -> Dict[str, ProbeResult]:
+    """Parse the whole stdout of a one-shot probe script into {id: ProbeResult}."""
+    results: List[ProbeResult] = []
+    end: Optional[ProbeEnd] = None
+    for line in text.splitlines():
+        if not line.startswith("@@"):
+            continue
+        if end is not None:
+            raise ProtocolError("record after end of frame")
+        record = parse_probe_record(line.rstrip())
+        if record.seq != seq:
+            raise ProtocolError(f"unexpected seq {record.seq}, expected {seq}")
+        if isinstance(record, ProbeEnd):
+            end = record
+        else:
+            results.append(record)
+    if end is None:
+        raise ProtocolError(f"frame not terminated ({len(results)} records)")
+    return collect_probe_frame(results, end, ids)
+
+
+class PowerShellWorker:
+    """
+    Long-lived PowerShell process that answers battery level queries over stdin.
+
+    The process is started lazily on the first query and reused afterwards, so a
+    poll costs one round-trip over a pipe instead of a PowerShell launch. A reply
+    that does not arrive within the timeout kills the process; a dead process is
+    restarted on the next query with exponential backoff between crashes.
+
+    `command` replaces the PowerShell command line, which allows running the
+    worker against any local stand-in that speaks the same result protocol
+    (see PS_RESULT_FUNCTION); `popen` replaces subprocess.Popen (trace
+    recording and replay).
+    """
+
+    def __init__(self, command: Optional[List[str]] = None,
+                 request_timeout: float = 5.0, start_timeout: float = 15.0,
+                 per_id_timeout: float = 0.5, max_backoff: float = 30.0,
+                 popen: Callable = subprocess.Popen):
+        if command is None:
+            runner = shutil.which("pwsh") or "powershell"
+            encoded = base64.b64encode(PS_WORKER_SCRIPT.encode("utf-16-le")).decode("ascii")
+            command = [runner, "-NoLogo", "-NoProfile", "-NonInteractive", "-EncodedCommand", encoded]
+        self.command = command
+        self.popen = popen
+        self.request_timeout = request_timeout
+        self.start_timeout = start_timeout
+        self.per_id_timeout = per_id_timeout
+        self.max_backoff = max_backoff
+
+        self._proc: Optional[subprocess.Popen] = None
+        self._replies: Optional[queue.Queue] = None
+        self._lock = threading.Lock()  # один запрос в воркере за раз
+        self._seq = 0
+        self._fresh = False  # первый запрос после старта ждёт дольше (запуск PowerShell)
+        self._closed = False
+        self._crashes = 0
+        self._next_start_ts = 0.0
+
+        self.starts = 0
+        self.restarts = 0
+        self.timeouts = 0
+
+    def _start(self) -> bool:
+        now = time.monotonic()
+        if now < self._next_start_ts:
+            return False
+        try:
+            proc = self.popen(
+                self.command,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                text=True, encoding="utf-8", errors="replace", bufsize=1,
+                creationflags=NO_WINDOW
+            )
+        except Exception as e:
+            self._crashed(f"start failed: {e}")
+            return False
+        replies: queue.Queue = queue.Queue()
+        threading.Thread(target=self._reader, args=(proc, replies), daemon=True).start()
+        if self.starts:
+            self.restarts += 1
+        self.starts += 1
+        metrics.inc("powershell_spawns_worker")
+        self._proc = proc
+        self._replies = replies
+        self._fresh = True
+        log_handler.log.info(f"PowerShell worker started (pid {proc.pid})")
+        return True
+
+    @staticmethod
+    def _reader(proc: subprocess.Popen, replies: queue.Queue):
+        # у каждого процесса своя очередь — ответы умершего процесса никуда не попадут
+        try:
+            for line in proc.stdout:
+                if line.startswith("@@"):
+                    replies.put(line.rstrip("\r\n"))
+        except Exception:
+            pass
+        replies.put(None)
+
+    def _stop(self, kill: bool = False):
+        proc, self._proc, self._replies = self._proc, None, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+        try:
+            if kill:
+                raise subprocess.TimeoutExpired(self.command, 0)
+            proc.wait(timeout=2)
+        except Exception:
+            try:
+                proc.kill()
+                proc.wait(timeout=2)
+            except Exception:
+                pass
+
+    def _crashed(self, reason: str):
+        self._stop(kill=True)
+        self._crashes += 1
+        backoff = min(self.max_backoff, 2 ** (self._crashes - 1))
+        self._next_start_ts = time.monotonic() + backoff
+        log_handler.log.warning(f"PowerShell worker failed ({reason}), next start in {backoff}s")
+
+    def query(self, instance_id: str, timeout: Optional[float] = None) -> Optional[int]:
+        """Return the battery level for instance_id, or None if it is unavailable."""
+        return self.query_many([instance_id], timeout).get(instance_id)
+
+    def query_many(self, instance_ids: List[str], timeout: Optional[float] = None) -> Dict[str, Optional[int]]:
+        """
+        Read the battery level of several devices in one request.
+
+        Returns {instance_id: level or None} for every requested id; the default
+        timeout grows with the number of ids.
+        """
+        levels: Dict[str, Optional[int]] = {inst: None for inst in instance_ids}
+        ids = [inst for inst in levels if inst and "\t" not in inst and "\n" not in inst]
+        if not ids:
+            return levels
+        with self._lock:
+            if self._closed:
+                return levels
+            if self._proc is None or self._proc.poll() is not None:
+                if self._proc is not None:
+                    self._crashed(f"exited with code {self._proc.returncode}")
+                if not self._start():
+                    return levels
+
+            self._seq += 1
+            seq = self._seq
+            if timeout is None:
+                timeout = self.start_timeout if self._fresh else self.request_timeout
+                timeout += self.per_id_timeout * (len(ids) - 1)
+            try:
+                self._proc.stdin.write(str(seq) + "\t" + "\t".join(ids) + "\n")
+                self._proc.stdin.flush()
+            except Exception as e:
+                self._crashed(f"write failed: {e}")
+                return levels
+
+            started = time.perf_counter()
+            deadline = time.monotonic() + timeout
+            results: List[ProbeResult] = []
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        line = self._replies.get(timeout=max(0.0, remaining))
+                    except queue.Empty:
+                        self.timeouts += 1
+                        metrics.inc("worker_timeouts")
+                        self._crashed(f"no reply for {len(ids)} ids in {timeout}s")
+                        return levels
+                    if line is None:
+                        self._crashed("stdout closed")
+                        return levels
+                    with metrics.timer("parse_worker_reply"):
+                        record = parse_probe_record(line)
+                    if record.seq != seq:
+                        continue  # запоздалый ответ на предыдущий запрос
+                    if isinstance(record, ProbeEnd):
+                        frame = collect_probe_frame(results, record, ids)
+                        break
+                    results.append(record)
+            except ProtocolError as e:
+                # поток ответов рассинхронизирован — перезапускаем воркер
+                metrics.inc("protocol_errors")
+                self._crashed(f"protocol error: {e}")
+                return levels
+            metrics.observe("worker_query", time.perf_counter() - started)
+
+            self._fresh = False
+            self._crashes = 0
+            for inst, result in frame.items():
+                if result.status == "ok":
+                    levels[inst] = result.level
+                elif result.status == "error":
+                    log_handler.log.debug(f"PS worker error for {inst}: {result.error} ({result.code})")
+            return levels
+
+    def close(self):
+        """Stop the worker process; further queries return None."""
+        with self._lock:
+            self._closed = True
+            self._stop()
+
+
+# Скрипт пакетного/одиночного опроса: InstanceId приходят построчно через stdin,
+# ответ — кадр результатов с seq 0.
+PS_BATCH_SCRIPT = r"""
+[Console]::InputEncoding = [Text.Encoding]::UTF8
+[Console]::OutputEncoding = [Text.Encoding]::UTF8
+""" + PS_RESULT_FUNCTION + r"""
+$ids = @([Console]::In.ReadToEnd() -split "`r?`n" | Where-Object { $_ })
+foreach ($id in $ids) { Write-ProbeResult 0 $id }
+Write-ProbeEnd 0 $ids.Count
+"""
+
+CANDIDATE_NAME_PATTERNS = ("Headphone", "Headphones", "Audio", "Hands-Free", "AirPods", "WH", "BT")
+
+
+def is_candidate_name(name: Optional[str]) -> bool:
+    name = (name or "").lower()
+    return any(p.lower() in name for p in CANDIDATE_NAME_PATTERNS)
+
+
+class BatteryBackend(ABC):
+    """
+    Source of devices and battery readings behind DeviceManager and BatteryMonitor.
+    Devices are dicts {name, id, id_type, battery}, as returned by discover().
+    """
+
+    @abstractmethod
+    def discover(self) -> List[Dict[str, str]]:
+        """Full device scan (blocking)."""
+
+    def iter_discover(self) -> Iterator[Dict[str, str]]:
+        """Full device scan that yields each device as soon as it is found."""
+        yield from self.discover()
+
+    @abstractmethod
+    def read(self, device_id: str) -> Optional[int]:
+        """Battery level of one device, or None."""
+
+    def read_many(self, device_ids: List[str]) -> Dict[str, Optional[int]]:
+        """Battery levels of several devices; backends should answer in one query."""
+        return {device_id: self.read(device_id) for device_id in device_ids}
+
+    def event_source(self) -> Optional[DeviceEventSource]:
+        """Source of device arrival/removal events, or None if the backend has none."""
+        return None
+
+    def close(self):
+        pass
+
+
+class WmiSession:
+    """
+    One COM apartment and one WMI connection kept on a dedicated worker thread.
+    Queries are submitted from any thread; the connection is re-established
+    on the next query after a failure.
+    """
+
+    def __init__(self, namespace: str = "root\\cimv2", timeout: float = 30.0):
+        self.namespace = namespace
+        self.timeout = timeout
+        self._svc = None
+        self._pythoncom = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="TrayBTB-wmi", initializer=self._init_com
+        )
+        self.connects = 0
+        self.queries = 0
+
+    def _init_com(self):
+        # pywin32 нужен только этому бэкенду
+        import pythoncom
+        pythoncom.CoInitialize()
+        self._pythoncom = pythoncom
+
+    def _service(self):
+        if self._svc is None:
+            import win32com.client
+            locator = win32com.client.Dispatch("WbemScripting.SWbemLocator")
+            self._svc = locator.ConnectServer(".", self.namespace)
+            self.connects += 1
+            log_handler.log.info(f"WMI connected to {self.namespace}")
+        return self._svc
+
+    def _query(self, wql: str, fields: tuple) -> List[Dict]:
+        try:
+            items = self._service().ExecQuery(wql)
+            return [{f: getattr(it, f, None) for f in fields} for it in items]
+        except Exception:
+            self._svc = None  # переподключимся при следующем запросе
+            raise
+
+    def query(self, wql: str, fields: tuple) -> List[Dict]:
+        """Run a WQL query on the WMI thread and return rows as dicts of `fields`."""
+        self.queries += 1
+        return self._executor.submit(self._query, wql, fields).result(self.timeout)
+
+    def _close(self):
+        self._svc = None
+        if self._pythoncom is not None:
+            self._pythoncom.CoUninitialize()
+
+    def close(self):
+        try:
+            self._executor.submit(self._close)
+        except RuntimeError:
+            pass
+        self._executor.shutdown(wait=False)
+
+
+class PowerShellBackend(BatteryBackend):
+    """WMI discovery + PowerShell Get-PnpDeviceProperty; readings go through a persistent worker."""
+
+    def __init__(self, worker: Optional[PowerShellWorker] = None,
+                 discovery_mode: str = "batch", batch_size: int = 64,
+                 batch_timeout: float = 20.0, probe_timeout: float = 8.0,
+                 no_battery_ttl: float = 6 * 3600, wmi: Optional[WmiSession] = None,
+                 batch_workers: int = 4, run: Callable = subprocess.run,
+                 watch_events: bool = True):
+        self.worker = worker or PowerShellWorker()
+        self.wmi = wmi or WmiSession()
+        self.run = run  # запуск одноразовых PowerShell-проб (подменяется при записи/воспроизведении трассы)
+        self.watch_events = watch_events
+        # индекс известных PnP-сущностей-кандидатов: PNPDeviceID -> Name
+        self.entities: Dict[str, str] = {}
+        # сущности, у которых батарея точно есть — их читает постоянный воркер
+        self._with_battery: set = set()
+        # отрицательный кэш: PNPDeviceID -> до какого времени не допрашивать (нет DEVPKEY_Device_BatteryLevel)
+        self._no_battery: Dict[str, float] = {}
+        self.no_battery_ttl = no_battery_ttl
+        self.last_scan: Dict[str, int] = {}
+        # 'batch' — один вызов PowerShell на пакет кандидатов,
+        # 'fanout' — старый режим: отдельный процесс на каждого кандидата
+        self.discovery_mode = discovery_mode
+        self.batch_size = batch_size
+        self.batch_workers = batch_workers
+        self.batch_timeout = batch_timeout
+        self.probe_timeout = probe_timeout
+
+    def discover(self) -> List[Dict[str, str]]:
+        return list(self.iter_discover())
+
+    def iter_discover(self) -> Iterator[Dict[str, str]]:
+        """
+        Быстрый WMI-скан для кандидатов (фильтр по имени), затем:
+        - известные устройства с батареей читаются постоянным воркером (без запуска PowerShell),
+          не ответившие воркеру допрашиваются вместе с новыми;
+        - устройства из отрицательного кэша (TTL) пропускаются;
+        - только новые/просроченные кандидаты допрашиваются через Get-PnpDeviceProperty.
+        Устройства отдаются по мере ответа, dict: {name, id, id_type='pnp', battery}
+        Если WMI-запрос не удался, исключение уходит вызывающему, индекс не меняется.
+        """
+        candidates = self._query_candidates()
+        now = time.time()
+        self.entities = dict(candidates)
+        self._with_battery &= set(self.entities)
+        self._no_battery = {k: v for k, v in self._no_battery.items() if v > now}
+        if not candidates:
+            return
+
+        known = [(inst, name) for inst, name in candidates if inst in self._with_battery]
+        fresh = [
+            (inst, name) for inst, name in candidates
+            if inst not in self._with_battery and inst not in self._no_battery
+        ]
+
+        # убираем дубли по instance id
+        seen = set()
+        skipped = len(candidates) - len(known) - len(fresh)
+        if known:
+            levels = self.worker.query_many([inst for inst, _ in known])
+            for inst, name in known:
+                if levels.get(inst) is not None:
+                    seen.add(inst)
+                    yield {"name": name, "id": inst, "id_type": "pnp", "battery": levels[inst]}
+                else:
+                    # воркер не ответил (или устройство перестало отвечать) — допрашиваем пакетом сейчас,
+                    # иначе известное устройство молча пропало бы из результата скана
+                    self._with_battery.discard(inst)
+                    fresh.append((inst, name))
+
+        if fresh:
+            for r in self._iter_probe_candidates(fresh, now):
+                key = r.get("id")
+                if key and key not in seen:
+                    seen.add(key)
+                    yield r
+
+        self.last_scan = {
+            "candidates": len(candidates), "refreshed": len(candidates) - skipped - len(fresh), "probed": len(fresh),
+            "skipped_no_battery": skipped, "found": len(seen),
+        }
+        try:
+            log_handler.log.info(f"PowerShellBackend (pywin32, {self.discovery_mode}) scan: {self.last_scan}")
+        except Exception:
+            pass
+
+    def _iter_probe_candidates(self, candidates: List[tuple], now: float) -> Iterator[Dict[str, str]]:
+        """Probe new candidates with PowerShell, yielding devices as probes finish."""
+        # runner для PowerShell: пробуем pwsh, иначе powershell
+        runner = shutil.which("pwsh") or "powershell"
+
+        if self.discovery_mode == "fanout":
+            for r in self._iter_fanout(runner, candidates):
+                self._with_battery.add(r["id"])
+                yield r
+            return
+
+        # делим кандидатов на несколько пакетов и гоняем их параллельно:
+        # первые устройства появляются, не дожидаясь самого медленного пакета
+        size = max(1, min(self.batch_size, -(-len(candidates) // self.batch_workers)))
+        batches = [candidates[i:i + size] for i in range(0, len(candidates), size)]
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.batch_workers) as ex:
+            futs = {ex.submit(self._probe_batch, runner, batch): batch for batch in batches}
+            for f in concurrent.futures.as_completed(futs):
+                batch = futs[f]
+                try:
+                    found, batch_failed = f.result()
+                except Exception:
+                    found, batch_failed = [], list(batch)
+                failed.extend(batch_failed)
+                # пакет ответил, что батареи нет — запоминаем на no_battery_ttl
+                answered_empty = (
+                    {inst for inst, _ in batch}
+                    - {inst for inst, _ in batch_failed}
+                    - {r["id"] for r in found}
+                )
+                for inst in answered_empty:
+                    self._no_battery[inst] = now + self.no_battery_ttl
+                for r in found:
+                    self._with_battery.add(r["id"])
+                    yield r
+        if failed:
+            # поштучно допрашиваем только тех, по кому пакет не дал ответа
+            try:
+                log_handler.log.info(f"Batch discovery: falling back to single probes for {len(failed)} ids")
+            except Exception:
+                pass
+            for r in self._iter_fanout(runner, failed):
+                self._with_battery.add(r["id"])
+                yield r
+
+    def read(self, device_id: str) -> Optional[int]:
+        return self.worker.query(device_id)
+
+    def read_many(self, device_ids: List[str]) -> Dict[str, Optional[int]]:
+        return self.worker.query_many(device_ids)
+
+    def event_source(self) -> Optional[DeviceEventSource]:
+        if not self.watch_events:
+            return None
+        return WmiDeviceEventSource(self._query_candidates)
+
+    def close(self):
+        self.worker.close()
+        self.wmi.close()
+
+    def _query_candidates(self) -> List[tuple]:
+        """WMI query for PnP entities whose name looks like an audio/BT device; raises if WMI fails."""
+        # фильтр по имени уменьшает количество проверяемых устройств
+        q = (
+            "SELECT PNPDeviceID, Name FROM Win32_PnPEntity "
+            "WHERE Status='OK' AND ("
+            + " OR ".join(f"Name LIKE '%{p}%'" for p in CANDIDATE_NAME_PATTERNS) +
+            ")"
+        )
+        # ошибка WMI — не «устройств нет»: пробрасываем, чтобы не сбросить индекс и список устройств
+        try:
+            with metrics.timer("wmi_query"):
+                rows = self.wmi.query(q, ("PNPDeviceID", "Name"))
+        except Exception as e:
+            metrics.inc("wmi_query_failures")
+            log_handler.log.error(f"WMI query failed: {e}")
+            raise
+        candidates = []
+        seen = set()
+        for row in rows:
+            inst = row.get("PNPDeviceID")
+            name = row.get("Name")
+            if inst and inst not in seen:
+                seen.add(inst)
+                candidates.append((inst, name or inst))
+        log_handler.log.info(f"WMI candidates count: {len(candidates)}")
+        return candidates
+
+    def _run_probe_script(self, runner: str, ids: List[str], timeout: float) -> Dict[str, ProbeResult]:
+        """Run PS_BATCH_SCRIPT for ids; raises TimeoutExpired or ProtocolError."""
+        encoded = base64.b64encode(PS_BATCH_SCRIPT.encode("utf-16-le")).decode("ascii")
+        res = self.run(
+            [runner, "-NoProfile", "-NonInteractive", "-EncodedCommand", encoded],
+            input="\n".join(ids) + "\n",
+            capture_output=True, text=True, encoding="utf-8", errors="replace",
+            timeout=timeout, creationflags=NO_WINDOW
+        )
+        with metrics.timer("parse_probe_output"):
+            try:
+                return parse_probe_output(res.stdout or "", ids)
+            except ProtocolError:
+                metrics.inc("protocol_errors")
+                raise
+
+    def _probe_batch(self, runner: str, batch: List[tuple]):
+        """
+        Probes a whole batch of candidates with one PowerShell invocation.
+
+        Returns (devices, failed) where failed holds the candidates that the batch
+        could not answer for (PowerShell error, timeout, malformed output).
+        """
+        names = dict(batch)
+        try:
+            metrics.inc("powershell_spawns_batch")
+            with metrics.timer("ps_batch"):
+                frame = self._run_probe_script(runner, list(names), self.batch_timeout)
+        except subprocess.TimeoutExpired:
+            metrics.inc("ps_batch_timeouts")
+            try:
+                log_handler.log.warning(f"PS batch timeout ({len(batch)} ids)")
+            except Exception:
+                pass
+            return [], list(batch)
+        except Exception as e:
+            try:
+                log_handler.log.warning(f"PS batch failed ({len(batch)} ids): {e}")
+            except Exception:
+                pass
+            return [], list(batch)
+
+        devices = []
+        failed = []
+        for inst, name in batch:
+            result = frame[inst]
+            if result.status == "ok":
+                devices.append({"name": name, "id": inst, "id_type": "pnp", "battery": result.level})
+            elif result.status == "error":
+                failed.append((inst, name))
+        return devices, failed
+
+    def _probe_one(self, runner: str, inst: str, name: str):
+        # один InstanceId тем же скриптом и протоколом, что и пакет; возвращаем device dict или None
+        try:
+            metrics.inc("powershell_spawns_probe")
+            with metrics.timer("ps_probe"):
+                result = self._run_probe_script(runner, [inst], self.probe_timeout)[inst]
+            if result.status != "ok":
+                return None
+            return {"name": name, "id": inst, "id_type": "pnp", "battery": result.level}
+        except subprocess.TimeoutExpired:
+            metrics.inc("ps_probe_timeouts")
+            try:
+                log_handler.log.debug(f"PS timeout for {inst}")
+            except Exception:
+                pass
+            return None
+        except Exception as e:
+            try:
+                log_handler.log.debug(f"PS error for {inst}: {e}")
+            except Exception:
+                pass
+            return None
+
+    def _iter_fanout(self, runner: str, candidates: List[tuple]) -> Iterator[Dict[str, str]]:
+        # параллельно опрашиваем кандидатов (ограничиваем worker-ы), отдаём по мере готовности
+        with concurrent.futures.ThreadPoolExecutor(max_workers=12) as ex:
+            futs = [ex.submit(self._probe_one, runner, inst, name) for inst, name in candidates]
+            for f in concurrent.futures.as_completed(futs):
+                try:
+                    r = f.result()
+                    if r:
+                        yield r
+                except Exception:
+                    pass
+
+@dataclass
+class LatencyProfile:
+    latency: float = 0.0  # секунды на запрос
+    jitter: float = 0.0
+    failure_rate: float = 0.0  # доля запросов, вернувших None
+    per_device_latency: float = 0.0  # добавка к запросу за каждое устройство
+
+
+class FakeBackend(BatteryBackend):
+    """
+    Deterministic in-process backend for running the app headless (tests,
+    profiling, CI on Linux). Latency and failures follow `profile` and a seeded
+    RNG; levels can be scripted with set_level() or drained on every read.
+    """
+
+    def __init__(self, devices: Optional[List[Dict[str, str]]] = None,
+                 profile: Optional[LatencyProfile] = None, seed: int = 0,
+                 drain_per_read: float = 0.0, sleep: Callable[[float], None] = time.sleep,
+                 probe_latency: Optional[Dict[str, float]] = None):
+        if devices is None:
+            devices = [
+                {"name": "Fake Headphones", "id": "FAKE\\HEADPHONES", "id_type": "pnp", "battery": 80},
+                {"name": "Fake Mouse", "id": "FAKE\\MOUSE", "id_type": "pnp", "battery": 55},
+                {"name": "Fake Keyboard", "id": "FAKE\\KEYBOARD", "id_type": "pnp", "battery": 30},
+            ]
+        self.profile = profile or LatencyProfile()
+        self.drain_per_read = drain_per_read
+        self.sleep = sleep
+        # задержка обнаружения по устройствам (для имитации «перекошенных» проб при поиске)
+        self.probe_latency = probe_latency or {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._devices: Dict[str, Dict[str, str]] = {d["id"]: dict(d) for d in devices}
+        self._levels: Dict[str, float] = {d["id"]: float(d.get("battery", 100)) for d in devices}
+        self.discover_calls = 0
+        self.read_calls = 0
+
+    def set_level(self, device_id: str, level: Optional[float]):
+        """Script the level of a device; None makes it stop reporting battery."""
+        with self._lock:
+            if level is None:
+                self._levels.pop(device_id, None)
+            else:
+                self._levels[device_id] = float(level)
+
+    def _delay(self, count: int):
+        with self._lock:
+            jitter = self._rng.uniform(-self.profile.jitter, self.profile.jitter) if self.profile.jitter else 0.0
+        delay = self.profile.latency + jitter + self.profile.per_device_latency * count
+        if delay > 0:
+            self.sleep(delay)
+
+    def _level(self, device_id: str) -> Optional[int]:
+        with self._lock:
+            if self.profile.failure_rate and self._rng.random() < self.profile.failure_rate:
+                return None
+            level = self._levels.get(device_id)
+            if level is None:
+                return None
+            self._levels[device_id] = max(0.0, level - self.drain_per_read)
+            return int(round(level))
+
+    def discover(self) -> List[Dict[str, str]]:
+        return list(self.iter_discover())
+
+    def iter_discover(self) -> Iterator[Dict[str, str]]:
+        """
+        Devices come out in order of their probe_latency (as parallel probes
+        would finish); without probe latencies the whole scan takes one delay.
+        """
+        self.discover_calls += 1
+        if not self.probe_latency:
+            self._delay(len(self._devices))
+        elapsed = 0.0
+        order = sorted(self._devices, key=lambda device_id: self.probe_latency.get(device_id, 0.0))
+        for device_id in order:
+            latency = self.probe_latency.get(device_id, 0.0)
+            if latency > elapsed:
+                self.sleep(latency - elapsed)
+                elapsed = latency
+            level = self._level(device_id)
+            if level is not None:
+                yield dict(self._devices[device_id], battery=level)
+
+    def read(self, device_id: str) -> Optional[int]:
+        self.read_calls += 1
+        self._delay(1)
+        return self._level(device_id)
+
+    def read_many(self, device_ids: List[str]) -> Dict[str, Optional[int]]:
+        self.read_calls += 1
+        self._delay(len(device_ids))
+        return {device_id: self._level(device_id) for device_id in device_ids}
+
+
+class TraceRecorder:
+    """
+    Records the raw I/O of PowerShellBackend to a JSON-lines trace: the rows
+    of every WMI query, every request line written to the PowerShell worker
+    with each stdout line it got back (and when), and the stdin/stdout of
+    every one-shot PowerShell probe, with latencies, timeouts and errors.
+    TraceReplayer feeds the same data back on any OS, so batching, the
+    negative cache, the worker protocol and the parsers all run on replay.
+
+    `popen` and `run` are the real process functions being recorded.
+    """
+
+    TRACE_VERSION = 2
+
+    def __init__(self, path: str, popen: Callable = subprocess.Popen, run: Callable = subprocess.run):
+        self.path = path
+        self._popen = popen
+        self._run = run
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(path, "w", encoding="utf-8")
+        self.write({"op": "meta", "version": self.TRACE_VERSION, "started": time.time(), "platform": sys.platform})
+
+    def write(self, record: Dict):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def offset(self) -> float:
+        return round(time.monotonic() - self._t0, 6)
+
+    def backend(self, wmi: Optional[WmiSession] = None, command: Optional[List[str]] = None,
+                **kwargs) -> PowerShellBackend:
+        """A PowerShellBackend whose WMI session, worker and probes are recorded."""
+        return PowerShellBackend(
+            worker=PowerShellWorker(command=command, popen=self.popen),
+            wmi=_RecordingWmi(wmi or WmiSession(), self),
+            run=self.run, **kwargs
+        )
+
+    def popen(self, args, **kwargs) -> "_RecordingProcess":
+        return _RecordingProcess(self._popen(args, **kwargs), self)
+
+    def run(self, args, **kwargs) -> subprocess.CompletedProcess:
+        record = {"op": "ps_run", "t": self.offset(), "input": kwargs.get("input")}
+        started = time.perf_counter()
+        try:
+            result = self._run(args, **kwargs)
+            record["returncode"] = result.returncode
+            record["stdout"] = result.stdout
+            return result
+        except subprocess.TimeoutExpired:
+            record["timeout"] = True
+            raise
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["latency"] = round(time.perf_counter() - started, 6)
+            self.write(record)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class _RecordingWmi:
+    """WmiSession wrapper that appends every query and its rows to the trace."""
+
+    def __init__(self, inner: WmiSession, trace: TraceRecorder):
+        self.inner = inner
+        self.trace = trace
+
+    def query(self, wql: str, fields: tuple) -> List[Dict]:
+        record = {"op": "wmi", "t": self.trace.offset(), "wql": wql, "fields": list(fields)}
+        started = time.perf_counter()
+        try:
+            rows = self.inner.query(wql, fields)
+            record["rows"] = rows
+            return rows
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["latency"] = round(time.perf_counter() - started, 6)
+            self.trace.write(record)
+
+    def close(self):
+        self.inner.close()
+
+
+class _RecordingProcess:
+    """
+    Popen wrapper for the worker: each request line written to stdin opens an
+    exchange that collects the stdout lines read until the next request, with
+    their delay from the request. The exchange is written on the next request
+    or when stdout ends; 'exit' marks a process that ended on its own.
+    """
+
+    def __init__(self, proc: subprocess.Popen, trace: TraceRecorder):
+        self._proc = proc
+        self._trace = trace
+        self._lock = threading.Lock()
+        self._exchange: Optional[Dict] = None
+        self._started = 0.0
+        self._stopped = False  # процесс остановлен нами (close/kill), а не упал сам
+        self.stdin = self
+        self.stdout = self._read()
+
+    def __getattr__(self, name):
+        return getattr(self._proc, name)  # pid, poll, wait, returncode
+
+    def _end_exchange(self):
+        exchange, self._exchange = self._exchange, None
+        if exchange is not None:
+            self._trace.write(exchange)
+
+    # stdin
+    def write(self, line: str):
+        with self._lock:
+            self._end_exchange()
+            seq, _, ids = line.rstrip("\n").partition("\t")
+            self._exchange = {"op": "worker", "t": self._trace.offset(), "seq": seq, "ids": ids, "replies": []}
+            self._started = time.perf_counter()
+        self._proc.stdin.write(line)
+
+    def flush(self):
+        self._proc.stdin.flush()
+
+    def close(self):
+        self._stopped = True
+        self._proc.stdin.close()
+
+    def kill(self):
+        self._stopped = True
+        self._proc.kill()
+
+    # stdout
+    def _read(self):
+        for line in self._proc.stdout:
+            with self._lock:
+                if self._exchange is not None:
+                    self._exchange["replies"].append([round(time.perf_counter() - self._started, 6), line.rstrip("\r\n")])
+            yield line
+        with self._lock:
+            if self._exchange is not None and not self._stopped:
+                self._exchange["exit"] = round(time.perf_counter() - self._started, 6)
+            self._end_exchange()
+
+
+def _replace_seq(line: str, seq: str) -> str:
+    """Put the replayed request's seq into a recorded '@@{"seq": N, ...}' line."""
+    head = '@@{"seq":'
+    if not line.startswith(head):
+        return line
+    start = len(head)
+    while start < len(line) and line[start] == " ":
+        start += 1
+    end = start
+    while end < len(line) and line[end].isdigit():
+        end += 1
+    return line[:start] + seq + line[end:] if end > start else line
+
+
+class TraceReplayer:
+    """
+    Plays back a TraceRecorder trace through a real PowerShellBackend:
+    WMI rows by query text, one-shot probes by their stdin, worker replies by
+    the requested ids (with the seq of the new request), all in recorded order
+    and with recorded delays divided by `speed` (0 — no delays, for throughput
+    runs). When the records for a query run out, replay starts over from its
+    first one. Requests that were never recorded fail like a broken probe.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, sleep: Callable[[float], None] = time.sleep):
+        self.speed = speed
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._records: Dict[tuple, List[Dict]] = {}
+        self._next: Dict[tuple, int] = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                op = record.get("op")
+                if op == "meta" and record.get("version") != TraceRecorder.TRACE_VERSION:
+                    raise ValueError(f"Unsupported trace version: {record.get('version')}")
+                key = {"wmi": "wql", "ps_run": "input", "worker": "ids"}.get(op)
+                if key is not None:
+                    self._records.setdefault((op, record.get(key)), []).append(record)
+        self.wmi_queries = 0
+        self.runs = 0
+        self.worker_requests = 0
+        self.misses = 0
+
+    def scaled(self, seconds: float) -> float:
+        return seconds / self.speed if self.speed > 0 and seconds > 0 else 0.0
+
+    def _take(self, op: str, key) -> Optional[Dict]:
+        with self._lock:
+            records = self._records.get((op, key))
+            if not records:
+                self.misses += 1
+                return None
+            i = self._next.get((op, key), 0)
+            self._next[(op, key)] = (i + 1) % len(records)
+            return records[i]
+
+    def backend(self, **kwargs) -> PowerShellBackend:
+        """A PowerShellBackend that answers from the trace (device events are not replayed)."""
+        return PowerShellBackend(
+            worker=PowerShellWorker(popen=self.popen), wmi=self, run=self.run, watch_events=False, **kwargs
+        )
+
+    # WmiSession
+    def query(self, wql: str, fields: tuple) -> List[Dict]:
+        self.wmi_queries += 1
+        record = self._take("wmi", wql)
+        if record is None:
+            raise RuntimeError(f"WMI query is not in the trace: {wql}")
+        self.sleep(self.scaled(record.get("latency", 0.0)))
+        if "error" in record:
+            raise RuntimeError(f"replayed WMI error: {record['error']}")
+        return [dict(row) for row in record.get("rows", [])]
+
+    def close(self):
+        pass
+
+    # subprocess.run для одноразовых проб
+    def run(self, args, **kwargs) -> subprocess.CompletedProcess:
+        self.runs += 1
+        record = self._take("ps_run", kwargs.get("input"))
+        if record is None:
+            return subprocess.CompletedProcess(args, 1, stdout="", stderr="")  # неполный кадр — проба не удалась
+        self.sleep(self.scaled(record.get("latency", 0.0)))
+        if record.get("timeout"):
+            raise subprocess.TimeoutExpired(args, kwargs.get("timeout"))
+        if "error" in record:
+            raise OSError(f"replayed PowerShell error: {record['error']}")
+        return subprocess.CompletedProcess(args, record.get("returncode", 0), stdout=record.get("stdout") or "", stderr="")
+
+    # subprocess.Popen для постоянного воркера
+    def popen(self, args, **kwargs) -> "_ReplayProcess":
+        return _ReplayProcess(self)
+
+
+class _ReplayProcess:
+    """Stand-in for the worker process that answers requests with recorded stdout lines."""
+
+    pid = 0
+
+    def __init__(self, replayer: TraceReplayer):
+        self._replayer = replayer
+        # (когда отдать, строка или None — конец stdout, код выхода)
+        self._lines: queue.Queue = queue.Queue()
+        self.returncode: Optional[int] = None
+        self.stdin = self
+        self.stdout = self._read()
+
+    def write(self, line: str):
+        self._replayer.worker_requests += 1
+        seq, _, ids = line.rstrip("\n").partition("\t")
+        now = time.monotonic()
+        record = self._replayer._take("worker", ids)
+        if record is None:
+            # запрос не записан — отвечаем как упавший Get-PnpDeviceProperty по каждому id
+            for device_id in ids.split("\t"):
+                reply = {"seq": int(seq), "id": device_id, "status": "error", "level": None,
+                         "error": "not in trace", "code": None}
+                self._lines.put((now, "@@" + json.dumps(reply) + "\n", None))
+            end = {"seq": int(seq), "end": True, "count": len(ids.split("\t"))}
+            self._lines.put((now, "@@" + json.dumps(end) + "\n", None))
+            return
+        for at, text in record.get("replies", []):
+            text = _replace_seq(text, seq) if record.get("seq") is not None else text
+            self._lines.put((now + self._replayer.scaled(at), text + "\n", None))
+        if "exit" in record:
+            self._lines.put((now + self._replayer.scaled(record["exit"]), None, 1))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._lines.put((0.0, None, 0))
+
+    def _read(self):
+        while True:
+            due, line, code = self._lines.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._replayer.sleep(delay)
+            if line is None:
+                if self.returncode is None:
+                    self.returncode = code
+                return
+            yield line
+
+    def poll(self) -> Optional[int]:
+        return self.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        if self.returncode is None:
+            self.returncode = 0
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+        self._lines.put((0.0, None, -9))
+
+
+BATTERY_SERVICE_UUID = "0000180f-0000-1000-8000-00805f9b34fb"
+BATTERY_LEVEL_UUID = "00002a19-0000-1000-8000-00805f9b34fb"
+
+
+class BleBatteryBackend(BatteryBackend):
+    """
+    BLE GATT Battery Service backend. Each device that is read gets a
+    persistent connection kept on a private asyncio loop: Battery Level
+    (0x2A19) notifications update a cache, so read()/read_many() are dict
+    lookups. Devices without notifications are read every read_interval.
+    Lost connections are re-established with exponential backoff; devices
+    nobody has read for idle_disconnect_s are released. idle_disconnect_s
+    must stay well above the longest gap between polls, otherwise every poll
+    finds the link released and reconnecting.
+
+    While a device is connecting, read_many() returns its last known level,
+    or waits up to connect_timeout for the first one; None means the
+    connection failed and is waiting to retry.
+
+    client_factory(address, disconnected_callback) returns a bleak-like
+    client (connect, disconnect, is_connected, start_notify, read_gatt_char);
+    scanner(timeout) returns [(address, name)]. Both default to bleak.
+    """
+
+    def __init__(self, client_factory: Optional[Callable] = None, scanner: Optional[Callable] = None,
+                 scan_timeout: float = 5.0, read_interval: float = 60.0,
+                 min_backoff: float = 1.0, max_backoff: float = 60.0, idle_disconnect_s: float = 900.0,
+                 connect_timeout: float = 5.0):
+        self.client_factory = client_factory or self._bleak_client
+        self.scanner = scanner or self._bleak_scan
+        self.scan_timeout = scan_timeout
+        self.read_interval = read_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.idle_disconnect_s = idle_disconnect_s
+        self.connect_timeout = connect_timeout
+        # вызывается из потока BLE при каждом новом уровне — приложение может сразу обновить трей
+        self.on_level: Optional[Callable[[str, int], None]] = None
+        self._lock = threading.Lock()
+        self._levels: Dict[str, int] = {}
+        # адрес -> 'connecting' | 'connected' | 'backoff' (нет записи — соединение отпущено)
+        self._state: Dict[str, str] = {}
+        # будит read_many, ждущий первого уровня подключающегося устройства
+        self._changed = threading.Condition()
+        self._wanted: Dict[str, float] = {}
+        self._names: Dict[str, str] = {}
+        self._tasks: Dict[str, "concurrent.futures.Future"] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.connects = 0
+        self.notifications = 0
+        self.gatt_reads = 0
+
+    @staticmethod
+    def _bleak_client(address: str, disconnected_callback: Callable):
+        from bleak import BleakClient
+        return BleakClient(address, disconnected_callback=disconnected_callback)
+
+    @staticmethod
+    async def _bleak_scan(timeout: float) -> List[tuple]:
+        from bleak import BleakScanner
+        devices = await BleakScanner.discover(timeout=timeout, service_uuids=[BATTERY_SERVICE_UUID])
+        return [(d.address, d.name or d.address) for d in devices]
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="TrayBTB-ble", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def discover(self) -> List[Dict[str, str]]:
+        """Scan for devices advertising the Battery Service and read each one once."""
+        if self._closed:
+            return []
+        loop = self._ensure_loop()
+        try:
+            found = asyncio.run_coroutine_threadsafe(self.scanner(self.scan_timeout), loop).result(self.scan_timeout + 5)
+        except Exception as e:
+            log_handler.log.warning(f"BLE scan failed: {e}")
+            return []
+        devices = []
+        for address, name in found:
+            self._names[address] = name
+            level = self._levels.get(address)
+            if level is None:
+                try:
+                    level = asyncio.run_coroutine_threadsafe(self._read_once(address), loop).result(15)
+                except Exception as e:
+                    log_handler.log.debug(f"BLE read of {address} failed: {e}")
+            if level is not None:
+                devices.append({"name": name, "id": address, "id_type": "ble", "battery": level})
+        return devices
+
+    def read(self, device_id: str) -> Optional[int]:
+        return self.read_many([device_id]).get(device_id)
+
+    def read_many(self, device_ids: List[str]) -> Dict[str, Optional[int]]:
+        """
+        Cached levels; starts keeping a connection to new devices and waits up
+        to connect_timeout for those that are connecting and have no level yet.
+        """
+        now = time.monotonic()
+        for address in device_ids:
+            self._wanted[address] = now
+            self._watch(address)
+
+        def pending() -> List[str]:
+            return [a for a in device_ids if a not in self._levels and self._state.get(a) == "connecting"]
+
+        with self._changed:
+            self._changed.wait_for(lambda: not pending(), self.connect_timeout)
+        # при неудачном подключении (backoff) уровня нет, пока соединение не восстановится
+        return {
+            address: None if self._state.get(address) == "backoff" else self._levels.get(address)
+            for address in device_ids
+        }
+
+    def _set_state(self, address: str, state: Optional[str]):
+        with self._changed:
+            if state is None:
+                self._state.pop(address, None)
+            else:
+                self._state[address] = state
+            self._changed.notify_all()
+
+    def _watch(self, address: str):
+        if self._closed:
+            return
+        loop = self._ensure_loop()
+        with self._lock:
+            task = self._tasks.get(address)
+            if task is not None and not task.done():
+                return
+            self._set_state(address, "connecting")
+            self._tasks[address] = asyncio.run_coroutine_threadsafe(self._maintain(address), loop)
+
+    def _set_level(self, address: str, level: int):
+        with self._changed:
+            self._levels[address] = level
+            self._changed.notify_all()
+        callback = self.on_level
+        if callback is not None:
+            try:
+                callback(address, level)
+            except Exception as e:
+                log_handler.log.debug(f"BLE level callback failed: {e}")
+
+    @staticmethod
+    def _parse_level(data) -> Optional[int]:
+        if not data:
+            return None
+        level = data[0]
+        return level if 0 <= level <= 100 else None
+
+    async def _read_once(self, address: str) -> Optional[int]:
+        client = self.client_factory(address, lambda _client: None)
+        await client.connect()
+        try:
+            self.gatt_reads += 1
+            return self._parse_level(await client.read_gatt_char(BATTERY_LEVEL_UUID))
+        finally:
+            await client.disconnect()
+
+    async def _maintain(self, address: str):
+        try:
+            await self._keep_connected(address)
+        finally:
+            self._set_state(address, None)
+
+    async def _keep_connected(self, address: str):
+        backoff = self.min_backoff
+        while not self._closed:
+            if time.monotonic() - self._wanted.get(address, 0.0) > self.idle_disconnect_s:
+                break  # устройство больше никто не читает — отпускаем соединение
+            self._set_state(address, "connecting")
+            connected = False
+            disconnected = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            client = self.client_factory(address, lambda _client: loop.call_soon_threadsafe(disconnected.set))
+            try:
+                await client.connect()
+                self.connects += 1
+                metrics.inc("ble_connects")
+                backoff = self.min_backoff
+                level = self._parse_level(await client.read_gatt_char(BATTERY_LEVEL_UUID))
+                self.gatt_reads += 1
+                if level is not None:
+                    self._set_level(address, level)
+                connected = True
+                self._set_state(address, "connected")
+                try:
+                    await client.start_notify(BATTERY_LEVEL_UUID, lambda _sender, data: self._on_notify(address, data))
+                    notify = True
+                except Exception as e:
+                    notify = False
+                    log_handler.log.info(f"BLE {address}: no battery notifications ({e}), reading every {self.read_interval}s")
+                while not self._closed and client.is_connected:
+                    if time.monotonic() - self._wanted.get(address, 0.0) > self.idle_disconnect_s:
+                        break
+                    wait = self.idle_disconnect_s if notify else self.read_interval
+                    try:
+                        await asyncio.wait_for(disconnected.wait(), wait)
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+                    if not notify and client.is_connected:
+                        level = self._parse_level(await client.read_gatt_char(BATTERY_LEVEL_UUID))
+                        self.gatt_reads += 1
+                        metrics.inc("ble_reads")
+                        if level is not None:
+                            self._set_level(address, level)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_handler.log.warning(f"BLE {address} connection failed: {e}")
+            finally:
+                try:
+                    await client.disconnect()
+                except Exception:
+                    pass
+            if self._closed or time.monotonic() - self._wanted.get(address, 0.0) > self.idle_disconnect_s:
+                break
+            if not connected:
+                # подключиться не удалось — до следующей попытки уровня нет
+                self._set_state(address, "backoff")
+            else:
+                self._set_state(address, "connecting")  # обрыв: уровень из кэша, пока переподключаемся
+            log_handler.log.info(f"BLE {address} disconnected, reconnecting in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(self.max_backoff, backoff * 2)
+
+    def _on_notify(self, address: str, data):
+        level = self._parse_level(data)
+        self.notifications += 1
+        metrics.inc("ble_notifications")
+        if level is not None:
+            self._set_level(address, level)
+
+    def close(self):
+        self._closed = True
+        loop = self._loop
+        if loop is None:
+            return
+        for task in list(self._tasks.values()):
+            task.cancel()
+        # даём задачам отключиться, затем останавливаем цикл
+        loop.call_soon_threadsafe(lambda: loop.call_later(0.5, loop.stop))
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+
+
+class FakeBleDevice:
+    """
+    Scripted BLE peripheral for BleBatteryBackend (tests, --fake-backend).
+    script is a list of (delay_s, event, value) run after each connect:
+    ('level', n) — the level changes (notified if notify=True), ('disconnect', None)
+    — the link drops. connect_failures makes the first N connects fail.
+    """
+
+    def __init__(self, address: str, name: str, level: int = 80, script: Optional[List[tuple]] = None,
+                 notify: bool = True, connect_failures: int = 0):
+        self.address = address
+        self.name = name
+        self.level = level
+        self.script = list(script or [])
+        self.notify = notify
+        self.connect_failures = connect_failures
+        self.connects = 0
+        self.reads = 0
+
+    def client(self, disconnected_callback: Optional[Callable] = None) -> "FakeBleClient":
+        return FakeBleClient(self, disconnected_callback)
+
+
+class FakeBleClient:
+    """The subset of bleak.BleakClient used by BleBatteryBackend, driven by a FakeBleDevice."""
+
+    def __init__(self, device: FakeBleDevice, disconnected_callback: Optional[Callable] = None):
+        self.device = device
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self._notify: Optional[Callable] = None
+        self._script_task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        self.device.connects += 1
+        if self.device.connect_failures > 0:
+            self.device.connect_failures -= 1
+            raise ConnectionError("fake connect failure")
+        self.is_connected = True
+        self._script_task = asyncio.create_task(self._run_script())
+
+    async def disconnect(self):
+        if self._script_task is not None:
+            self._script_task.cancel()
+        self.is_connected = False
+
+    async def read_gatt_char(self, uuid: str) -> bytearray:
+        if not self.is_connected:
+            raise ConnectionError("not connected")
+        self.device.reads += 1
+        return bytearray([self.device.level])
+
+    async def start_notify(self, uuid: str, callback: Callable):
+        if not self.device.notify:
+            raise NotImplementedError("characteristic does not support notify")
+        self._notify = callback
+
+    async def _run_script(self):
+        for delay, event, value in self.device.script:
+            await asyncio.sleep(delay)
+            if event == "level":
+                self.device.level = value
+                if self._notify is not None:
+                    self._notify(None, bytearray([value]))
+            elif event == "disconnect":
+                self.is_connected = False
+                if self.disconnected_callback is not None:
+                    self.disconnected_callback(self)
+                return
+
+
+class BatteryMonitor:
+    def __init__(self, backend: Optional[BatteryBackend] = None, ble_backend: Optional[BatteryBackend] = None):
+        self.device_id: str = ""
+        self.device_type: str = ""  # 'ble' или 'pnp'
+        self.backend = backend or PowerShellBackend()
+        # BLE-устройства (GATT Battery Service) читаются отдельным бэкендом, если он есть
+        self.ble_backend = ble_backend
+
+    def _read_pnp_battery(self, instance_id: str) -> Optional[int]:
+        try:
+            with metrics.timer("battery_read"):
+                level = self.backend.read(instance_id)
+        except Exception as e:
+            self._log_error(e)
+            level = None
+        if level is None:
+            metrics.inc("battery_read_failures")
+        return level
+
+    def get_battery_level(self, device_id: Optional[str] = None, device_type: Optional[str] = None) -> Optional[int]:
+        device_id = device_id if device_id is not None else self.device_id
+        device_type = device_type if device_type is not None else self.device_type
+        if not device_id or not device_type:
+            return None
+        if device_type == "ble":
+            return self.get_battery_levels([(device_id, device_type)]).get(device_id)
+        else:
+            return self._read_pnp_battery(device_id)
+
+    def get_battery_levels(self, devices: List[tuple]) -> Dict[str, Optional[int]]:
+        """
+        Read several devices at once: devices is a list of (device_id, device_type).
+        All PnP devices go to the backend in a single request; BLE levels come
+        from the BLE backend's notification cache.
+        """
+        levels: Dict[str, Optional[int]] = {}
+        pnp_ids = []
+        ble_ids = []
+        for device_id, device_type in devices:
+            levels[device_id] = None
+            if device_type == "ble":
+                if self.ble_backend is None:
+                    log_handler.log.error(f"somewhere got ble device, check it {device_id} {device_type}")
+                elif device_id:
+                    ble_ids.append(device_id)
+            elif device_id:
+                pnp_ids.append(device_id)
+        if ble_ids:
+            try:
+                levels.update(self.ble_backend.read_many(ble_ids))
+            except Exception as e:
+                self._log_error(e)
+        if pnp_ids:
+            try:
+                with metrics.timer("battery_read_many"):
+                    levels.update(self.backend.read_many(pnp_ids))
+            except Exception as e:
+                self._log_error(e)
+            metrics.inc("battery_reads", len(pnp_ids))
+            metrics.inc("battery_read_failures", sum(1 for device_id in pnp_ids if levels.get(device_id) is None))
+        return levels
+
+    def close(self):
+        self.backend.close()
+        if self.ble_backend is not None:
+            self.ble_backend.close()
+
+    def _log_error(self, e: Exception):
+        # короткая локальная функция логирования (использует существующий логгер, если есть)
+        try:
+            log_handler.log.error(f"Error in BT module: {e}")
+        except Exception:
+            print(f"BatteryMonitor error: {e}")
+
+
+class DiscoveryError(RuntimeError):
+    """A backend failed during a device scan, so the scan result is incomplete."""
+
+
+@dataclass
+class DiscoveryStats:
+    devices: int = 0
+    time_to_first: Optional[float] = None
+    total_time: float = 0.0
+    failed: int = 0  # бэкенды, скан которых не удался
+
+    def summary(self) -> str:
+        first = f"{self.time_to_first * 1000:.0f}ms" if self.time_to_first is not None else "-"
+        return (f"devices={self.devices} first={first} total={self.total_time * 1000:.0f}ms "
+                f"failed={self.failed}")
+
+
+class DeviceManager:
+    def __init__(self, backend: Optional[BatteryBackend] = None, ble_backend: Optional[BatteryBackend] = None):
+        self.backend = backend or PowerShellBackend()
+        self.ble_backend = ble_backend
+        self.last_stats = DiscoveryStats()
+
+    def get_devices(self) -> List[Dict[str, str]]:
+        """
+        Full device scan through the backend.
+        Возвращает список dict: {name, id, id_type, battery}
+        """
+        return list(self.iter_devices())
+
+    def iter_devices(self) -> Iterator[Dict[str, str]]:
+        """
+        Stream devices from the backend as they are found; records DiscoveryStats.
+        If a backend fails, the other backends are still scanned and DiscoveryError
+        is raised at the end: what was yielded is not the full device list.
+        """
+        stats = DiscoveryStats()
+        started = time.perf_counter()
+        errors = []
+        try:
+            for backend in (self.backend, self.ble_backend):
+                if backend is None:
+                    continue
+                try:
+                    for device in backend.iter_discover():
+                        if stats.time_to_first is None:
+                            stats.time_to_first = time.perf_counter() - started
+                        stats.devices += 1
+                        yield device
+                except Exception as e:
+                    stats.failed += 1
+                    errors.append(f"{type(backend).__name__}: {e}")
+                    log_handler.log.error(f"Device discovery failed ({type(backend).__name__}): {e}")
+            if errors:
+                raise DiscoveryError("; ".join(errors))
+        finally:
+            stats.total_time = time.perf_counter() - started
+            self.last_stats = stats
+            metrics.observe("discovery", stats.total_time)
+            if stats.time_to_first is not None:
+                metrics.observe("discovery_first_device", stats.time_to_first)
+            metrics.inc("discovery_devices", stats.devices)
+            log_handler.log.info(f"Discovery stats: {stats.summary()}")
+
+
+@dataclass
+class DeviceEvent:
+    kind: str  # 'created', 'changed' или 'deleted'
+    instance_id: str
+    name: str = ""
+
+
+class DeviceEventSource(ABC):
+    """Blocking stream of PnP device events consumed by DeviceWatcher on its own thread."""
+
+    @abstractmethod
+    def next_event(self, timeout: float) -> Optional[DeviceEvent]:
+        """Wait up to timeout seconds for the next event; None if there was none."""
+
+    def close(self):
+        pass
+
+
+# wbemErrTimedOut: NextEvent не дождался события
+WBEM_E_TIMED_OUT = -2147209215  # 0x80043001
+
+
+def _is_wmi_timeout(e: Exception) -> bool:
+    args = getattr(e, "args", ())
+    if args and args[0] == WBEM_E_TIMED_OUT:
+        return True
+    excepinfo = args[2] if len(args) > 2 else None
+    return bool(excepinfo) and len(excepinfo) > 5 and excepinfo[5] == WBEM_E_TIMED_OUT
+
+
+class WmiDeviceEventSource(DeviceEventSource):
+    """
+    Device arrival/removal from Win32_DeviceChangeEvent. WMI pushes these
+    events without polling the PnP class, but they do not say which device
+    changed: after each burst of events one candidate query (`snapshot`,
+    [(instance_id, name)]) is compared with the previous one and the
+    difference comes out as 'created'/'deleted' DeviceEvents.
+    """
+
+    QUERY = "SELECT * FROM Win32_DeviceChangeEvent"
+
+    def __init__(self, snapshot: Callable[[], List[tuple]], settle: float = 1.0, max_settle: float = 5.0):
+        self.snapshot = snapshot
+        self.settle = settle
+        self.max_settle = max_settle
+        self._events = None
+        self._pythoncom = None
+        self._known: Optional[Dict[str, str]] = None  # None — исходного снимка ещё нет
+        self._stale = True  # снимок ещё не сделан или прошлый не удался
+        self._diff: deque = deque()
+        self.notifications = 0
+        self.snapshots = 0
+
+    def _connect(self):
+        # COM-объекты привязаны к потоку — подключаемся из потока наблюдателя
+        import pythoncom
+        import win32com.client
+        pythoncom.CoInitialize()
+        self._pythoncom = pythoncom
+        locator = win32com.client.Dispatch("WbemScripting.SWbemLocator")
+        svc = locator.ConnectServer(".", "root\\cimv2")
+        self._events = svc.ExecNotificationQuery(self.QUERY)
+
+    def _wait(self, timeout: float) -> bool:
+        try:
+            self._events.NextEvent(int(timeout * 1000))
+        except Exception as e:
+            if _is_wmi_timeout(e):
+                return False
+            raise
+        self.notifications += 1
+        return True
+
+    def _refresh(self):
+        current = dict(self.snapshot())  # ошибка WMI пробрасывается, _stale остаётся — повторим
+        self.snapshots += 1
+        if self._known is not None:
+            for inst, name in current.items():
+                if inst not in self._known:
+                    self._diff.append(DeviceEvent("created", inst, name))
+            for inst, name in self._known.items():
+                if inst not in current:
+                    self._diff.append(DeviceEvent("deleted", inst, name))
+        self._known = current
+        self._stale = False
+
+    def next_event(self, timeout: float) -> Optional[DeviceEvent]:
+        if self._events is None:
+            # первый снимок — после подписки, чтобы изменения между ними не потерялись
+            self._connect()
+        if self._stale:
+            self._refresh()
+        if not self._diff:
+            if not self._wait(timeout):
+                return None
+            # одно подключение устройства — пачка событий: ждём тишины и сравниваем один раз
+            deadline = time.monotonic() + self.max_settle
+            while time.monotonic() < deadline and self._wait(self.settle):
+                pass
+            self._stale = True
+            self._refresh()
+        return self._diff.popleft() if self._diff else None
+
+    def close(self):
+        if self._events is not None:
+            log_handler.log.info(
+                f"WMI device events: notifications={self.notifications} snapshots={self.snapshots}"
+            )
+        self._events = None
+        if self._pythoncom is not None:
+            try:
+                self._pythoncom.CoUninitialize()
+            except Exception:
+                pass
+            self._pythoncom = None
+
+
+class ScriptedEventSource(DeviceEventSource):
+    """Replays [(delay_seconds, DeviceEvent)] in order; for tests and benchmarks."""
+
+    def __init__(self, events: List[tuple], sleep: Callable[[float], None] = time.sleep):
+        self._events = list(events)
+        self._index = 0
+        self._waited = 0.0
+        self.sleep = sleep
+
+    def next_event(self, timeout: float) -> Optional[DeviceEvent]:
+        if self._index >= len(self._events):
+            self.sleep(timeout)
+            return None
+        delay, event = self._events[self._index]
+        remaining = delay - self._waited
+        if remaining > timeout:
+            self._waited += timeout
+            self.sleep(timeout)
+            return None
+        if remaining > 0:
+            self.sleep(remaining)
+        self._index += 1
+        self._waited = 0.0
+        return event
+
+
+class DeviceWatcher:
+    """
+    Turns device events into incremental device list updates.
+
+    Events are debounced (one BT connect fires several PnP events) and
+    collapsed per instance id; each flush probes only the changed entities
+    that look like candidates, with one batched read. on_change receives
+    (added_devices, removed_ids).
+    """
+
+    def __init__(self, source: DeviceEventSource, backend: BatteryBackend,
+                 on_change: Callable[[List[Dict], List[str]], None],
+                 debounce: float = 1.5, max_delay: float = 10.0, poll_timeout: float = 0.5):
+        self.source = source
+        self.backend = backend
+        self.on_change = on_change
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_timeout = poll_timeout
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.events = 0
+        self.flushes = 0
+        self.probed = 0
+        self.max_probed_per_flush = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="TrayBTB-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        log_handler.log.info(f"Device watcher: {self.summary()}")
+
+    def summary(self) -> str:
+        return (f"events={self.events} flushes={self.flushes} probed={self.probed} "
+                f"max_probed_per_flush={self.max_probed_per_flush}")
+
+    def _run(self):
+        pending: Dict[str, DeviceEvent] = {}
+        first_ts = last_ts = 0.0
+        try:
+            while not self._stop.is_set():
+                try:
+                    event = self.source.next_event(self.poll_timeout)
+                except Exception as e:
+                    log_handler.log.warning(f"Device event source failed: {e}")
+                    self._stop.wait(5)
+                    continue
+                now = time.monotonic()
+                if event is not None:
+                    self.events += 1
+                    if not pending:
+                        first_ts = now
+                    # по каждому устройству важно только последнее событие
+                    pending[event.instance_id] = event
+                    last_ts = now
+                if pending and (now - last_ts >= self.debounce or now - first_ts >= self.max_delay):
+                    batch, pending = list(pending.values()), {}
+                    self.flush(batch)
+            if pending:
+                self.flush(list(pending.values()))
+        finally:
+            self.source.close()
+
+    def flush(self, events: List[DeviceEvent]):
+        """Probe the changed candidates in one batch and report the result."""
+        removed = [e.instance_id for e in events if e.kind == "deleted"]
+        to_probe = [e for e in events if e.kind != "deleted" and is_candidate_name(e.name)]
+        levels: Dict[str, Optional[int]] = {}
+        if to_probe:
+            try:
+                levels = self.backend.read_many([e.instance_id for e in to_probe])
+            except Exception as e:
+                log_handler.log.warning(f"Probing changed devices failed: {e}")
+        self.flushes += 1
+        self.probed += len(to_probe)
+        self.max_probed_per_flush = max(self.max_probed_per_flush, len(to_probe))
+
+        added = []
+        for e in to_probe:
+            level = levels.get(e.instance_id)
+            if level is not None:
+                added.append({"name": e.name, "id": e.instance_id, "id_type": "pnp", "battery": level})
+            else:
+                removed.append(e.instance_id)  # изменилось и больше не отдаёт батарею
+        log_handler.log.info(
+            f"Device events: {len(events)} changed, {len(to_probe)} probed, "
+            f"{len(added)} with battery, {len(removed)} gone"
+        )
+        try:
+            self.on_change(added, removed)
+        except Exception as e:
+            log_handler.log.error(f"Applying device changes failed: {e}")
+
+
+class BatteryHistory:
+    """
+    Fixed-memory (timestamp, level) history of one device plus an O(1)
+    estimator of the discharge rate and time to empty.
+
+    The last `capacity` samples are kept as-is in a ring buffer; all samples
+    are also averaged into bucket_s buckets kept in a second ring of `buckets`
+    entries (a week at the defaults), so memory does not grow with uptime.
+    The estimator is a linear regression over exponentially decayed sums
+    (half_life_s), updated per sample and reset when the device is charged.
+    """
+
+    def __init__(self, capacity: int = 256, bucket_s: float = 600.0, buckets: int = 1008,
+                 half_life_s: float = 3600.0, min_span_s: float = 600.0):
+        self.capacity = capacity
+        self.bucket_s = bucket_s
+        self._times = array("d", bytes(8 * capacity))
+        self._levels = array("b", bytes(capacity))
+        self._next = 0
+        self._count = 0
+        self._bucket_times = array("d", bytes(8 * buckets))
+        self._bucket_levels = array("f", bytes(4 * buckets))
+        self._bucket_next = 0
+        self._bucket_count = 0
+        self._bucket_start: Optional[float] = None
+        self._bucket_sum = 0.0
+        self._bucket_n = 0
+        # оценка скорости разряда: взвешенные суммы регрессии level(t), t отсчитывается от последнего сэмпла
+        self._tau = half_life_s / math.log(2)
+        self.min_span_s = min_span_s
+        self._last_t: Optional[float] = None
+        self._last_level: Optional[int] = None
+        self._reset_estimator()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, timestamp: float, level: int):
+        if self._last_t is not None and timestamp < self._last_t:
+            return  # сэмплы приходят по порядку; старые игнорируем
+        i = self._next
+        self._times[i] = timestamp
+        self._levels[i] = level
+        self._next = (i + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+        self._add_to_bucket(timestamp, level)
+        self._update_estimator(timestamp, level)
+
+    def samples(self) -> List[tuple]:
+        """Recent raw samples, oldest first."""
+        start = (self._next - self._count) % self.capacity
+        return [
+            (self._times[(start + k) % self.capacity], self._levels[(start + k) % self.capacity])
+            for k in range(self._count)
+        ]
+
+    def downsampled(self) -> List[tuple]:
+        """Bucket averages (bucket start, mean level), oldest first."""
+        size = len(self._bucket_times)
+        start = (self._bucket_next - self._bucket_count) % size
+        return [
+            (self._bucket_times[(start + k) % size], self._bucket_levels[(start + k) % size])
+            for k in range(self._bucket_count)
+        ]
+
+    @property
+    def rate_per_hour(self) -> Optional[float]:
+        """Discharge rate in percent per hour (positive while discharging), None if unknown."""
+        s0, st, sl, stt, stl = self._sums
+        if s0 < 3:
+            return None
+        variance = stt / s0 - (st / s0) ** 2
+        if variance < (self.min_span_s / 2) ** 2:
+            return None  # сэмплы покрывают слишком короткий отрезок времени
+        slope = (s0 * stl - st * sl) / (s0 * stt - st * st)
+        return -slope * 3600.0
+
+    def time_to_empty(self) -> Optional[float]:
+        """Seconds until the level reaches 0 at the current rate, None if not discharging."""
+        rate = self.rate_per_hour
+        if rate is None or rate <= 0.05 or self._last_level is None:
+            return None
+        return self._last_level / rate * 3600.0
+
+    def _add_to_bucket(self, timestamp: float, level: int):
+        if self._bucket_start is not None and timestamp >= self._bucket_start + self.bucket_s:
+            size = len(self._bucket_times)
+            self._bucket_times[self._bucket_next] = self._bucket_start
+            self._bucket_levels[self._bucket_next] = self._bucket_sum / self._bucket_n
+            self._bucket_next = (self._bucket_next + 1) % size
+            self._bucket_count = min(self._bucket_count + 1, size)
+            self._bucket_start = None
+        if self._bucket_start is None:
+            self._bucket_start = timestamp - timestamp % self.bucket_s
+            self._bucket_sum = 0.0
+            self._bucket_n = 0
+        self._bucket_sum += level
+        self._bucket_n += 1
+
+    def _reset_estimator(self):
+        # s0 = Σw, st = Σw·t, sl = Σw·level, stt = Σw·t², stl = Σw·t·level
+        self._sums = (0.0, 0.0, 0.0, 0.0, 0.0)
+
+    def _update_estimator(self, timestamp: float, level: int):
+        if self._last_level is not None and level >= self._last_level + 2:
+            self._reset_estimator()  # заряжали — старый наклон больше не актуален
+        s0, st, sl, stt, stl = self._sums
+        if self._last_t is not None and s0 > 0:
+            dt = timestamp - self._last_t
+            decay = math.exp(-dt / self._tau)
+            # переносим начало отсчёта на новый сэмпл (t -> t - dt) и затухаем старые веса
+            st, stt, stl = st - dt * s0, stt - 2 * dt * st + dt * dt * s0, stl - dt * sl
+            s0, st, sl, stt, stl = s0 * decay, st * decay, sl * decay, stt * decay, stl * decay
+        self._sums = (s0 + 1.0, st, sl + level, stt, stl)
+        self._last_t = timestamp
+        self._last_level = level
+
+
+def format_remaining(seconds: float) -> str:
+    """'5h 20m' rounded to 10 minutes, so the tooltip does not change on every poll."""
+    minutes = min(int(round(seconds / 600.0)) * 10, 99 * 60)
+    if minutes < 60:
+        return f"{max(minutes, 10)}m"
+    return f"{minutes // 60}h {minutes % 60:02d}m"
+
+
+@dataclass
+class MonitoredDevice:
+    name: str
+    device_id: str
+    device_type: str
+    policy: str = "tray"  # 'tray' — показывается в трее, 'notify' — только уведомления о разряде
+    low_threshold: int = 20
+    status: BatStatus = field(default_factory=lambda: BatStatus(level=None, last_update=0))
+    low_alerted: bool = False  # уведомление о разряде уже отправлено, ждём подзарядки
+    history: BatteryHistory = field(default_factory=BatteryHistory, repr=False, compare=False)
+
+
+class MonitoringEngine:
+    """
+    Tracks any number of devices and reads all of them with one batched query
+    per cycle, so the cost of a cycle barely depends on the number of devices.
+    At most one device has the 'tray' policy; the rest are notify-only.
+    """
+
+    def __init__(self, battery_monitor: BatteryMonitor):
+        self.battery_monitor = battery_monitor
+        self._devices: Dict[str, MonitoredDevice] = {}
+        self._lock = threading.Lock()
+        self.cycles = 0
+        self.last_cycle_latency = 0.0
+
+    def add(self, device: MonitoredDevice) -> MonitoredDevice:
+        """Start monitoring device; a new 'tray' device demotes the previous one."""
+        with self._lock:
+            if device.policy == "tray":
+                for other in self._devices.values():
+                    if other.policy == "tray" and other.device_id != device.device_id:
+                        other.policy = "notify"
+            current = self._devices.get(device.device_id)
+            if current is not None:
+                # уже отслеживаем — меняем только политику, историю статуса сохраняем
+                current.policy = device.policy
+                return current
+            self._devices[device.device_id] = device
+            return device
+
+    def remove(self, device_id: str) -> Optional[MonitoredDevice]:
+        with self._lock:
+            return self._devices.pop(device_id, None)
+
+    def get(self, device_id: str) -> Optional[MonitoredDevice]:
+        with self._lock:
+            return self._devices.get(device_id)
+
+    def has(self, device_id: str) -> bool:
+        with self._lock:
+            return device_id in self._devices
+
+    def devices(self) -> List[MonitoredDevice]:
+        with self._lock:
+            return list(self._devices.values())
+
+    def tray_device(self) -> Optional[MonitoredDevice]:
+        with self._lock:
+            for device in self._devices.values():
+                if device.policy == "tray":
+                    return device
+        return None
+
+    def poll(self) -> List[tuple]:
+        """
+        Run one monitoring cycle (blocking): read every tracked device in one
+        batch and update its status. Returns [(device, level or None)] for the
+        devices that are still tracked after the read.
+        """
+        started = time.perf_counter()
+        targets = self.devices()
+        if not targets:
+            return []
+        levels = self.battery_monitor.get_battery_levels(
+            [(d.device_id, d.device_type) for d in targets]
+        )
+        now = time.time()
+        results = []
+        with self._lock:
+            for device in targets:
+                if self._devices.get(device.device_id) is not device:
+                    continue  # устройство убрали, пока шёл опрос
+                level = levels.get(device.device_id)
+                # статус неизменяемый: читатели в других потоках видят либо старый, либо новый целиком
+                if level is not None:
+                    device.status = BatStatus(level=level, last_update=now)
+                    device.history.add(now, level)
+                else:
+                    device.status = replace(device.status, error_count=device.status.error_count + 1)
+                results.append((device, level))
+        self.cycles += 1
+        self.last_cycle_latency = time.perf_counter() - started
+        return results
+
+    def push(self, device_id: str, level: int) -> Optional[MonitoredDevice]:
+        """Apply a level the device reported by itself (BLE notification); None if it is not tracked."""
+        now = time.time()
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is not None:
+                device.status = BatStatus(level=level, last_update=now)
+                device.history.add(now, level)
+            return device
+
+
+class PollScheduler:
+    """
+    Decides when the next battery poll is due.
+
+    The interval grows while the level is stable, drops back when it changes
+    (down to min_interval when it changes fast), is capped near the low battery
+    threshold and backs off exponentially on consecutive failures. `clock` is
+    injectable so the schedule can be driven by a simulated clock.
+    """
+
+    def __init__(self, min_interval: float = 5.0, base_interval: float = 15.0,
+                 max_interval: float = 300.0, near_threshold_interval: float = 30.0,
+                 low_threshold: int = 20, threshold_margin: int = 5,
+                 fast_rate: float = 1.0 / 60, growth: float = 1.5,
+                 failure_interval: float = 2.0, max_failure_interval: float = 120.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.min_interval = min_interval
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.near_threshold_interval = near_threshold_interval
+        self.low_threshold = low_threshold
+        self.threshold_margin = threshold_margin
+        self.fast_rate = fast_rate  # % в секунду, выше — считаем, что уровень меняется быстро
+        self.growth = growth
+        self.failure_interval = failure_interval
+        self.max_failure_interval = max_failure_interval
+        self.clock = clock
+
+        self.interval = min_interval
+        self.failures = 0
+        self.polls = 0
+        self.started = clock()
+        self.next_due = self.started
+        self._last_level: Optional[int] = None
+        self._last_ts = 0.0
 
-NO_WINDOW = 0
-if sys.platform == "win32" and hasattr(subprocess, "CREATE_NO_WINDOW"):
-    NO_WINDOW = subprocess.CREATE_NO_WINDOW
+    def reset(self):
+        """Forget the level history (e.g. after switching device) and poll right away."""
+        self.interval = self.min_interval
+        self.failures = 0
+        self._last_level = None
+        self.poll_now()
 
-fulltime = str(datetime.now())
-if sys.platform == "win32":
-    try:
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    except Exception:
-        pass
+    def poll_now(self):
+        self.next_due = self.clock()
 
-@dataclass
-class BatStatus:
-    level: Optional[int]
-    last_update: float
-    error_count: int = 0
+    def is_due(self) -> bool:
+        return self.clock() >= self.next_due
 
-class Logs:
-    def __init__(self):
-        self.log = logging.getLogger("TrayBTB")
-        if not os.path.exists("logs"):
-            os.makedirs("logs")
-        logFileStart = "logs\\TrayBTB_"
-        logFileExt = ".log"
-        self.logFileName = logFileStart+fulltime[:fulltime.rfind('.')].replace(" ","_").replace(":","-")+logFileExt
-        self.logLevel = logging.INFO
-        self.log.setLevel(self.logLevel)
-        self.handler = logging.FileHandler(filename=self.logFileName, mode = "a", encoding='utf-8')
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    def record_success(self, level: int) -> float:
+        """Register a successful reading and return the delay until the next poll."""
+        now = self.clock()
+        self.polls += 1
+        self.failures = 0
+        if self._last_level is None:
+            interval = self.base_interval
+        elif level != self._last_level:
+            rate = abs(level - self._last_level) / max(now - self._last_ts, 1e-6)
+            interval = self.min_interval if rate >= self.fast_rate else self.base_interval
+        else:
+            interval = min(self.max_interval, self.interval * self.growth)
+        if level <= self.low_threshold + self.threshold_margin:
+            interval = min(interval, self.near_threshold_interval)
+        self.interval = max(self.min_interval, interval)
+        self._last_level = level
+        self._last_ts = now
+        self.next_due = now + self.interval
+        return self.interval
+
+    def record_failure(self) -> float:
+        """Register a failed reading and return the backed-off delay until the next poll."""
+        self.polls += 1
+        self.failures += 1
+        delay = min(self.max_failure_interval, self.failure_interval * 2 ** (self.failures - 1))
+        self.next_due = self.clock() + delay
+        return delay
+
+    def polls_per_hour(self) -> float:
+        elapsed = self.clock() - self.started
+        return self.polls * 3600.0 / elapsed if elapsed > 0 else 0.0
+
+    def report(self, fixed_interval: float) -> str:
+        """Polls-per-hour of this scheduler compared with a fixed-interval poller."""
+        return (
+            f"{self.polls_per_hour():.0f} polls/h adaptive vs "
+            f"{3600.0 / fixed_interval:.0f} polls/h at fixed {fixed_interval}s"
         )
-        self.handler.setFormatter(formatter)
-        self.log.addHandler(self.handler)
-        self.log.info("Logging initialized")
 
-    def changeLogLevel(self, level: int):
-        self.log.setLevel(level)
-    
-class DeviceState(Enum):
-    UPDATING = 0
-    NO_DEVICE = 1
-    DEVICE_CHOSEN = 2
+class DiscoveryCache:
+    """
+    Small on-disk JSON cache of the last discovery results and of the devices
+    being monitored, so the menu can be built and monitoring resumed at launch
+    without a full scan. Entries older than `ttl` or of another format version
+    are ignored.
+    """
+    VERSION = 1
 
-class BatteryMonitor:
-    def __init__(self):
-        self.device_id: str = ""
-        self.device_type: str = ""  # 'ble' или 'pnp'
-        
-    def _read_pnp_battery(self, instance_id: str) -> Optional[int]:
+    def __init__(self, path: str = os.path.join("cache", "devices.json"), ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+
+    def load(self) -> Optional[Dict]:
+        """Return {'devices', 'chosen', 'notify'} or None if there is no usable cache."""
         try:
-            result = subprocess.run(
-                [
-                    "powershell", "-NoProfile", "-NonInteractive", "-Command",
-                    f"(Get-PnpDeviceProperty -InstanceId '{instance_id}' -KeyName 'DEVPKEY_Device_BatteryLevel' -ErrorAction SilentlyContinue).Data"
-                ],
-                capture_output=True, text=True, encoding='cp866', creationflags=NO_WINDOW
-            )
-            if result.returncode == 0 and result.stdout:
-                match = re.search(r'[0-9]+', result.stdout)
-                if match:
-                    return int(match.group(0))
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
             return None
         except Exception as e:
-            self._log_error(e)
+            log_handler.log.warning(f"Discovery cache unreadable: {e}")
             return None
-
-
-    def get_battery_level(self) -> Optional[int]:
-        if not self.device_id or not self.device_type:
+        if not isinstance(data, dict) or data.get("version") != self.VERSION:
+            log_handler.log.info("Discovery cache has another version, ignoring")
             return None
-        if self.device_type == "ble":
-            log_handler.log.error(f"somewhere got ble device, check it {self.device_id} {self.device_type}")
-        else:
-            return self._read_pnp_battery(self.device_id)
-
-    def _log_error(self, e: Exception):
-        # короткая локальная функция логирования (использует существующий логгер, если есть)
-        try:
-            log_handler.log.error(f"Error in BT module: {e}")
-        except Exception:
-            print(f"BatteryMonitor error: {e}")
-
-class DeviceManager:
-    def get_devices(self) -> List[Dict[str, str]]:
-        """
-        Быстрый WMI-скан для кандидатов (фильтр по имени) + параллельный
-        вызов Get-PnpDeviceProperty для каждого InstanceId.
-        Возвращает список dict: {name, id, id_type='pnp', battery}
-        """
-        devices: List[Dict[str, str]] = []
-        initialized_com = False
+        age = time.time() - float(data.get("saved_at", 0))
+        if age > self.ttl:
+            log_handler.log.info(f"Discovery cache expired ({age / 3600:.0f}h old)")
+            return None
+        devices = [
+            d for d in data.get("devices", [])
+            if isinstance(d, dict) and d.get("id") and d.get("name") and d.get("id_type")
+        ]
+        chosen = data.get("chosen")
+        if not isinstance(chosen, dict) or not chosen.get("id"):
+            chosen = None
+        notify = [d for d in data.get("notify", []) if isinstance(d, dict) and d.get("id")]
+        return {"devices": devices, "chosen": chosen, "notify": notify}
 
-        # Инициализируем COM в текущем потоке (безопасно — логируем любые ошибки)
-        try:
+    def save(self, devices: List[Dict], chosen: Optional[Dict], notify: List[Dict]):
+        data = {
+            "version": self.VERSION,
+            "saved_at": time.time(),
+            "devices": devices,
+            "chosen": chosen,
+            "notify": notify,
+        }
+        with self._lock:
             try:
-                pythoncom.CoInitialize()
-                initialized_com = True
-                try:
-                    log_handler.log.debug("pythoncom.CoInitialize() succeeded")
-                except Exception:
-                    pass
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.exists(directory):
+                    os.makedirs(directory)
+                # пишем во временный файл и подменяем — кэш не останется обрезанным
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
             except Exception as e:
-                try:
-                    log_handler.log.warning(f"pythoncom.CoInitialize() failed or already initialized: {e}")
-                except Exception:
-                    pass
+                log_handler.log.warning(f"Failed to save discovery cache: {e}")
 
-            # --- основной код метода (WMI + параллельный PowerShell) ---
-            try:
-                # подключаемся к WMI и получаем PNPDeviceID + Name только для кандидатов
-                locator = win32com.client.Dispatch("WbemScripting.SWbemLocator")
-                svc = locator.ConnectServer(".", "root\\cimv2")
-                # фильтр по имени уменьшает количество проверяемых устройств
-                q = (
-                    "SELECT PNPDeviceID, Name FROM Win32_PnPEntity "
-                    "WHERE Status='OK' AND ("
-                    "Name LIKE '%Headphone%' OR Name LIKE '%Headphones%' OR "
-                    "Name LIKE '%Audio%' OR Name LIKE '%Hands-Free%' OR "
-                    "Name LIKE '%AirPods%' OR Name LIKE '%WH%' OR Name LIKE '%BT%'"
-                    ")"
-                )
-                items = svc.ExecQuery(q)
-                candidates = []
-                for it in items:
-                    inst = getattr(it, "PNPDeviceID", None)
-                    name = getattr(it, "Name", None)
-                    if inst:
-                        candidates.append((inst, name or inst))
-                try:
-                    log_handler.log.info(f"WMI candidates count: {len(candidates)}")
-                except Exception:
-                    pass
-            except Exception as e:
-                try:
-                    log_handler.log.error(f"WMI query failed: {e}")
-                except Exception:
-                    print(f"WMI query failed: {e}")
-                candidates = []
+class MenuUpdater:
+    """
+    Debounced, coalescing tray-menu updates. request() only marks the menu as
+    stale; a worker thread waits for quiet_s without new requests (but no longer
+    than max_delay_s after the first one), then builds the menu for the latest
+    state and applies it. When the state fingerprint equals the one already
+    shown, the native rebuild is skipped.
+    """
 
-            if not candidates:
-                return []
+    def __init__(self, fingerprint: Callable[[], object], build: Callable[[], object],
+                 apply: Callable[[object], bool], quiet_s: float = 0.1, max_delay_s: float = 0.5):
+        self.fingerprint = fingerprint
+        self.build = build
+        self.apply = apply
+        self.quiet_s = quiet_s
+        self.max_delay_s = max_delay_s
+        self._cond = threading.Condition()
+        self._pending = False
+        self._busy = False
+        self._stopped = False
+        self._first_request = 0.0
+        self._last_request = 0.0
+        self._applied: Optional[object] = None
+        self._thread: Optional[threading.Thread] = None
+        self.requests = 0
+        self.rebuilds = 0
+        self.skipped = 0
+        self.errors = 0
 
-            # runner для PowerShell: пробуем pwsh, иначе powershell
-            runner = shutil.which("pwsh") or "powershell"
+    def request(self):
+        with self._cond:
+            if self._stopped:
+                return
+            now = time.monotonic()
+            if not self._pending:
+                self._pending = True
+                self._first_request = now
+            self._last_request = now
+            self.requests += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="TrayBTB-menu", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
 
-            def probe(instance_and_name):
-                inst, name = instance_and_name
-                try:
-                    # вызываем только для одного InstanceId; возвращаем int battery или None
-                    ps_cmd = f"(Get-PnpDeviceProperty -InstanceId '{inst}' -KeyName 'DEVPKEY_Device_BatteryLevel' -ErrorAction SilentlyContinue).Data"
-                    res = subprocess.run(
-                        [runner, "-NoProfile", "-NonInteractive", "-Command", ps_cmd],
-                        capture_output=True, text=True, encoding='cp866', timeout=8, creationflags=NO_WINDOW
-                    )
-                    out = (res.stdout or "").strip()
-                    if not out:
-                        return None
-                    m = re.search(r'\d+', out)
-                    if not m:
-                        return None
-                    return {"name": name, "id": inst, "id_type": "pnp", "battery": int(m.group(0))}
-                except subprocess.TimeoutExpired:
-                    try:
-                        log_handler.log.debug(f"PS timeout for {inst}")
-                    except Exception:
-                        pass
-                    return None
-                except Exception as e:
-                    try:
-                        log_handler.log.debug(f"PS error for {inst}: {e}")
-                    except Exception:
-                        pass
-                    return None
+    def flush(self, timeout: float = 2.0) -> bool:
+        """Wait until every request made so far has been applied (or skipped)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._pending or self._busy) and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
 
-            # параллельно опрашиваем кандидатов (ограничиваем worker-ы)
-            results = []
-            with concurrent.futures.ThreadPoolExecutor(max_workers=12) as ex:
-                futs = [ex.submit(probe, c) for c in candidates]
-                for f in concurrent.futures.as_completed(futs):
-                    try:
-                        r = f.result()
-                        if r:
-                            results.append(r)
-                    except Exception:
-                        pass
+    def stop(self, timeout: float = 1.0):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
 
-            # убираем дубли по instance id
-            seen = set()
-            for r in results:
-                key = r.get("id")
-                if key and key not in seen:
-                    seen.add(key)
-                    devices.append(r)
+    def summary(self) -> str:
+        return f"requests={self.requests} rebuilds={self.rebuilds} skipped={self.skipped} errors={self.errors}"
 
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                # ждём тишины quiet_s после последнего запроса, но не дольше max_delay_s от первого
+                while not self._stopped:
+                    due = min(self._last_request + self.quiet_s, self._first_request + self.max_delay_s)
+                    remaining = due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopped:
+                    return
+                # запросы, пришедшие во время сборки, снова выставят _pending — последнее состояние не теряется
+                self._pending = False
+                self._busy = True
+            try:
+                self._rebuild()
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _rebuild(self):
+        try:
+            fingerprint = self.fingerprint()
+            if fingerprint == self._applied:
+                self.skipped += 1
+                return
+            with metrics.timer("menu_build"):
+                menu = self.build()  # сборка меню — без локов UI
+            if self.apply(menu):
+                self._applied = fingerprint
+                self.rebuilds += 1
+        except Exception as e:
+            self.errors += 1
             try:
-                log_handler.log.info(f"DeviceManager (pywin32) found: {len(devices)}")
+                log_handler.log.debug(f"Menu update failed: {e}")
             except Exception:
                 pass
 
-            return devices
-
-        finally:
-            # Обязательно разинициализируем COM в текущем потоке (если инициализировали)
-            if initialized_com:
-                try:
-                    pythoncom.CoUninitialize()
-                    try:
-                        log_handler.log.debug("pythoncom.CoUninitialize() called")
-                    except Exception:
-                        pass
-                except Exception as e:
-                    try:
-                        log_handler.log.warning(f"pythoncom.CoUninitialize() failed: {e}")
-                    except Exception:
-                        pass
 
 class IconManager:
-    def __init__(self, size: tuple = (64, 64)):
+    def __init__(self, size: tuple = (64, 64), cache_size: int = 128):
         self.size = size
-        
-    def create_image(self, color: str = 'blue') -> Image:
+        # LRU-кэш готовых иконок: ключ (цвет, текст)
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.renders = 0
+        self.hits = 0
+
+    def get_image(self, color: str = 'blue', text: Optional[str] = None) -> Image:
+        """Return a cached icon for (color, text), rendering it on a cache miss."""
+        key = (color.lower(), text)
+        with self._cache_lock:
+            image = self._cache.get(key)
+            if image is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                metrics.inc("icon_cache_hits")
+                return image
+        # рисуем вне lock: параллельный промах максимум отрисует ту же иконку дважды
+        with metrics.timer("icon_render"):
+            image = self.create_image(color, text)
+        with self._cache_lock:
+            self.renders += 1
+            self._cache[key] = image
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return image
+
+    def create_image(self, color: str = 'blue', text: Optional[str] = None) -> Image:
+        from PIL import Image, ImageDraw
         image = Image.new('RGB', self.size, 'white')
         dc = ImageDraw.Draw(image)
         dc.rectangle((16, 16, 48, 48), fill=color)
-        return image    
+        if text:
+            dc.text((self.size[0] / 2, self.size[1] / 2), text, fill='white', anchor='mm')
+        return image
     @staticmethod
     def get_hex_color(val: float) -> str:
         normalized = max(0, min(1, val / 100))
@@ -252,100 +2847,588 @@ class IconManager:
         return f"#{red:02x}{green:02x}00"
 
 class NotificationManager:
-    def __init__(self, app_name: str, icon_path: str):
+    def __init__(self, app_name: str, icon_path: str, enabled: bool = True):
         self.app_name = app_name
         self.icon_path = icon_path
+        # enabled=False (headless) — уведомления только пишутся в лог
+        self.enabled = enabled
         
     def show_notification(self, message: str):
-        notification = WinNotification(
-            app_id=self.app_name,
-            title=self.app_name,
-            msg=message,
-            icon=self.icon_path
+        metrics.inc("notifications")
+        if not self.enabled:
+            log_handler.log.info(f"Notification: {message}")
+            return
+        with metrics.timer("notification_show"):
+            from winotify import Notification as WinNotification, audio
+            notification = WinNotification(
+                app_id=self.app_name,
+                title=self.app_name,
+                msg=message,
+                icon=self.icon_path
+            )
+            notification.set_audio(audio.Reminder, False)
+            notification.show()
+
+class NotificationDispatcher:
+    """
+    Sends notifications from a background thread so callers only enqueue.
+
+    The queue is bounded (overflow is dropped and counted). A message whose key
+    is already waiting replaces the queued one instead of adding another toast,
+    and a key with a cooldown is suppressed until the cooldown has passed.
+    """
+
+    def __init__(self, manager: NotificationManager, maxsize: int = 16,
+                 clock: Callable[[], float] = time.monotonic):
+        self.manager = manager
+        self.clock = clock
+        self._queue: queue.Queue = queue.Queue(maxsize)
+        self._pending: Dict[str, str] = {}
+        self._last_enqueued: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.suppressed = 0
+        self.failed = 0
+
+    def notify(self, message: str, key: Optional[str] = None, cooldown: float = 0.0) -> bool:
+        """Enqueue message without blocking; returns False if it was suppressed or dropped."""
+        key = key or message
+        with self._lock:
+            if key in self._pending:
+                # такое уведомление уже ждёт отправки — просто обновляем текст
+                self._pending[key] = message
+                self.coalesced += 1
+                return True
+            now = self.clock()
+            last = self._last_enqueued.get(key)
+            if cooldown and last is not None and now - last < cooldown:
+                self.suppressed += 1
+                return False
+            try:
+                self._queue.put_nowait(key)
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._pending[key] = message
+            self._last_enqueued[key] = now
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="TrayBTB-notify", daemon=True)
+                self._thread.start()
+        return True
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            if key is None:
+                break
+            with self._lock:
+                message = self._pending.pop(key, None)
+            if message is None:
+                continue
+            try:
+                self.manager.show_notification(message)
+                self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                log_handler.log.warning(f"Notification failed: {e}")
+
+    def stop(self, timeout: float = 5.0):
+        """Deliver what is already queued (up to timeout) and stop the sender thread."""
+        with self._lock:
+            thread = self._thread
+        if thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        if thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def summary(self) -> str:
+        return (
+            f"sent={self.sent} coalesced={self.coalesced} suppressed={self.suppressed} "
+            f"dropped={self.dropped} failed={self.failed}"
+        )
+
+class _IpcClient:
+    """Outgoing side of one IPC connection: replies are queued, pushed events keep only the latest per kind."""
+
+    max_pending_replies = 256
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.subscribed = False
+        self._replies: deque = deque()
+        self._latest: Dict[str, bytes] = {}
+        self._ready = asyncio.Event()
+
+    def send(self, data: bytes) -> bool:
+        if len(self._replies) >= self.max_pending_replies:
+            return False  # клиент шлёт запросы и не читает ответы
+        self._replies.append(data)
+        self._ready.set()
+        return True
+
+    def send_last(self, data: bytes):
+        """Write the queued replies and a final line right away; the connection is closed next."""
+        while self._replies:
+            self.writer.write(self._replies.popleft())
+        self.writer.write(data)
+
+    def push(self, kind: str, data: bytes):
+        # медленный подписчик получит только последнее состояние, очередь не растёт
+        self._latest[kind] = data
+        self._ready.set()
+
+    async def run_sender(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._replies:
+                self.writer.write(self._replies.popleft())
+            latest, self._latest = self._latest, {}
+            for data in latest.values():
+                self.writer.write(data)
+            await self.writer.drain()
+
+
+class IpcServer:
+    """
+    Localhost JSON-lines API, so local tools share this app's poller instead of
+    running their own PowerShell queries. One request per line:
+      {"cmd": "ping"} | {"cmd": "devices"} | {"cmd": "levels"} | {"cmd": "refresh"}
+      {"cmd": "monitor", "id": ...} | {"cmd": "unmonitor", "id": ...} | {"cmd": "subscribe"}
+    Every request gets one reply line ({"ok": true, ...} or {"ok": false, "error": ...}).
+    A line that is not a JSON object ends the connection: a browser page posting
+    to the port gets its HTTP request line rejected before the body is read.
+    Subscribers then get {"event": "levels" | "devices", ...} after each poll,
+    device list change or change of the monitored devices. Replies and events
+    are encoded once per state and shared by all clients.
+    """
+
+    def __init__(self, app: "TrayApplication", host: str = "127.0.0.1", port: int = 47655, max_clients: int = 64,
+                 max_monitored: int = 32):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.max_clients = max_clients
+        # сколько устройств можно поставить на отслеживание через API (каждое — в кэше и в каждом опросе)
+        self.max_monitored = max_monitored
+        self._server: Optional[asyncio.AbstractServer] = None
+        # клиент -> (задача отправки, задача обработки запросов)
+        self._clients: Dict[_IpcClient, tuple] = {}
+        # закодированные последние состояния: (kind, "reply" | "event") -> строка;
+        # ответ на запрос — чтение из кэша
+        self._payloads: Dict[tuple, bytes] = {}
+        self.requests = 0
+        self.rejected = 0
+        self.published = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        log_handler.log.info(f"IPC server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        # закрываем соединения: обработчики получат EOF и завершатся сами
+        handlers = []
+        for client, (sender, handler) in list(self._clients.items()):
+            sender.cancel()
+            client.writer.close()
+            handlers.append(handler)
+        if handlers:
+            await asyncio.wait(handlers, timeout=2.0)
+        await self._server.wait_closed()
+        self._server = None
+        log_handler.log.info(
+            f"IPC server stopped: requests={self.requests} rejected={self.rejected} published={self.published}"
         )
-        notification.set_audio(audio.Reminder, False)
-        notification.show()
+
+    def publish(self, kind: str, payload: Dict):
+        """Replace the cached state of `kind` and push it to every subscriber (event loop thread only)."""
+        self._payloads[(kind, "reply")] = self._reply(dict(payload, ok=True))
+        data = self._payloads[(kind, "event")] = self._reply(dict(payload, event=kind))
+        self.published += 1
+        for client in self._clients:
+            if client.subscribed:
+                client.push(kind, data)
+
+    def _cached(self, kind: str, form: str) -> bytes:
+        """Encoded reply or event line for the last published `kind`, built from the app if there is none yet."""
+        data = self._payloads.get((kind, form))
+        if data is None:
+            payload = getattr(self.app, f"ipc_{kind}")()
+            self._payloads[(kind, "reply")] = self._reply(dict(payload, ok=True))
+            self._payloads[(kind, "event")] = self._reply(dict(payload, event=kind))
+            data = self._payloads[(kind, form)]
+        return data
+
+    @staticmethod
+    def _reply(payload: Dict) -> bytes:
+        return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if len(self._clients) >= self.max_clients:
+            writer.write(self._reply({"ok": False, "error": "too many clients"}))
+            writer.close()
+            return
+        client = _IpcClient(writer)
+        sender = asyncio.create_task(client.run_sender())
+        self._clients[client] = (sender, asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = self._parse(line)
+                if request is None:
+                    # не JSON-объект (например, HTTP-запрос из браузера) — дальше не читаем
+                    self.rejected += 1
+                    client.send_last(self._reply({"ok": False, "error": "bad request"}))
+                    break
+                if not client.send(self._dispatch(client, request)):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # клиент отключился или прислал слишком длинную строку
+        finally:
+            self._clients.pop(client, None)
+            sender.cancel()
+            writer.close()
+
+    @staticmethod
+    def _parse(line: bytes) -> Optional[Dict]:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return None
+        return request if isinstance(request, dict) else None
+
+    def _dispatch(self, client: _IpcClient, request: Dict) -> bytes:
+        self.requests += 1
+        cmd = request.get("cmd")
+        if cmd == "ping":
+            return self._reply({"ok": True})
+        if cmd in ("devices", "levels"):
+            return self._cached(cmd, "reply")
+        if cmd == "subscribe":
+            client.subscribed = True
+            for kind in ("devices", "levels"):
+                client.push(kind, self._cached(kind, "event"))
+            return self._reply({"ok": True, "subscribed": True})
+        if cmd == "refresh":
+            self.app.update_devices()
+            return self._reply({"ok": True})
+        if cmd in ("monitor", "unmonitor"):
+            device_id = request.get("id")
+            if not isinstance(device_id, str) or not device_id:
+                return self._reply({"ok": False, "error": "id required"})
+            if (cmd == "monitor" and not self.app.engine.has(device_id)
+                    and len(self.app.engine.devices()) >= self.max_monitored):
+                return self._reply({"ok": False, "error": f"too many monitored devices (max {self.max_monitored})"})
+            self.app.set_monitored(device_id, cmd == "monitor")
+            return self._reply({"ok": True})
+        return self._reply({"ok": False, "error": f"unknown cmd: {cmd}"})
+
 
 class TrayApplication:
-    def __init__(self):
-        self.state = DeviceState.NO_DEVICE
+    def __init__(self, backend: Optional[BatteryBackend] = None, headless: bool = False,
+                 discovery_cache: Optional[DiscoveryCache] = None,
+                 event_source: Optional[DeviceEventSource] = None,
+                 ipc_port: Optional[int] = None, ble_backend: Optional[BatteryBackend] = None):
+        # headless=True — без иконки в трее и тостов (тесты, профилирование, CI)
+        self.headless = headless
+        # локальный API для других программ (None — выключен)
+        self.ipc_port = ipc_port
+        self.ipc: Optional[IpcServer] = None
+        # общее состояние (устройства, выбор, статус) — неизменяемый снимок с одной точкой записи
+        self.store = StateStore()
         self.exit_flag = False
-        self.chosen_device = ""
-        self.chosen_device_id = ""
-        self.devices = []
         
         self.icon_manager = IconManager()
-        self.battery_monitor = BatteryMonitor()
-        self.device_manager = DeviceManager()
+        self.backend = backend or PowerShellBackend()
+        self.battery_monitor = BatteryMonitor(self.backend, ble_backend)
+        self.engine = MonitoringEngine(self.battery_monitor)
+        self.device_manager = DeviceManager(self.backend, ble_backend)
         self.notification_manager = NotificationManager(
             "TrayBTB",
-            os.path.join(os.path.dirname(__file__), "TrayBTB.png")
+            os.path.join(os.path.dirname(__file__), "TrayBTB.png"),
+            enabled=not headless
         )
+        # все уведомления идут через фоновый диспетчер — цикл опроса только ставит их в очередь
+        self.notifier = NotificationDispatcher(self.notification_manager)
         self.update_interval = 1.0
         self.error_threshold = 10
-        self.battery_status = BatStatus(level=None,last_update=0)
+        self.low_battery_threshold = 20
+        # повторное уведомление о разряде — только после подзарядки выше порога + гистерезис
+        self.low_battery_hysteresis = 5
+        # когда опрашивать батарею решает планировщик; update_interval — только такт UI
+        self.scheduler = PollScheduler(low_threshold=self.low_battery_threshold)
+        if ble_backend is not None and hasattr(ble_backend, "on_level"):
+            # уведомление BLE сразу попадает в трей из кэша, не сбрасывая расписание опроса
+            ble_backend.on_level = self._on_pushed_level
+            # соединение не должно отпускаться между двумя опросами
+            ble_backend.idle_disconnect_s = max(ble_backend.idle_disconnect_s, 3 * self.scheduler.max_interval)
+        self._wake: Optional[asyncio.Event] = None
+        # опрос батареи идёт отдельной задачей, не блокируя main_loop;
+        # первый запрос после (пере)запуска воркера ждёт start_timeout — опрос не должен сдаваться раньше
+        worker = getattr(self.backend, "worker", None)
+        self.poll_timeout = max(10.0, getattr(worker, "start_timeout", 0.0) + 5.0)
+        self.poll_timeout_per_id = getattr(worker, "per_id_timeout", 0.0)
+        self.poll_stats = PollStats()
+        self._poll_task: Optional[asyncio.Task] = None
+        # сам engine.poll в потоке: по таймауту задача завершается, а поток может ещё работать
+        self._poll_future: Optional[concurrent.futures.Future] = None
+        self._poll_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="TrayBTB-poll")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
 
         self.icon = None
+        # что сейчас показано в трее — одинаковые иконку/tooltip повторно не выставляем
+        self._shown_icon_key: Optional[tuple] = None
+        self._shown_tooltip: Optional[str] = None
 
         # lock для сериализации изменений меню/иконки между потоками (pystray GUI и background)
         self._menu_lock = threading.Lock()
-        # простая защита: принять изменения меню только если прошло >= minimal_menu_update_s сек
-        self._last_menu_update_ts = 0.0
-        self._minimal_menu_update_s = 0.1
+        # меню пересобирается отложенно и только если изменился список устройств/подключение
+        self.menu_updater = MenuUpdater(self._menu_fingerprint, self._build_menu, self.safe_set_menu)
+        self.store.subscribe(self._on_state_change)
 
-        self.setup_tray()
+        # кэш прошлых результатов поиска: меню и мониторинг доступны сразу при запуске
+        self.discovery_cache = discovery_cache
+        self._cached_ids: List[tuple] = []  # (id, id_type) устройств из кэша
+        self.restore_from_cache()
 
-    def safe_set_menu(self, menu: pystray.Menu):
-        """Set menu and call update_menu under a lock to avoid concurrent UI races."""
+        # наблюдатель за подключением/отключением устройств (вместо ручного полного поиска)
+        self._event_source = event_source
+        self.device_watcher: Optional[DeviceWatcher] = None
+
+        if not headless:
+            self.setup_tray()
+
+    # чтение общего состояния — без локов, из текущего снимка
+    @property
+    def state(self) -> DeviceState:
+        return self.store.current.state
+
+    @property
+    def devices(self) -> Tuple[Dict, ...]:
+        return self.store.current.devices
+
+    @property
+    def chosen_device(self) -> str:
+        return self.store.current.chosen_device
+
+    @property
+    def chosen_device_id(self) -> str:
+        return self.store.current.chosen_device_id
+
+    @property
+    def battery_status(self) -> BatStatus:
+        return self.store.current.battery_status
+
+    def _on_state_change(self, old: AppState, new: AppState):
+        """Drive menu/icon refreshes from published state changes."""
+        if old.devices != new.devices or bool(old.chosen_device) != bool(new.chosen_device):
+            self.refresh_menu()
+        if old.devices != new.devices:
+            self.publish_ipc("devices")
+        if new.state == DeviceState.NO_DEVICE and old.state != DeviceState.NO_DEVICE:
+            self.update_icon("black")
+
+    def safe_set_menu(self, menu: pystray.Menu) -> bool:
+        """Set the menu under a lock to avoid concurrent UI races."""
         try:
             with self._menu_lock:
-                now = time.time()
-                if now - self._last_menu_update_ts < self._minimal_menu_update_s:
-                    # пропускаем слишком частые обновления меню
-                    return
-                self._last_menu_update_ts = now
-                self.icon.menu = menu
-                # update_menu должен вызываться под lock
-                self.icon.update_menu()
+                if self.icon is None:
+                    return False  # иконки ещё нет — применим при следующем запросе
+                with metrics.timer("menu_update"):
+                    # сеттер pystray сам вызывает update_menu — второй вызов пересобрал бы нативное меню ещё раз
+                    self.icon.menu = menu
+            return True
         except Exception as e:
             try:
                 log_handler.log.debug(f"safe_set_menu failed: {e}")
             except Exception:
                 pass
+            return False
+
+    def refresh_menu(self):
+        """Request a menu rebuild for the current state; bursts are coalesced by MenuUpdater."""
+        if self.headless:
+            return  # в headless-режиме меню не показывается — и не собираем его
+        self.menu_updater.request()
+
+    def _menu_fingerprint(self) -> tuple:
+        """Everything the menu shows: device list, connection and notify-only devices."""
+        snapshot = self.store.current
+        devices = tuple((d.get("name"), d.get("id"), d.get("id_type")) for d in snapshot.devices)
+        notify = tuple(sorted(d.device_id for d in self.engine.devices() if d.policy == "notify"))
+        return bool(snapshot.chosen_device), devices, notify
+
+    def _build_menu(self) -> pystray.Menu:
+        return self.get_connected_menu() if self.chosen_device else self.get_updated_menu()
 
     def setup_tray(self):
-        # используем get_updated_menu(), оно возвращает pystray.Menu
-        menu = self.get_updated_menu()
-        self.icon = pystray.Icon(
+        menu = self._build_menu()
+        self.icon = _pystray().Icon(
             "TrayBTB",
-            self.icon_manager.create_image(),
+            self.icon_manager.get_image(),
             "TrayBTB --Updating devices--",
             menu
         )
+        self._shown_icon_key = ("blue", None)
+        self._shown_tooltip = "TrayBTB --Updating devices--"
+
+    def restore_from_cache(self):
+        """Fill the device list and resume monitoring from the discovery cache."""
+        if self.discovery_cache is None:
+            return
+        cached = self.discovery_cache.load()
+        if not cached:
+            return
+        self.store.update(devices=tuple(cached["devices"]))
+        self._cached_ids = [(d["id"], d.get("id_type", "pnp")) for d in self.devices]
+        for device in cached["notify"]:
+            self.engine.add(MonitoredDevice(
+                device.get("name", device["id"]), device["id"], device.get("id_type", "pnp"),
+                policy="notify", low_threshold=self.low_battery_threshold
+            ))
+        chosen = cached["chosen"]
+        if chosen:
+            self.select_device(chosen.get("name", chosen["id"]), chosen["id"], chosen.get("id_type", "pnp"), announce=False)
+        log_handler.log.info(
+            f"Restored {len(self.devices)} devices from cache, chosen: {chosen.get('name') if chosen else None}"
+        )
+
+    def save_cache(self):
+        if self.discovery_cache is None:
+            return
+        chosen = None
+        notify = []
+        for device in self.engine.devices():
+            entry = {"name": device.name, "id": device.device_id, "id_type": device.device_type}
+            if device.policy == "tray":
+                chosen = entry
+            else:
+                notify.append(entry)
+        self.discovery_cache.save(list(self.devices), chosen, notify)
+
+    def _bg_revalidate_cache(self):
+        """
+        Re-read only the cached devices (one batched query, no WMI scan) and
+        drop those that no longer report a battery level.
+        """
+        ids = self._cached_ids
+        if not ids:
+            return
+        # PnP — одним пакетом через PowerShell-бэкенд, BLE — через BLE-бэкенд
+        levels = self.battery_monitor.get_battery_levels(ids)
+        if not any(level is not None for level in levels.values()):
+            # ни одного ответа — скорее сбой чтения, чем пропажа всех устройств
+            log_handler.log.warning(f"Cache revalidation failed: no levels for {len(ids)} devices")
+            return
+        updating = getattr(self, "_updating_thread", None)
+        if updating is not None and updating.is_alive():
+            return  # идёт полный поиск — его результат всё равно новее
+
+        def revalidated(snapshot: AppState) -> AppState:
+            devices = []
+            for device in snapshot.devices:
+                level = levels.get(device.get("id"))
+                if level is not None:
+                    devices.append(dict(device, battery=level))
+                elif device.get("id") == snapshot.chosen_device_id:
+                    devices.append(device)  # выбранное устройство оставляем, даже если сейчас не ответило
+            return replace(snapshot, devices=tuple(devices))
+
+        old, new = self.store.modify(revalidated)
+        dropped = len(old.devices) - len(new.devices)
+        log_handler.log.info(f"Cache revalidated: {len(new.devices)} devices, {dropped} dropped")
+        self.save_cache()
+
+    def start_device_watcher(self):
+        source = self._event_source or self.backend.event_source()
+        if source is None:
+            return
+        self.device_watcher = DeviceWatcher(source, self.backend, self.apply_device_changes)
+        self.device_watcher.start()
+
+    def apply_device_changes(self, added: List[Dict], removed: List[str]):
+        """Merge an incremental device update from the watcher into the device list."""
+        def merged(snapshot: AppState) -> AppState:
+            by_id = {d.get("id"): d for d in snapshot.devices}
+            for device_id in removed:
+                # выбранное устройство из меню не убираем — оно может вернуться
+                if device_id != snapshot.chosen_device_id:
+                    by_id.pop(device_id, None)
+            for device in added:
+                by_id[device["id"]] = device
+            return replace(snapshot, devices=tuple(by_id.values()))
+
+        old, new = self.store.modify(merged)
+        if new is old:
+            return
+        log_handler.log.info(f"Device list updated from events: {len(new.devices)} devices")
+        self.save_cache()
 
     def run(self):
-        tray_thread = threading.Thread(target=self.icon.run, daemon=True)
-        tray_thread.start()
+        if self._cached_ids:
+            threading.Thread(target=self._bg_revalidate_cache, daemon=True).start()
+        self.start_device_watcher()
+        if self.icon is not None:
+            tray_thread = threading.Thread(target=self.icon.run, kwargs={"setup": self._on_tray_ready}, daemon=True)
+            tray_thread.start()
 
         log_handler.log.info("App started")
-        self.notification_manager.show_notification(
-            "App started. \nPlease, update your device list and choose device!"
+        # стартовый тост (winotify запускает PowerShell) уходит в фоновый диспетчер
+        self.notifier.notify(
+            "App started. \nPlease, update your device list and choose device!", key="startup"
         )
         
         asyncio.run(self.main_loop())
 
+    @staticmethod
+    def _on_tray_ready(icon: pystray.Icon):
+        icon.visible = True
+        startup_profiler.mark("tray icon visible")
+        startup_profiler.report()
+
     async def main_loop(self):
+        startup_profiler.mark("main loop started")
+        if self.icon is None:
+            startup_profiler.report()
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        if self.ipc_port is not None:
+            self.ipc = IpcServer(self, port=self.ipc_port)
+            await self.ipc.start()
         try:
             while not self.exit_flag:
                 await self.handle_state()
-                await asyncio.sleep(self.update_interval)
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.update_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
                 
         except Exception as e:
             log_handler.log.error(f"Main loop error: {e}")
-            self.notification_manager.show_notification(
-                "Error in main loop. Application will be closed."
+            self.notifier.notify(
+                "Error in main loop. Application will be closed.", key="fatal"
             )
             self.exit_app()
+        finally:
+            if self._poll_task is not None and not self._poll_task.done():
+                self._poll_task.cancel()
+            if self.ipc is not None:
+                await self.ipc.stop()
 
     async def handle_state(self):
         """Handle different application states and update UI accordingly."""
@@ -359,16 +3442,27 @@ class TrayApplication:
                     await self.handle_device_chosen_state()
                 case _:
                     log_handler.log.warning(f"Unknown state: {self.state}")
+            self.start_poll_if_due()
                     
         except Exception as e:
             log_handler.log.error(f"State handling error: {e}")
-            self.battery_status.error_count += 1
-            
-            if self.battery_status.error_count >= self.error_threshold:
-                self.notification_manager.show_notification(
-                    "Multiple errors occurred. Please check device connection."
-                )
-                await self.auto_disconnect()
+            await self.register_error()
+
+    async def register_error(self):
+        """Count an error and auto-disconnect once error_threshold is reached."""
+        snapshot = self._count_error()
+
+        if snapshot.battery_status.error_count >= self.error_threshold:
+            self.notifier.notify(
+                "Multiple errors occurred. Please check device connection.", key="errors", cooldown=300
+            )
+            await self.auto_disconnect()
+
+    def _count_error(self) -> AppState:
+        """Publish the chosen device's status with error_count + 1 (event loop thread only)."""
+        return self.store.modify(lambda snapshot: replace(snapshot, battery_status=replace(
+            snapshot.battery_status, error_count=snapshot.battery_status.error_count + 1
+        )))[1]
 
     async def handle_updating_state(self):
         """Handle the updating state UI."""
@@ -381,44 +3475,232 @@ class TrayApplication:
         self.update_icon("black")
 
     async def handle_device_chosen_state(self):
-        """Handle the device chosen state, including battery monitoring."""
-        bat_level = self.battery_monitor.get_battery_level()
-        
-        if bat_level is not None:
-            self.battery_status.level = bat_level
-            self.battery_status.error_count = 0
-            self.update_tooltip(f"TrayBTB --{bat_level}%--")
-            self.update_icon(self.icon_manager.get_hex_color(bat_level))
-            
-            # Alert on low battery
-            if bat_level <= 20:
-                self.notification_manager.show_notification(
-                    f"Низкий заряд батареи: {bat_level}%"
+        """Handle the device chosen state UI from the last published battery level."""
+        level = self.battery_status.level
+        if level is None:
+            return
+        device = self.engine.tray_device()
+        self.show_level(level, device.history.time_to_empty() if device is not None else None)
+
+    def show_level(self, bat_level: int, remaining: Optional[float] = None):
+        tooltip = f"TrayBTB --{bat_level}%--"
+        if remaining is not None:
+            tooltip += f" ~{format_remaining(remaining)} left"
+        self.update_tooltip(tooltip)
+        self.update_icon(self.icon_manager.get_hex_color(bat_level))
+
+    def start_poll_if_due(self):
+        """Start a monitoring cycle for all tracked devices unless one is in flight."""
+        if not self.engine.devices():
+            return
+        if self._poll_task is not None and not self._poll_task.done():
+            # предыдущий опрос ещё не вернулся — не накладываем опросы друг на друга
+            self.poll_stats.skipped_in_flight += 1
+            return
+        if self._poll_future is not None and not self._poll_future.done():
+            # опрос, не уложившийся в таймаут, ещё занимает поток — новый встал бы за ним в очередь
+            self.poll_stats.skipped_in_flight += 1
+            return
+        if not self.scheduler.is_due():
+            return
+        self._poll_task = asyncio.create_task(self.poll_battery())
+
+    async def poll_battery(self):
+        """Run one batched monitoring cycle off the event loop and apply its results."""
+        started = time.perf_counter()
+        results = []
+        timeout = self.poll_timeout + self.poll_timeout_per_id * max(0, len(self.engine.devices()) - 1)
+        try:
+            self._poll_future = self._poll_executor.submit(self.engine.poll)
+            results = await asyncio.wait_for(asyncio.wrap_future(self._poll_future), timeout)
+        except asyncio.TimeoutError:
+            self.poll_stats.timeouts += 1
+            log_handler.log.warning(f"Battery poll timed out after {timeout}s")
+        except asyncio.CancelledError:
+            self.poll_stats.cancelled += 1
+            raise
+        except Exception as e:
+            log_handler.log.error(f"Battery poll error: {e}")
+        finally:
+            self.poll_stats.record(time.perf_counter() - started)
+
+        if self.exit_flag:
+            return
+        try:
+            await self.apply_poll_results(results)
+        except Exception as e:
+            log_handler.log.error(f"State handling error: {e}")
+            await self.register_error()
+
+    async def apply_poll_results(self, results: List[tuple]):
+        """Update tray UI, alerts and the scheduler from a finished monitoring cycle."""
+        levels = []
+        tray_level = None
+        for device, bat_level in results:
+            if bat_level is None:
+                if device.policy == "tray":
+                    log_handler.log.warning("Failed to get battery level")
+                    self._count_error()
+                else:
+                    log_handler.log.warning(f"Failed to get battery level of {device.name}")
+                continue
+            levels.append(bat_level)
+            if device.policy == "tray":
+                tray_level = bat_level
+                self.store.update(battery_status=device.status)
+                self.show_level(bat_level, device.history.time_to_empty())
+            self.check_low_battery(device, bat_level)
+
+        self.publish_ipc("levels")
+
+        if levels:
+            # планировщик ориентируется на трей-устройство, иначе на самое разряженное
+            self.scheduler.record_success(tray_level if tray_level is not None else min(levels))
+        else:
+            self.poll_stats.failures += 1
+            delay = self.scheduler.record_failure()
+            log_handler.log.warning(f"Battery poll failed, retry in {delay:.0f}s")
+
+    def check_low_battery(self, device: MonitoredDevice, bat_level: int):
+        """Alert on low battery: once per threshold crossing, re-armed after charging past the hysteresis."""
+        if bat_level <= device.low_threshold:
+            if not device.low_alerted:
+                device.low_alerted = True
+                suffix = "" if device.policy == "tray" else f" ({device.name})"
+                self.notifier.notify(
+                    f"Низкий заряд батареи{suffix}: {bat_level}%", key=f"low:{device.device_id}"
                 )
+        elif bat_level >= device.low_threshold + self.low_battery_hysteresis:
+            device.low_alerted = False
+
+    def _on_pushed_level(self, device_id: str, level: int):
+        """Level pushed by a device (BLE thread): applied on the event loop, the poll schedule is kept."""
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self.apply_pushed_level, device_id, level)
+        except RuntimeError:
+            pass  # цикл уже закрыт
+
+    def apply_pushed_level(self, device_id: str, level: int):
+        """Update status, tray, alerts and IPC from a pushed level (event loop thread only)."""
+        device = self.engine.push(device_id, level)
+        if device is None:
+            return
+        if device.policy == "tray":
+            self.store.update(battery_status=device.status)
+        self.check_low_battery(device, level)
+        self.publish_ipc("levels")
+        if self._wake is not None:
+            self._wake.set()  # следующий такт перерисует трей из опубликованного статуса
+
+    def poll_now(self):
+        """Make the next main_loop tick poll immediately; safe to call from any thread."""
+        self.scheduler.reset()
+        wake, loop = self._wake, self._loop
+        if wake is None or loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(wake.set)
+        except RuntimeError:
+            pass  # цикл уже закрыт
+
+    def publish_ipc(self, kind: str):
+        """Send the current devices/levels to IPC clients; safe to call from any thread."""
+        ipc, loop = self.ipc, self._loop
+        if ipc is None or loop is None:
+            return
+        payload = getattr(self, f"ipc_{kind}")()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            # из цикла — сразу, чтобы следующий запрос клиента уже видел новое состояние
+            ipc.publish(kind, payload)
+            return
+        try:
+            loop.call_soon_threadsafe(ipc.publish, kind, payload)
+        except RuntimeError:
+            pass  # цикл уже закрыт
+
+    def ipc_devices(self) -> Dict:
+        return {"devices": list(self.devices)}
+
+    def ipc_levels(self) -> Dict:
+        """Last known reading of every monitored device (no device is queried here)."""
+        levels = {}
+        for device in self.engine.devices():
+            levels[device.device_id] = {
+                "name": device.name,
+                "policy": device.policy,
+                "level": device.status.level,
+                "last_update": device.status.last_update or None,
+                "time_to_empty": device.history.time_to_empty(),
+            }
+        return {"levels": levels}
+
+    def set_monitored(self, device_id: str, enabled: bool):
+        """Start/stop notify-only monitoring of device_id (used by the IPC API)."""
+        current = self.engine.get(device_id)
+        if enabled and current is None:
+            known = next((d for d in self.devices if d.get("id") == device_id), {})
+            self.engine.add(MonitoredDevice(
+                known.get("name", device_id), device_id, known.get("id_type", "pnp"),
+                policy="notify", low_threshold=self.low_battery_threshold
+            ))
+            self.poll_now()
+        elif not enabled and current is not None and current.policy == "notify":
+            self.engine.remove(device_id)
         else:
-            self.battery_status.error_count += 1
-            log_handler.log.warning("Failed to get battery level")
+            return
+        # набор отслеживаемых изменился — клиенты не должны видеть старые levels
+        self.publish_ipc("levels")
+        self.save_cache()
+        self.refresh_menu()
+
+    def cancel_poll(self):
+        """Cancel an in-flight battery poll; safe to call from any thread."""
+        task, loop = self._poll_task, self._loop
+        if task is None or loop is None or task.done():
+            return
+        try:
+            loop.call_soon_threadsafe(task.cancel)
+        except RuntimeError:
+            pass  # цикл уже закрыт
 
     async def auto_disconnect(self):
         """Automatically disconnect device after too many errors."""
-        self.log_handler.log.info("Auto-disconnecting due to errors")
+        log_handler.log.info("Auto-disconnecting due to errors")
+        # disconnect_device публикует новый статус с нулевым счётчиком ошибок
         self.disconnect_device(None)
-        self.battery_status.error_count = 0
 
-    def update_icon(self, new_color: str):
+    def update_icon(self, new_color: str, text: Optional[str] = None):
+        key = (new_color.lower(), text)
+        if key == self._shown_icon_key:
+            # та же иконка уже показана — не дёргаем нативную пересборку
+            return
         try:
+            image = self.icon_manager.get_image(new_color, text)
             # изменение иконки — НЕ вызывать update_menu (это вызывает пересборку нативного меню)
             with self._menu_lock:
-                self.icon.icon = self.icon_manager.create_image(new_color)
+                if self.icon is not None:
+                    self.icon.icon = image
+                self._shown_icon_key = key
                 # НЕ: self.icon.update_menu()
         except Exception:
             pass
 
     def update_tooltip(self, new_tooltip: str):
+        if new_tooltip == self._shown_tooltip:
+            return
         try:
             # изменение tooltip — не трогаем меню
             with self._menu_lock:
-                self.icon.title = new_tooltip
+                if self.icon is not None:
+                    self.icon.title = new_tooltip
+                self._shown_tooltip = new_tooltip
                 # НЕ: self.icon.update_menu()
         except Exception:
             pass
@@ -430,34 +3712,48 @@ class TrayApplication:
          self._updating_thread = threading.Thread(target=self._bg_update_devices, daemon=True)
          self._updating_thread.start()
 
+    @staticmethod
+    def _idle_state(snapshot: AppState) -> AppState:
+        """Leave UPDATING: back to DEVICE_CHOSEN or NO_DEVICE depending on the chosen device."""
+        return replace(snapshot, state=DeviceState.DEVICE_CHOSEN if snapshot.chosen_device else DeviceState.NO_DEVICE)
+
     def _bg_update_devices(self):
         try:
             log_handler.log.info("Background: updating devices")
-            self.state = DeviceState.UPDATING
-            devices = self.device_manager.get_devices()
-            self.devices = devices
+            self.store.update(state=DeviceState.UPDATING)
+            # устройства попадают в меню по мере нахождения; старые записи видны до конца поиска
+            found: Dict[str, Dict] = {}
+            try:
+                for device in self.device_manager.iter_devices():
+                    found[device["id"]] = device
+                    self.store.modify(lambda snapshot: replace(snapshot, devices=tuple(found.values()) + tuple(
+                        d for d in snapshot.devices if d.get("id") not in found
+                    )))
+            except DiscoveryError as e:
+                # неполный скан: найденное обновлено, но ничего не удаляем и кэш не перезаписываем
+                self.store.modify(self._idle_state)
+                log_handler.log.warning(f"Background: device scan failed, keeping the previous list: {e}")
+                return
+            # меню и чёрную иконку обновляют подписчики хранилища
+            _, snapshot = self.store.modify(
+                lambda snapshot: self._idle_state(replace(snapshot, devices=tuple(found.values())))
+            )
+            self.save_cache()
             log_handler.log.info("Background: ended seeking for devices")
-            self.notification_manager.show_notification("Choose device!")
-            self.state = DeviceState.DEVICE_CHOSEN if self.chosen_device else DeviceState.NO_DEVICE
-            # обновляем иконку и меню через безопасный wrapper
-            if self.state == DeviceState.NO_DEVICE:
-                with self._menu_lock:
-                    self.icon.icon = self.icon_manager.create_image("black")
-                    #self.icon.update_menu()
-            else:
-                level = self.battery_monitor.get_battery_level() or 0
-                with self._menu_lock:
-                    self.icon.icon = self.icon_manager.create_image(self.icon_manager.get_hex_color(level))
-                    #self.icon.update_menu()
-            # обновляем меню (через safe_set_menu чтобы избежать гонок)
-            self.safe_set_menu(self.get_updated_menu())
+            self.notifier.notify("Choose device!", key="discovery", cooldown=10)
+            if snapshot.state == DeviceState.DEVICE_CHOSEN:
+                level = snapshot.battery_status.level
+                if level is None:
+                    level = self.battery_monitor.get_battery_level() or 0
+                self.update_icon(self.icon_manager.get_hex_color(level))
         except Exception as e:
             try:
                 log_handler.log.error(f"Background update failed: {e}")
             except Exception:
                 pass
-            # восстановим меню
-            self.safe_set_menu(self.get_updated_menu())
+            # не оставляем приложение в UPDATING; восстановим меню
+            self.store.modify(self._idle_state)
+            self.refresh_menu()
 
     def make_menu_devices(self) -> pystray.Menu:
         """
@@ -477,7 +3773,7 @@ class TrayApplication:
         else:
             menu_items = [item("No devices", lambda icon, item: None)]
             
-        return pystray.Menu(*menu_items)
+        return _pystray().Menu(*menu_items)
 
     def choose_device(self, name: str, device_id: str, device_type: str):
         """
@@ -491,71 +3787,111 @@ class TrayApplication:
             Callable: Handler function for menu item
         """
         def handler(icon: pystray.Icon, item: item):
-            self.chosen_device = name
-            self.chosen_device_id = device_id
-            self.battery_monitor.device_id = device_id
-            self.battery_monitor.device_type = device_type
-            self.state = DeviceState.DEVICE_CHOSEN
-            
-            log_handler.log.info(f"State: Device chosen. It's {self.chosen_device}")
-            self.notification_manager.show_notification(
-                f"Connected to {self.chosen_device}!"
-            )
-            
-            # Update menu to include disconnect option (через сериализованный safe_set_menu)
-            try:
-                self.safe_set_menu(self.get_connected_menu())
-            except Exception:
-                # backup: попробовать обновить прямо, если safe_set_menu упал
-                try:
-                    with self._menu_lock:
-                        self.icon.menu = self.get_connected_menu()
-                        self.icon.update_menu()
-                except Exception:
-                    pass
+            self.select_device(name, device_id, device_type)
+            self.save_cache()
             
         return handler
 
-    def get_connected_menu(self) -> pystray.Menu:
-        """
-        Creates menu for when device is connected.
+    def select_device(self, name: str, device_id: str, device_type: str, announce: bool = True):
+        """Make device_id the tray device and start monitoring it right away."""
+        if self.chosen_device_id and self.chosen_device_id != device_id:
+            self.engine.remove(self.chosen_device_id)
+        monitored = self.engine.add(MonitoredDevice(
+            name, device_id, device_type, policy="tray", low_threshold=self.low_battery_threshold
+        ))
+        self.battery_monitor.device_id = device_id
+        self.battery_monitor.device_type = device_type
+        # меню с «Отключиться» пересоберёт подписчик хранилища
+        self.store.update(
+            battery_status=monitored.status, chosen_device=name, chosen_device_id=device_id,
+            state=DeviceState.DEVICE_CHOSEN
+        )
+        self.cancel_poll()
+        self.poll_now()
+        self.publish_ipc("levels")
         
-        Returns:
-            pystray.Menu: Updated menu with disconnect option
+        log_handler.log.info(f"State: Device chosen. It's {self.chosen_device}")
+        if announce:
+            self.notifier.notify(
+                f"Connected to {self.chosen_device}!", key="connection"
+            )
+
+    def make_menu_notify_devices(self) -> pystray.Menu:
         """
-        return pystray.Menu(
-            item('Update Devices', self.update_devices),
-            item('Devices', self.make_menu_devices()),
-            item('Disconnect Device', self.disconnect_device),
-            item('Exit', self.exit_app)
-        )
+        Creates a menu of devices that can be monitored for low battery
+        notifications alongside the device shown in the tray.
+        """
+        if self.devices and len(self.devices) > 0:
+            menu_items = [
+                item(
+                    device.get("name"),
+                    self.toggle_notify_device(device.get("name"), device.get("id"), device.get("id_type")),
+                    checked=lambda it, device_id=device.get("id"): self.engine.has(device_id)
+                )
+                for device in self.devices
+            ]
+        else:
+            menu_items = [item("No devices", lambda icon, item: None)]
+
+        return _pystray().Menu(*menu_items)
+
+    def toggle_notify_device(self, name: str, device_id: str, device_type: str):
+        """Creates a handler that adds/removes a notify-only monitored device."""
+        def handler(icon: pystray.Icon, item: item):
+            current = self.engine.get(device_id)
+            if current is not None and current.policy == "tray":
+                return  # устройство в трее и так уведомляет о разряде
+            if current is not None:
+                self.engine.remove(device_id)
+                log_handler.log.info(f"Stopped notify-only monitoring of {name}")
+            else:
+                self.engine.add(MonitoredDevice(
+                    name, device_id, device_type, policy="notify", low_threshold=self.low_battery_threshold
+                ))
+                log_handler.log.info(f"Started notify-only monitoring of {name}")
+                self.poll_now()
+            self.publish_ipc("levels")
+            self.save_cache()
+            self.refresh_menu()
+
+        return handler
 
     def disconnect_device(self, icon=None, item=None):
         """Handles disconnecting from current device"""
         log_handler.log.info(f"disconnect from {self.chosen_device}")
-        self.notification_manager.show_notification(
-            f"Disconnected from {self.chosen_device}. \nPlease choose device!"
+        self.notifier.notify(
+            f"Disconnected from {self.chosen_device}. \nPlease choose device!", key="connection"
         )
-        self.chosen_device = ""
-        self.chosen_device_id = ""
+        self.engine.remove(self.chosen_device_id)
         self.battery_monitor.device_id = ""
         self.battery_monitor.device_type = ""
-        self.state = DeviceState.NO_DEVICE
-        self.icon_manager.create_image("Black")
-        # Reset menu to original state
-        try:
-            self.safe_set_menu(self.get_updated_menu())
-        except Exception:
-            # backup: попробовать обновить прямо, если safe_set_menu упал
-            try:
-                with self._menu_lock:
-                    self.icon.menu = self.get_updated_menu()
-                    self.icon.update_menu()
-            except Exception:
-                pass
+        # чёрную иконку и исходное меню выставит подписчик хранилища
+        self.store.update(
+            battery_status=BatStatus(level=None, last_update=0), chosen_device="", chosen_device_id="",
+            state=DeviceState.NO_DEVICE
+        )
+        self.cancel_poll()
+        self.publish_ipc("levels")
+        self.save_cache()
     
     def exit_app(self, icon=None, item=None):
         self.exit_flag = True
+        self.cancel_poll()
+        self._poll_executor.shutdown(wait=False)
+        if self.device_watcher is not None:
+            self.device_watcher.stop()
+        try:
+            self.battery_monitor.close()
+        except Exception:
+            pass
+        log_handler.log.info(f"Poll stats: {self.poll_stats.summary()}")
+        log_handler.log.info(f"Poll rate: {self.scheduler.report(self.update_interval)}")
+        self.notifier.stop(timeout=2.0)
+        log_handler.log.info(f"Notifications: {self.notifier.summary()}")
+        self.menu_updater.stop()
+        log_handler.log.info(f"Menu updates: {self.menu_updater.summary()}")
+        if metrics.enabled:
+            log_handler.log.info(f"Metrics: {metrics.summary()}")
         try:
             if self.icon:
                 self.icon.stop()
@@ -566,23 +3902,102 @@ class TrayApplication:
         sys.exit(0)
  
     def get_updated_menu(self) -> pystray.Menu:
-        return pystray.Menu(
+        return _pystray().Menu(
             item('Обновить список девайсов', self.update_devices),
             item('Девайсы', self.make_menu_devices()),
+            item('Уведомления о разряде', self.make_menu_notify_devices()),
             item('Выход', self.exit_app)
         )
     
     def get_connected_menu(self) -> pystray.Menu:
-        return pystray.Menu(
+        return _pystray().Menu(
             item('Обновить список девайсов', self.update_devices),
             item('Девайсы', self.make_menu_devices()),
+            item('Уведомления о разряде', self.make_menu_notify_devices()),
             item('Отключиться от устройства', self.disconnect_device),
             item('Выход', self.exit_app)
         )
 
 log_handler = Logs()
+startup_profiler = StartupProfiler()
+metrics = Metrics()
 def main():
-    app = TrayApplication()
+    parser = argparse.ArgumentParser(description="TrayBTB — Bluetooth battery level in the system tray")
+    parser.add_argument("--headless", action="store_true", help="run without tray icon and notifications")
+    parser.add_argument("--fake-backend", action="store_true", help="use the in-process fake backend instead of PowerShell/WMI")
+    parser.add_argument("--profile-startup", action="store_true", help="print per-phase import/init timings")
+    parser.add_argument("--no-cache", action="store_true", help="do not read/write the discovery cache")
+    parser.add_argument("--ble", action="store_true",
+                        help="also find/read BLE devices via the GATT Battery Service (needs bleak)")
+    parser.add_argument("--ipc-port", type=int, metavar="PORT",
+                        help="serve devices/levels/subscriptions as JSON lines on 127.0.0.1:PORT")
+    parser.add_argument("--daemon", action="store_true",
+                        help="headless with the IPC API on (default port 47655)")
+    parser.add_argument("--record", metavar="PATH",
+                        help="write every WMI query and PowerShell exchange with its latency to a JSON-lines trace")
+    parser.add_argument("--replay", metavar="PATH",
+                        help="answer WMI/PowerShell from a trace recorded with --record instead of the system")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="replay time scale: 2 — twice as fast, 0 — without delays")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="collect hot-path metrics and write them to PATH (*.prom — Prometheus text, else JSON)")
+    parser.add_argument("--metrics-interval", type=float, default=15.0, help="seconds between metrics file writes")
+    args = parser.parse_args()
+    if args.daemon:
+        args.headless = True
+        if args.ipc_port is None:
+            args.ipc_port = 47655
+
+    startup_profiler.enabled = args.profile_startup
+    startup_profiler.mark("main() entered")
+    with startup_profiler.phase("logs setup"):
+        log_handler.setup()
+    if args.metrics:
+        metrics.enabled = True
+        exporter = MetricsExporter(metrics, args.metrics, args.metrics_interval)
+        exporter.start()
+        # финальный снимок при выходе
+        atexit.register(exporter.stop)
+    if args.profile_startup and not args.headless:
+        # импортируем заранее только чтобы отдельно измерить стоимость импорта
+        with startup_profiler.phase("import pystray"):
+            _pystray()
+        with startup_profiler.phase("import PIL"):
+            for module in ("PIL.Image", "PIL.ImageDraw"):
+                importlib.import_module(module)
+
+    if args.record and (args.replay or args.fake_backend):
+        parser.error("--record records the real WMI/PowerShell backend; it cannot be combined with --replay or --fake-backend")
+    if args.replay:
+        backend = TraceReplayer(args.replay, speed=args.replay_speed).backend()
+    elif args.fake_backend:
+        backend = FakeBackend(drain_per_read=0.05)
+    elif args.record:
+        recorder = TraceRecorder(args.record)
+        atexit.register(recorder.close)
+        backend = recorder.backend()
+    else:
+        backend = None
+    ble_backend = None
+    if args.ble and args.fake_backend:
+        fake_ble = {
+            "FA:KE:00:00:00:01": FakeBleDevice("FA:KE:00:00:00:01", "Fake BLE Headset", level=70,
+                                               script=[(60.0 * i, "level", 70 - i) for i in range(1, 60)]),
+        }
+        ble_backend = BleBatteryBackend(
+            client_factory=lambda address, callback: fake_ble[address].client(callback),
+            scanner=lambda _timeout: asyncio.sleep(0, result=[(d.address, d.name) for d in fake_ble.values()]),
+        )
+    elif args.ble:
+        ble_backend = BleBatteryBackend()
+    synthetic = args.fake_backend or args.replay
+    # у fake/replay-бэкенда свои устройства — кэш реальных устройств им не подходит
+    discovery_cache = None if args.no_cache or synthetic else DiscoveryCache()
+    with startup_profiler.phase("TrayApplication.__init__"):
+        app = TrayApplication(backend=backend, headless=args.headless, discovery_cache=discovery_cache,
+                              ipc_port=args.ipc_port, ble_backend=ble_backend)
+    if synthetic or (args.daemon and not app.devices):
+        app.update_devices()
     app.run()
 
 if __name__ == "__main__":
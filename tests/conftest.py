@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+# pystray без системного трея (CI, Linux без X): меню собираются, но не показываются
+os.environ.setdefault("PYSTRAY_BACKEND", "dummy")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "BTBat"))
+
+import pystray  # noqa: E402  — импорт после выбора бэкенда
+
+
+class RecordingIcon(pystray.Icon):
+    """pystray icon without a native tray: counts native menu rebuilds."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.native_updates = 0
+
+    def _update_menu(self):
+        self.native_updates += 1
+
+    def _update_icon(self):
+        pass
+
+    def _update_title(self):
+        pass
+
+
+@pytest.fixture
+def tray_icon():
+    """Give a TrayApplication a RecordingIcon with its real menu and silence its toasts."""
+    def attach(app) -> RecordingIcon:
+        app.notification_manager.enabled = False
+        app.icon = RecordingIcon("TrayBTB", app.icon_manager.get_image(), "TrayBTB", app._build_menu())
+        return app.icon
+    return attach
@@ -0,0 +1,143 @@
+import asyncio
+import gc
+import os
+import threading
+import tracemalloc
+
+import pytest
+
+import TrayBTB
+
+# Масштаб прогона. По умолчанию (для CI) такт main_loop — минута симулированного
+# времени: 4 суток = 5 760 тактов, ~5 с. Опросы идут по расписанию PollScheduler,
+# поэтому их число от длины такта почти не зависит — меняется только число пустых
+# тактов. Полный прогон с тактом в 1 с, как у приложения, на ~1 млн тактов:
+#   TRAYBTB_SOAK_TICK_S=1 TRAYBTB_SOAK_DAYS=12 python -m pytest tests/test_soak.py
+DAYS = int(os.environ.get("TRAYBTB_SOAK_DAYS", "4"))  # первые сутки — прогрев, дальше рост ограничен бюджетом
+TICK_S = float(os.environ.get("TRAYBTB_SOAK_TICK_S", "60"))
+TICKS_PER_DAY = int(86400 / TICK_S)
+TICKS_PER_HOUR = max(1, int(3600 / TICK_S))
+TRACED_BUDGET_KB = 256  # прирост tracemalloc за сутки после прогрева
+RSS_BUDGET_KB = 2048  # RSS шумнее — аллокатор не сразу отдаёт память
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def process_resources():
+    """RSS in bytes and open fd count of this process (None where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        return rss, len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None, None
+
+
+def menu_entry(menu, text):
+    return next(entry for entry in menu.items if entry.text == text)
+
+
+def test_soak_main_loop_does_not_leak_over_simulated_days(tray_icon):
+    clock = SimClock()
+    half_day = TICKS_PER_DAY // 2
+    backend = TrayBTB.FakeBackend(drain_per_read=1.0, sleep=lambda _s: None)
+    app = TrayBTB.TrayApplication(backend=backend, headless=False)
+    tray_icon(app)
+    # расписание опросов идёт по симулированным часам; такт main_loop — только по пробуждению
+    app.scheduler = TrayBTB.PollScheduler(low_threshold=app.low_battery_threshold, clock=clock)
+    app.update_interval = 3600.0
+    ticked = asyncio.Event()
+    handle_state = app.handle_state
+
+    async def counted_tick():
+        await handle_state()
+        ticked.set()
+
+    app.handle_state = counted_tick
+    samples = []
+
+    def sample(day):
+        gc.collect()
+        traced, _ = tracemalloc.get_traced_memory()
+        rss, fds = process_resources()
+        samples.append({"day": day, "traced": traced, "rss": rss,
+                        "threads": threading.active_count(), "fds": fds})
+
+    async def discovery():
+        # «Обновить список девайсов» из меню — поиск в фоновом потоке, как у пользователя
+        menu_entry(app._build_menu(), "Обновить список девайсов")(app.icon)
+        thread = app._updating_thread
+        while thread.is_alive():
+            await asyncio.sleep(0.001)
+
+    async def tick():
+        clock.now += TICK_S
+        ticked.clear()
+        app._wake.set()
+        await ticked.wait()
+        if app._poll_task is not None:
+            await app._poll_task
+
+    async def drive():
+        while app._wake is None:
+            await asyncio.sleep(0)
+        await discovery()
+        switch = 0
+        sample(0)
+        for day in range(1, DAYS + 1):
+            for i in range(TICKS_PER_DAY):
+                if i % half_day == 0:
+                    for device in app.devices:
+                        backend.set_level(device["id"], 100)  # два цикла заряда в сутки
+                if i % TICKS_PER_HOUR == 0:
+                    await discovery()
+                if i % (TICKS_PER_DAY // 4) == 0 and app.devices:
+                    # смена устройства и уведомлений — через пункты меню, как их строит приложение
+                    menu = app._build_menu()
+                    if switch % 3 == 2 and app.chosen_device:
+                        menu_entry(menu, "Отключиться от устройства")(app.icon)
+                    device = app.devices[switch % len(app.devices)]
+                    menu_entry(menu_entry(menu, "Девайсы").submenu, device["name"])(app.icon)
+                    other = app.devices[(switch + 1) % len(app.devices)]
+                    menu_entry(menu_entry(menu, "Уведомления о разряде").submenu, other["name"])(app.icon)
+                    switch += 1
+                await tick()
+            assert app.menu_updater.flush(2.0)
+            sample(day)
+        app.exit_flag = True
+        app._wake.set()
+
+    async def run():
+        tracemalloc.start()
+        try:
+            await asyncio.gather(app.main_loop(), drive())
+        finally:
+            tracemalloc.stop()
+
+    try:
+        asyncio.run(run())
+    finally:
+        with pytest.raises(SystemExit):
+            app.exit_app()
+
+    # опросы действительно шли через цикл, меню в трее пересобиралось и соответствует состоянию
+    assert app.scheduler.polls > DAYS * 24
+    assert app.menu_updater.rebuilds > 1
+    assert app.icon.native_updates == app.menu_updater.rebuilds
+    notify_menu = menu_entry(app.icon.menu, "Уведомления о разряде").submenu
+    assert [entry.checked for entry in notify_menu.items] == [app.engine.has(d["id"]) for d in app.devices]
+    failures = []
+    for previous, current in zip(samples[1:], samples[2:]):
+        for key, budget_kb in (("traced", TRACED_BUDGET_KB), ("rss", RSS_BUDGET_KB)):
+            if previous[key] is not None and current[key] - previous[key] > budget_kb * 1024:
+                failures.append(f"day {current['day']}: {key} +{(current[key] - previous[key]) / 1024:.0f}KB")
+        for key in ("threads", "fds"):
+            if previous[key] is not None and current[key] > previous[key]:
+                failures.append(f"day {current['day']}: {key} {previous[key]} -> {current[key]}")
+    assert not failures, samples
@@ -0,0 +1,1098 @@
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import sys
+import textwrap
+import threading
+import time
+import tracemalloc
+
+import pytest
+
+import TrayBTB
+
+
+class SlowToasts(TrayBTB.NotificationManager):
+    """Notification manager whose every toast costs `cost` seconds, like winotify spawning PowerShell."""
+
+    def __init__(self, cost: float):
+        super().__init__("TrayBTB", "", enabled=False)
+        self.cost = cost
+        self.shown = []
+
+    def show_notification(self, message: str):
+        time.sleep(self.cost)
+        self.shown.append(message)
+
+
+def fake_backend(**kwargs) -> TrayBTB.FakeBackend:
+    return TrayBTB.FakeBackend(sleep=lambda _s: None, **kwargs)
+
+
+# --- MenuUpdater (user-014) ---
+
+def test_menu_updater_applies_latest_state_under_concurrent_requests():
+    lock = threading.Lock()
+    state = {"chosen": "", "devices": ()}
+    applied = []
+
+    def fingerprint():
+        with lock:
+            return state["chosen"], state["devices"]
+
+    updater = TrayBTB.MenuUpdater(fingerprint, fingerprint, lambda menu: applied.append(menu) or True,
+                                  quiet_s=0.005, max_delay_s=0.02)
+
+    def discovery():
+        for i in range(300):
+            with lock:
+                state["devices"] = tuple(f"dev{j}" for j in range(i % 7))
+            updater.request()
+            time.sleep(0.0005)
+
+    def chooser():
+        for i in range(300):
+            with lock:
+                state["chosen"] = f"dev{i % 5}" if i % 4 else ""
+            updater.request()
+            time.sleep(0.0005)
+
+    threads = [threading.Thread(target=fn) for fn in (discovery, chooser, discovery, chooser)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert updater.flush(2.0)
+    elapsed = time.monotonic() - started
+
+    # последнее состояние применено, пересборок — не больше одной на окно max_delay_s
+    assert applied[-1] == fingerprint()
+    assert updater.rebuilds == len(applied)
+    assert updater.rebuilds <= elapsed / updater.max_delay_s + 2
+    assert updater.rebuilds < updater.requests / 10
+
+    # состояние не менялось — нативное меню не пересобирается
+    rebuilds = updater.rebuilds
+    updater.request()
+    assert updater.flush(2.0)
+    assert updater.rebuilds == rebuilds
+    assert updater.skipped >= 1
+    updater.stop()
+
+
+def test_tray_menu_matches_final_state_after_racing_updates(tray_icon):
+    app = TrayBTB.TrayApplication(backend=fake_backend(), headless=False)
+    tray_icon(app)
+    app._bg_update_devices()
+    devices = list(app.devices)
+
+    def discovery():
+        for _ in range(20):
+            app._bg_update_devices()
+
+    def chooser():
+        for i in range(200):
+            device = devices[i % len(devices)]
+            app.select_device(device["name"], device["id"], device["id_type"], announce=False)
+            if i % 3 == 0:
+                app.disconnect_device()
+
+    def notify_toggler():
+        for i in range(100):
+            device = devices[i % len(devices)]
+            app.toggle_notify_device(device["name"], device["id"], device["id_type"])(None, None)
+
+    threads = [threading.Thread(target=fn) for fn in (discovery, chooser, notify_toggler)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        assert app.menu_updater.flush(2.0)
+        menu = app.icon.menu
+        texts = [entry.text for entry in menu.items]
+        assert ("Отключиться от устройства" in texts) == bool(app.chosen_device)
+        assert [entry.text for entry in menu.items[1].submenu.items] == [d["name"] for d in app.devices]
+        notify_menu = menu.items[2].submenu.items
+        assert [entry.checked for entry in notify_menu] == [app.engine.has(d["id"]) for d in app.devices]
+        assert app.icon.native_updates == app.menu_updater.rebuilds
+        assert app.menu_updater.rebuilds < app.menu_updater.requests / 10
+    finally:
+        app.menu_updater.stop()
+        app.notifier.stop(timeout=2.0)
+
+
+
+# --- PollScheduler (user-004) ---
+
+class SimClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def scheduler_with_clock(**kwargs):
+    clock = SimClock()
+    return TrayBTB.PollScheduler(clock=clock, **kwargs), clock
+
+
+def test_scheduler_interval_grows_while_the_level_is_stable():
+    scheduler, clock = scheduler_with_clock()
+    intervals = []
+    for _ in range(12):
+        intervals.append(scheduler.record_success(80))
+        clock.now = scheduler.next_due
+    assert intervals[:3] == [15.0, 22.5, 33.75]
+    assert intervals == sorted(intervals)
+    assert intervals[-1] == scheduler.max_interval == 300.0
+    scheduler.record_success(80)
+    clock.now = scheduler.next_due - 1
+    assert not scheduler.is_due()
+    clock.now += 1
+    assert scheduler.is_due()
+
+
+def test_scheduler_drops_to_min_interval_on_a_fast_change_and_base_on_a_slow_one():
+    scheduler, clock = scheduler_with_clock()
+    for _ in range(8):
+        scheduler.record_success(80)
+        clock.now = scheduler.next_due
+    clock.now += 300  # медленно: 1 % за 5 минут и более
+    assert scheduler.record_success(79) == scheduler.base_interval
+    clock.now += 60  # быстро: 3 % в минуту
+    assert scheduler.record_success(76) == scheduler.min_interval
+
+
+def test_scheduler_caps_the_interval_near_the_low_threshold():
+    scheduler, clock = scheduler_with_clock(low_threshold=20, threshold_margin=5)
+    for _ in range(12):
+        interval = scheduler.record_success(25)
+        clock.now = scheduler.next_due
+        assert interval <= scheduler.near_threshold_interval
+    assert interval == scheduler.near_threshold_interval
+    # выше порога + запаса тот же стабильный уровень опрашивается всё реже
+    scheduler, clock = scheduler_with_clock(low_threshold=20, threshold_margin=5)
+    for _ in range(12):
+        interval = scheduler.record_success(26)
+        clock.now = scheduler.next_due
+    assert interval == scheduler.max_interval
+
+
+def test_scheduler_backs_off_exponentially_on_failures_and_recovers():
+    scheduler, clock = scheduler_with_clock()
+    delays = [scheduler.record_failure() for _ in range(8)]
+    assert delays == [2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 120.0, 120.0]
+    assert scheduler.next_due == clock.now + 120.0
+    scheduler.record_success(80)
+    assert scheduler.failures == 0
+    assert scheduler.record_failure() == scheduler.failure_interval
+
+
+def test_scheduler_reset_and_poll_now_make_the_next_poll_due_immediately():
+    scheduler, clock = scheduler_with_clock()
+    for _ in range(6):
+        scheduler.record_success(80)
+        clock.now = scheduler.next_due
+    scheduler.record_failure()
+    assert not scheduler.is_due()
+    scheduler.poll_now()
+    assert scheduler.is_due()
+    assert scheduler.failures == 1  # poll_now расписание не трогает
+    scheduler.record_success(80)
+    scheduler.reset()
+    assert scheduler.is_due()
+    assert (scheduler.interval, scheduler.failures) == (scheduler.min_interval, 0)
+    # история уровня забыта — следующий успех начинается с базового интервала
+    assert scheduler.record_success(80) == scheduler.base_interval
+
+
+def test_scheduler_polls_far_less_than_a_fixed_one_second_poller():
+    scheduler, clock = scheduler_with_clock()
+    level = 90.0
+    end = clock.now + 24 * 3600
+    while clock.now < end:
+        clock.now = scheduler.next_due
+        level -= 0.02 * scheduler.interval / 60  # ~1.2 % в час
+        scheduler.record_success(int(level))
+    assert scheduler.polls_per_hour() < 3600 / 60
+    report = scheduler.report(1.0)
+    assert report.endswith("vs 3600 polls/h at fixed 1.0s")
+    assert report.startswith(f"{scheduler.polls_per_hour():.0f} polls/h adaptive")
+
+
+# --- общее состояние (user-015) ---
+
+def test_published_battery_status_is_an_immutable_snapshot():
+    backend = fake_backend()
+    app = TrayBTB.TrayApplication(backend=backend, headless=True)
+    app.select_device("Fake Mouse", "FAKE\\MOUSE", "pnp", announce=False)
+    published = app.battery_status
+
+    async def run():
+        app._loop = asyncio.get_running_loop()
+        await app.apply_poll_results(app.engine.poll())
+        backend.set_level("FAKE\\MOUSE", None)
+        await app.apply_poll_results(app.engine.poll())
+        for _ in range(app.error_threshold - 1):
+            await app.register_error()
+
+    asyncio.run(run())
+    app.notifier.stop(timeout=2.0)
+    app.menu_updater.stop()
+
+    # ранее опубликованный снимок не меняется опросом
+    assert published == TrayBTB.BatStatus(level=None, last_update=0)
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        app.battery_status.error_count = 0
+    # неудачное чтение + ошибки обработки достигли порога — устройство отключено, приложение работает
+    assert app.state == TrayBTB.DeviceState.NO_DEVICE
+    assert app.battery_status == TrayBTB.BatStatus(level=None, last_update=0)
+    assert not app.exit_flag
+
+
+
+
+
+# --- потоковый поиск (user-013) ---
+
+def test_first_device_is_published_before_the_slowest_probe_finishes():
+    backend = TrayBTB.FakeBackend(probe_latency={
+        "FAKE\\HEADPHONES": 0.02, "FAKE\\MOUSE": 0.05, "FAKE\\KEYBOARD": 0.6,
+    })
+    app = TrayBTB.TrayApplication(backend=backend, headless=True)
+    started = time.perf_counter()
+    published = []
+
+    def on_change(old, new):
+        if new.devices and not old.devices:
+            published.append((time.perf_counter() - started, [d["id"] for d in new.devices]))
+
+    app.store.subscribe(on_change)
+    try:
+        app._bg_update_devices()
+    finally:
+        app.notifier.stop(timeout=2.0)
+        app.menu_updater.stop()
+    elapsed = time.perf_counter() - started
+
+    # меню получило первое устройство, пока медленная проба ещё шла
+    (first_at, first_ids), = published
+    assert first_ids == ["FAKE\\HEADPHONES"]
+    assert first_at < 0.3 < elapsed
+    stats = app.device_manager.last_stats
+    assert stats.devices == 3
+    assert stats.time_to_first < 0.3 <= 0.6 <= stats.total_time
+    assert sorted(d["id"] for d in app.devices) == ["FAKE\\HEADPHONES", "FAKE\\KEYBOARD", "FAKE\\MOUSE"]
+
+
+# --- DeviceWatcher (user-010) ---
+
+def test_device_watcher_collapses_an_event_burst_into_one_bounded_probe():
+    Event = TrayBTB.DeviceEvent
+    backend = fake_backend(devices=[
+        {"name": "BT Headphones", "id": "BT\\HEAD", "id_type": "pnp", "battery": 80},
+        {"name": "BT Mouse", "id": "BT\\MOUSE", "id_type": "pnp", "battery": 40},
+        {"name": "BT Old Speaker", "id": "BT\\OLD", "id_type": "pnp", "battery": 60},
+    ])
+    app = TrayBTB.TrayApplication(backend=backend, headless=True)
+    app.store.update(devices=tuple(backend.discover()))
+    app.select_device("BT Old Speaker", "BT\\OLD", "pnp", announce=False)
+    backend.set_level("BT\\MOUSE", None)  # мышь переподключилась без батареи
+    # одно подключение гарнитуры — пачка событий, плюс шум от устройств, которые не кандидаты
+    burst = [Event("created", "BT\\HEAD", "BT Headphones")]
+    burst += [Event("changed", "BT\\HEAD", "BT Headphones") for _ in range(30)]
+    burst += [Event("changed", f"USB\\HUB{i}", "USB Root Hub") for i in range(20)]
+    burst += [Event("changed", "BT\\MOUSE", "BT Mouse"), Event("deleted", "BT\\OLD", "BT Old Speaker")]
+    source = TrayBTB.ScriptedEventSource([(0.001, event) for event in burst])
+    changes = []
+
+    def on_change(added, removed):
+        changes.append((added, removed))
+        app.apply_device_changes(added, removed)
+
+    watcher = TrayBTB.DeviceWatcher(source, backend, on_change, debounce=0.2, max_delay=5.0, poll_timeout=0.02)
+    backend.read_calls = 0
+    watcher.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not changes and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        watcher.stop()
+        app.notifier.stop(timeout=2.0)
+        app.menu_updater.stop()
+
+    # 53 события — один сброс и одно пакетное чтение двух кандидатов
+    assert watcher.events == len(burst)
+    assert watcher.flushes == 1
+    assert watcher.max_probed_per_flush == 2
+    assert backend.read_calls == 1
+    assert changes == [(
+        [{"name": "BT Headphones", "id": "BT\\HEAD", "id_type": "pnp", "battery": 80}],
+        ["BT\\OLD", "BT\\MOUSE"],
+    )]
+    # выбранное устройство не убирается из меню событием удаления, остальные изменения применены
+    assert [d["id"] for d in app.devices] == ["BT\\HEAD", "BT\\OLD"]
+    assert app.chosen_device_id == "BT\\OLD"
+
+
+# --- IPC API (user-020) ---
+
+def test_ipc_replies_are_ok_objects_and_monitor_republishes_levels():
+    backend = fake_backend()
+    app = TrayBTB.TrayApplication(backend=backend, headless=True)
+    app.select_device("Fake Mouse", "FAKE\\MOUSE", "pnp", announce=False)
+    app.store.update(devices=tuple(backend.discover()))
+    replies = {}
+
+    async def run():
+        app._loop = asyncio.get_running_loop()
+        await app.apply_poll_results(app.engine.poll())
+        app.ipc = TrayBTB.IpcServer(app, port=0)
+        await app.ipc.start()
+        reader, writer = await asyncio.open_connection("127.0.0.1", app.ipc.port)
+
+        async def ask(request):
+            writer.write((json.dumps(request) + "\n").encode("utf-8"))
+            await writer.drain()
+            return json.loads(await asyncio.wait_for(reader.readline(), 5))
+
+        try:
+            replies["devices"] = await ask({"cmd": "devices"})
+            replies["before"] = await ask({"cmd": "levels"})
+            replies["monitor"] = await ask({"cmd": "monitor", "id": "FAKE\\KEYBOARD"})
+            replies["after_monitor"] = await ask({"cmd": "levels"})
+            replies["unmonitor"] = await ask({"cmd": "unmonitor", "id": "FAKE\\KEYBOARD"})
+            replies["after_unmonitor"] = await ask({"cmd": "levels"})
+            replies["subscribe"] = await ask({"cmd": "subscribe"})
+            replies["events"] = [json.loads(await asyncio.wait_for(reader.readline(), 5)) for _ in range(2)]
+        finally:
+            writer.close()
+            await app.ipc.stop()
+
+    asyncio.run(run())
+    app.notifier.stop(timeout=2.0)
+    app.menu_updater.stop()
+
+    # ответ на запрос — {"ok": true, ...} без "event", событие — {"event": ...} без "ok"
+    assert replies["devices"]["ok"] is True and "event" not in replies["devices"]
+    assert [d["id"] for d in replies["devices"]["devices"]] == ["FAKE\\HEADPHONES", "FAKE\\MOUSE", "FAKE\\KEYBOARD"]
+    assert replies["before"]["ok"] is True and "event" not in replies["before"]
+    assert set(replies["before"]["levels"]) == {"FAKE\\MOUSE"}
+    assert replies["monitor"] == {"ok": True}
+    assert set(replies["after_monitor"]["levels"]) == {"FAKE\\MOUSE", "FAKE\\KEYBOARD"}
+    assert replies["after_monitor"]["levels"]["FAKE\\KEYBOARD"]["policy"] == "notify"
+    assert set(replies["after_unmonitor"]["levels"]) == {"FAKE\\MOUSE"}
+    assert replies["subscribe"] == {"ok": True, "subscribed": True}
+    assert sorted(e["event"] for e in replies["events"]) == ["devices", "levels"]
+    assert all("ok" not in e for e in replies["events"])
+
+
+
+
+def test_ipc_closes_the_connection_on_a_non_json_line_and_caps_monitored_devices():
+    app = TrayBTB.TrayApplication(backend=fake_backend(), headless=True)
+    refreshes = []
+    app.update_devices = lambda *args: refreshes.append(args)
+    result = {}
+
+    async def run():
+        app._loop = asyncio.get_running_loop()
+        app.ipc = TrayBTB.IpcServer(app, port=0, max_monitored=2)
+        await app.ipc.start()
+        try:
+            # браузер, отправляющий POST на порт API: тело — валидные команды
+            reader, writer = await asyncio.open_connection("127.0.0.1", app.ipc.port)
+            writer.write(
+                b"POST / HTTP/1.1\r\nHost: 127.0.0.1:47655\r\nContent-Type: text/plain\r\n\r\n"
+                b'{"cmd": "refresh"}\n{"cmd": "monitor", "id": "EVIL"}\n'
+            )
+            await writer.drain()
+            result["http"] = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", app.ipc.port)
+            replies = []
+            for i in range(4):
+                writer.write((json.dumps({"cmd": "monitor", "id": f"DEV{i % 3}"}) + "\n").encode("utf-8"))
+                await writer.drain()
+                replies.append(json.loads(await asyncio.wait_for(reader.readline(), 5)))
+            result["monitor"] = replies
+            writer.close()
+        finally:
+            await app.ipc.stop()
+
+    asyncio.run(run())
+    app.notifier.stop(timeout=2.0)
+    app.menu_updater.stop()
+
+    # одна строка «bad request» и EOF: тело запроса не выполнено
+    assert result["http"] == b'{"ok": false, "error": "bad request"}\n'
+    assert refreshes == [] and not app.engine.has("EVIL")
+    assert app.ipc.rejected == 1
+    assert [r["ok"] for r in result["monitor"]] == [True, True, False, True]  # DEV0 уже отслеживается
+    assert sorted(d.device_id for d in app.engine.devices()) == ["DEV0", "DEV1"]
+
+
+# --- BatteryHistory (user-016) ---
+
+def discharge(history, start_t, start_level, rate_per_hour, duration_s, step_s=60.0):
+    """Feed a linear discharge curve (levels rounded like real readings); returns the end time."""
+    t = start_t
+    while t - start_t <= duration_s:
+        level = start_level - rate_per_hour * (t - start_t) / 3600.0
+        history.add(t, max(0, int(round(level))))
+        t += step_s
+    return t
+
+
+def test_history_estimates_the_rate_of_a_linear_discharge():
+    history = TrayBTB.BatteryHistory()
+    discharge(history, 0.0, 100, 10.0, 3 * 3600)
+    assert history.rate_per_hour == pytest.approx(10.0, rel=0.05)
+    assert history.time_to_empty() == pytest.approx(70 / 10.0 * 3600, rel=0.05)
+    assert TrayBTB.format_remaining(history.time_to_empty()) == "7h 00m"
+
+
+def test_history_has_no_estimate_below_min_span():
+    history = TrayBTB.BatteryHistory(min_span_s=600.0)
+    discharge(history, 0.0, 100, 30.0, 300, step_s=10.0)  # 5 минут сэмплов — наклон ещё шумный
+    assert len(history) == 31
+    assert history.rate_per_hour is None
+    assert history.time_to_empty() is None
+
+
+def test_history_resets_the_estimate_when_the_device_is_charged():
+    history = TrayBTB.BatteryHistory()
+    t = discharge(history, 0.0, 90, 20.0, 2 * 3600)
+    assert history.rate_per_hour == pytest.approx(20.0, rel=0.05)
+    history.add(t, 100)  # подзарядили
+    assert history.rate_per_hour is None
+    # новая оценка строится только по сэмплам после зарядки
+    discharge(history, t + 60, 100, 5.0, 2 * 3600)
+    assert history.rate_per_hour == pytest.approx(5.0, rel=0.1)
+
+
+def test_history_memory_stays_flat_over_weeks_of_samples():
+    history = TrayBTB.BatteryHistory()
+    day = 86400.0
+
+    def sawtooth(start, days):
+        # два цикла разряда/заряда в сутки, сэмпл раз в минуту
+        t = start
+        for _ in range(days * 2):
+            t = discharge(history, t, 100, 15.0, day / 2 - 60)
+        return t
+
+    t = sawtooth(0.0, 7)  # неделя — кольцо корзин заполнено
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        started = time.perf_counter()
+        t = sawtooth(t, 21)
+        per_sample = (time.perf_counter() - started) / (21 * 1440)
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert after - before < 4096
+    assert len(history) == history.capacity
+    assert len(history.downsampled()) == 1008
+    assert history.downsampled()[-1][0] > history.downsampled()[0][0]
+    assert per_sample < 50e-6  # O(1) на сэмпл, без пересчёта по истории
+
+
+# --- NotificationDispatcher (user-011) ---
+
+def test_notification_cost_does_not_delay_poll_ticks():
+    backend = fake_backend(devices=[{"name": "Low", "id": "FAKE\\LOW", "id_type": "pnp", "battery": 10}])
+    app = TrayBTB.TrayApplication(backend=backend, headless=True)
+    toasts = SlowToasts(cost=0.2)
+    app.notifier = TrayBTB.NotificationDispatcher(toasts)
+    app.select_device("Low", "FAKE\\LOW", "pnp", announce=False)
+    ticks = []
+
+    async def run():
+        app._loop = asyncio.get_running_loop()
+        for i in range(40):
+            # каждое второе чтение — новое пересечение порога, т.е. новое уведомление
+            backend.set_level("FAKE\\LOW", 10 if i % 2 == 0 else 30)
+            started = time.perf_counter()
+            await app.handle_state()
+            await app.apply_poll_results(app.engine.poll())
+            ticks.append(time.perf_counter() - started)
+
+    asyncio.run(run())
+    app.notifier.stop(timeout=5.0)
+    app.menu_updater.stop()
+
+    # тост стоит 0.2 с, такт цикла его не ждёт
+    assert max(ticks) < 0.05
+    assert toasts.shown
+    # 20 пересечений порога, но тосты одного ключа склеиваются, пока предыдущий ждёт отправки
+    assert len(toasts.shown) < 20
+    assert app.notifier.coalesced > 0
+
+
+# --- опрос вне main_loop (user-003) ---
+
+def test_poll_timeout_outlasts_the_first_request_of_a_cold_worker():
+    backend = fake_backend()
+    backend.worker = TrayBTB.PowerShellWorker()  # процесс запускается лениво, здесь не стартует
+    app = TrayBTB.TrayApplication(backend=backend, headless=True)
+    app.notifier.stop(timeout=2.0)
+    app.menu_updater.stop()
+    assert app.poll_timeout > backend.worker.start_timeout
+    assert app.poll_timeout_per_id == backend.worker.per_id_timeout
+
+
+def test_next_poll_is_skipped_while_a_timed_out_one_still_runs():
+    backend = fake_backend(devices=[{"name": "Mouse", "id": "FAKE\\MOUSE", "id_type": "pnp", "battery": 50}])
+    app = TrayBTB.TrayApplication(backend=backend, headless=True)
+    app.select_device("Mouse", "FAKE\\MOUSE", "pnp", announce=False)
+    app.poll_timeout = 0.05
+    release = threading.Event()
+    calls = []
+
+    def stuck_poll():
+        calls.append(time.perf_counter())
+        release.wait(5)
+        return []
+
+    app.engine.poll = stuck_poll
+
+    async def run():
+        app._loop = asyncio.get_running_loop()
+        app.start_poll_if_due()
+        await app._poll_task
+        assert app.poll_stats.timeouts == 1
+        # опрос снова по расписанию, но прошлый engine.poll ещё держит поток
+        for _ in range(5):
+            app.scheduler.poll_now()
+            app.start_poll_if_due()
+            assert app._poll_task.done()
+        assert len(calls) == 1
+        release.set()
+        await asyncio.wrap_future(app._poll_future)
+        app.scheduler.poll_now()
+        app.start_poll_if_due()
+        await app._poll_task
+
+    asyncio.run(run())
+    app.notifier.stop(timeout=2.0)
+    app.menu_updater.stop()
+    assert len(calls) == 2
+    assert app.poll_stats.skipped_in_flight == 5
+    assert app.poll_stats.timeouts == 1
+
+
+# --- кэш обнаружения (user-009) ---
+
+CACHED_DEVICES = [
+    {"name": "Fake Mouse", "id": "FAKE\\MOUSE", "id_type": "pnp", "battery": 50},
+    {"name": "Fake Keyboard", "id": "FAKE\\KEYBOARD", "id_type": "pnp", "battery": 80},
+]
+
+
+def write_cache(path, **data):
+    data = {"version": TrayBTB.DiscoveryCache.VERSION, "saved_at": time.time(),
+            "devices": CACHED_DEVICES, "chosen": None, "notify": [], **data}
+    path.write_text(json.dumps(data), encoding="utf-8")
+
+
+def test_discovery_cache_round_trips_devices_and_monitored_ones(tmp_path):
+    cache = TrayBTB.DiscoveryCache(str(tmp_path / "cache" / "devices.json"))
+    assert cache.load() is None  # файла ещё нет
+    chosen = {"name": "Fake Mouse", "id": "FAKE\\MOUSE", "id_type": "pnp"}
+    notify = [{"name": "Fake Keyboard", "id": "FAKE\\KEYBOARD", "id_type": "pnp"}]
+    cache.save(CACHED_DEVICES, chosen, notify)
+    assert cache.load() == {"devices": CACHED_DEVICES, "chosen": chosen, "notify": notify}
+    assert not (tmp_path / "cache" / "devices.json.tmp").exists()
+
+
+def test_discovery_cache_ignores_another_version(tmp_path):
+    path = tmp_path / "devices.json"
+    write_cache(path, version=TrayBTB.DiscoveryCache.VERSION + 1)
+    assert TrayBTB.DiscoveryCache(str(path)).load() is None
+    path.write_text(json.dumps(CACHED_DEVICES), encoding="utf-8")  # не объект
+    assert TrayBTB.DiscoveryCache(str(path)).load() is None
+
+
+def test_discovery_cache_expires_after_ttl(tmp_path):
+    path = tmp_path / "devices.json"
+    write_cache(path, saved_at=time.time() - 120)
+    assert TrayBTB.DiscoveryCache(str(path), ttl=60).load() is None
+    assert TrayBTB.DiscoveryCache(str(path), ttl=600).load()["devices"] == CACHED_DEVICES
+
+
+def test_discovery_cache_drops_malformed_entries(tmp_path):
+    path = tmp_path / "devices.json"
+    write_cache(
+        path,
+        devices=CACHED_DEVICES + ["junk", {"name": "No id", "id_type": "pnp"}, {"id": "X", "name": "No type"}],
+        chosen={"name": "No id"},
+        notify=[{"name": "No id"}, 7, {"name": "Fake Keyboard", "id": "FAKE\\KEYBOARD"}],
+    )
+    assert TrayBTB.DiscoveryCache(str(path)).load() == {
+        "devices": CACHED_DEVICES, "chosen": None,
+        "notify": [{"name": "Fake Keyboard", "id": "FAKE\\KEYBOARD"}],
+    }
+    path.write_text('{"version": 1, "devices": [', encoding="utf-8")  # обрезанный файл
+    assert TrayBTB.DiscoveryCache(str(path)).load() is None
+
+
+def test_launch_resumes_chosen_and_notify_devices_from_the_cache(tmp_path):
+    path = tmp_path / "devices.json"
+    write_cache(
+        path,
+        chosen={"name": "Fake Mouse", "id": "FAKE\\MOUSE", "id_type": "pnp"},
+        notify=[{"name": "Fake Keyboard", "id": "FAKE\\KEYBOARD", "id_type": "pnp"}],
+    )
+    cache = TrayBTB.DiscoveryCache(str(path))
+    app = TrayBTB.TrayApplication(backend=fake_backend(), headless=True, discovery_cache=cache)
+    try:
+        assert list(app.devices) == CACHED_DEVICES
+        assert app._cached_ids == [("FAKE\\MOUSE", "pnp"), ("FAKE\\KEYBOARD", "pnp")]
+        assert app.chosen_device_id == "FAKE\\MOUSE"
+        assert app.engine.get("FAKE\\MOUSE").policy == "tray"
+        assert app.engine.get("FAKE\\KEYBOARD").policy == "notify"
+        # сохранение отдаёт в кэш то же, что было восстановлено
+        before = cache.load()
+        app.save_cache()
+        assert cache.load() == before
+    finally:
+        app.notifier.stop(timeout=2.0)
+        app.menu_updater.stop()
+
+
+# --- логи (user-019) ---
+
+def log_record(msg, *args, level=logging.WARNING):
+    return logging.LogRecord("TrayBTB", level, __file__, 0, msg, args or None, None)
+
+
+def test_repeat_throttle_swallows_repeats_and_counts_them_in_the_next_message():
+    clock = SimClock(now=0.0)
+    throttle = TrayBTB.RepeatThrottle(window=60.0, clock=clock)
+    assert throttle.filter(log_record("Failed to get battery level"))
+    for _ in range(10):
+        clock.now += 5
+        assert not throttle.filter(log_record("Failed to get battery level"))
+    # ключ — текст после подстановки аргументов
+    assert throttle.filter(log_record("Battery level: %d", 50))
+    assert not throttle.filter(log_record("Battery level: %d", 50))
+    assert throttle.filter(log_record("Battery level: %d", 40))
+    clock.now = 240.0
+    record = log_record("Failed to get battery level")
+    assert throttle.filter(record)
+    assert record.getMessage() == "Failed to get battery level (x11 in last 4m)"
+    assert throttle.suppressed == 11
+    # без повторов в окне следующее сообщение проходит как есть
+    clock.now += 600
+    record = log_record("Failed to get battery level")
+    assert throttle.filter(record)
+    assert record.getMessage() == "Failed to get battery level"
+
+
+def test_repeat_throttle_reports_repeats_of_still_open_windows():
+    clock = SimClock(now=0.0)
+    throttle = TrayBTB.RepeatThrottle(window=60.0, clock=clock)
+    throttle.filter(log_record("Failed to get battery level"))
+    throttle.filter(log_record("Logging initialized", level=logging.INFO))
+    for _ in range(3):
+        clock.now += 1
+        throttle.filter(log_record("Failed to get battery level"))
+    assert throttle.pending() == [(logging.WARNING, "Failed to get battery level (x3 more in last 3s)")]
+
+
+def test_logs_close_writes_pending_repeat_summaries(tmp_path):
+    logs = TrayBTB.Logs()
+    # отдельный логгер — обработчики теста не остаются на общем логгере TrayBTB
+    logs.log = logging.getLogger("TrayBTB.test-close")
+    logs.log.propagate = False
+    logs.throttle = TrayBTB.RepeatThrottle(window=60.0, clock=SimClock())
+    logs.setup(str(tmp_path))
+    try:
+        for _ in range(4):
+            logs.log.warning("Failed to get battery level")
+    finally:
+        logs.close()
+        for handler in list(logs.log.handlers):
+            logs.log.removeHandler(handler)
+    lines = open(logs.logFileName, encoding="utf-8").read().splitlines()
+    assert [line.split(" - ")[-1] for line in lines] == [
+        "Logging initialized",
+        "Failed to get battery level",
+        "Failed to get battery level (x3 more in last 0s)",
+    ]
+
+
+def test_log_file_rolls_over_by_age(tmp_path):
+    path = tmp_path / "TrayBTB_test.log"
+    handler = TrayBTB.RotatingLogHandler(str(path), max_bytes=1024 * 1024, backup_count=2, max_age=3600)
+    try:
+        handler.emit(log_record("first"))
+        handler.emit(log_record("second"))  # размер и возраст в пределах — тот же файл
+        handler._opened_at -= 3600
+        handler.emit(log_record("third"))
+    finally:
+        handler.close()
+    assert (tmp_path / "TrayBTB_test.log.1").read_text(encoding="utf-8").split() == ["first", "second"]
+    assert path.read_text(encoding="utf-8").split() == ["third"]
+
+
+def test_logs_prune_keeps_newest_files_within_max_days(tmp_path):
+    now = time.time()
+    ages_h = {"TrayBTB_1.log": 0, "TrayBTB_2.log": 1, "TrayBTB_2.log.1": 2, "TrayBTB_3.log": 3,
+              "TrayBTB_old.log": 20 * 24, "notes.txt": 30 * 24}
+    for name, age in ages_h.items():
+        (tmp_path / name).write_text("x")
+        os.utime(tmp_path / name, (now - age * 3600, now - age * 3600))
+    logs = TrayBTB.Logs()
+    logs.prune(str(tmp_path))  # max_days=14: старше — удаляется, чужие файлы не трогаются
+    assert sorted(os.listdir(tmp_path)) == sorted(set(ages_h) - {"TrayBTB_old.log"})
+    logs.max_files = 2
+    logs.prune(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ["TrayBTB_1.log", "TrayBTB_2.log", "notes.txt"]
+
+
+# --- протокол результатов PowerShell (user-023) ---
+
+@pytest.mark.parametrize("line", [
+    'noise 42',
+    '@@',
+    '@@{"seq":1,"id":"A","status":"ok"',
+    '@@[1, 2]',
+    '@@{"id":"A","status":"ok","level":5}',
+    '@@{"seq":-1,"id":"A","status":"none"}',
+    '@@{"seq":true,"id":"A","status":"none"}',
+    '@@{"seq":1,"id":"","status":"none"}',
+    '@@{"seq":1,"id":7,"status":"none"}',
+    '@@{"seq":1,"id":"A","status":"weird"}',
+    '@@{"seq":1,"id":"A","status":"ok"}',
+    '@@{"seq":1,"id":"A","status":"ok","level":101}',
+    '@@{"seq":1,"id":"A","status":"ok","level":true}',
+    '@@{"seq":1,"id":"A","status":"ok","level":"50"}',
+    '@@{"seq":1,"id":"A","status":"none","level":50}',
+    '@@{"seq":1,"id":"A","status":"error","error":404}',
+    '@@{"seq":1,"id":"A","status":"error","code":"E_FAIL"}',
+    '@@{"seq":1,"id":"A","status":"none","extra":1}',
+    '@@{"seq":1,"end":true}',
+    '@@{"seq":1,"end":false,"count":0}',
+    '@@{"seq":1,"end":true,"count":-1}',
+    '@@{"seq":1,"end":true,"count":0,"id":"A"}',
+])
+def test_parse_probe_record_rejects_malformed_records(line):
+    with pytest.raises(TrayBTB.ProtocolError):
+        TrayBTB.parse_probe_record(line)
+
+
+def test_parse_probe_record_accepts_every_status():
+    parse = TrayBTB.parse_probe_record
+    assert parse('@@{"seq":3,"id":"A","status":"ok","level":0,"error":null,"code":null}') == \
+        TrayBTB.ProbeResult(3, "A", "ok", 0)
+    assert parse('@@{"seq":3,"id":"B","status":"none","level":null}') == TrayBTB.ProbeResult(3, "B", "none")
+    assert parse('@@{"seq":3,"id":"C","status":"error","error":"Элемент не найден","code":-2146233079}') == \
+        TrayBTB.ProbeResult(3, "C", "error", None, "Элемент не найден", -2146233079)
+    assert parse('@@{"seq":3,"end":true,"count":3}') == TrayBTB.ProbeEnd(3, 3)
+
+
+@pytest.mark.parametrize("records, end, ids", [
+    ([("A", 1)], (1, 2), ["A", "B"]),                 # кадр короче заявленного
+    ([("A", 1), ("B", 1)], (1, 1), ["A", "B"]),       # count не совпадает с числом записей
+    ([("A", 1)], (1, 1), ["A", "B"]),                 # ответ не на все id
+    ([("B", 1), ("A", 1)], (1, 2), ["A", "B"]),       # чужой порядок
+    ([("A", 1), ("B", 2)], (1, 2), ["A", "B"]),       # запись другого запроса
+    ([("A", 1), ("C", 1)], (1, 2), ["A", "B"]),       # ответ на чужой id
+])
+def test_collect_probe_frame_rejects_partial_and_mismatched_frames(records, end, ids):
+    results = [TrayBTB.ProbeResult(seq, device_id, "ok", 50) for device_id, seq in records]
+    with pytest.raises(TrayBTB.ProtocolError):
+        TrayBTB.collect_probe_frame(results, TrayBTB.ProbeEnd(*end), ids)
+
+
+def test_parse_probe_output_skips_noise_and_requires_a_complete_frame():
+    text = (
+        "WARNING: something from PowerShell 99\n"
+        '@@{"seq":0,"id":"A","status":"ok","level":5}\n'
+        '@@{"seq":0,"id":"B","status":"none"}\n'
+        '@@{"seq":0,"end":true,"count":2}\n'
+    )
+    frame = TrayBTB.parse_probe_output(text, ["A", "B"])
+    assert frame["A"].level == 5 and frame["B"].status == "none"
+
+    with pytest.raises(TrayBTB.ProtocolError):
+        TrayBTB.parse_probe_output(text.rsplit("@@", 1)[0], ["A", "B"])  # обрезанный вывод
+    with pytest.raises(TrayBTB.ProtocolError):
+        TrayBTB.parse_probe_output(text + '@@{"seq":0,"id":"C","status":"none"}\n', ["A", "B"])
+    with pytest.raises(TrayBTB.ProtocolError):
+        TrayBTB.parse_probe_output(text.replace('"seq":0', '"seq":1'), ["A", "B"])
+
+
+STAND_IN_WORKER = textwrap.dedent('''
+    import json, sys
+    for line in sys.stdin:
+        seq, *ids = line.rstrip("\\n").split("\\t")
+        print("noise 99")
+        if "garble" in ids:
+            print('@@{"seq": %s, "id": "gar' % seq, flush=True)
+            continue
+        for device_id in ids:
+            record = {"seq": int(seq), "id": device_id, "status": "ok", "level": len(device_id)}
+            if device_id == "none":
+                record.update(status="none", level=None)
+            print("@@" + json.dumps(record))
+        print("@@" + json.dumps({"seq": int(seq), "end": True, "count": len(ids)}), flush=True)
+''')
+
+
+def test_worker_drops_garbled_frame_and_restarts(tmp_path):
+    script = tmp_path / "worker.py"
+    script.write_text(STAND_IN_WORKER, encoding="utf-8")
+    worker = TrayBTB.PowerShellWorker(command=[sys.executable, str(script)])
+    try:
+        assert worker.query_many(["AB", "none", "XYZ"], timeout=5) == {"AB": 2, "none": None, "XYZ": 3}
+        assert worker.query_many(["garble", "AB"], timeout=5) == {"garble": None, "AB": None}
+        time.sleep(1.1)  # пауза перед перезапуском после первого сбоя — 1 с
+        assert worker.query_many(["ABCD"], timeout=5) == {"ABCD": 4}
+        assert worker.restarts == 1
+    finally:
+        worker.close()
+
+
+class StubWmi:
+    """WmiSession stand-in returning fixed Win32_PnPEntity rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def query(self, wql, fields):
+        return [dict(row) for row in self.rows]
+
+    def close(self):
+        pass
+
+
+def stand_in_probe(args, input, **kwargs):
+    # одноразовая проба: тот же кадр, что печатает PS_BATCH_SCRIPT (seq 0)
+    ids = [line for line in input.splitlines() if line]
+    lines = []
+    for device_id in ids:
+        record = {"seq": 0, "id": device_id, "status": "ok", "level": len(device_id)}
+        if device_id.startswith("none"):
+            record.update(status="none", level=None)
+        elif device_id.startswith("err") and len(ids) > 1:
+            # Get-PnpDeviceProperty упал в пакете; поштучная проба отвечает
+            record.update(status="error", level=None, error="boom", code=-1)
+        lines.append("@@" + json.dumps(record))
+    lines.append("@@" + json.dumps({"seq": 0, "end": True, "count": len(ids)}))
+    return TrayBTB.subprocess.CompletedProcess(args, 0, stdout="\n".join(lines) + "\n", stderr="")
+
+
+def test_replayed_trace_drives_the_real_powershell_backend(tmp_path):
+    script = tmp_path / "worker.py"
+    script.write_text(STAND_IN_WORKER, encoding="utf-8")
+    trace = str(tmp_path / "trace.jsonl")
+    wmi = StubWmi([
+        {"PNPDeviceID": "AB", "Name": "Headphones AB"},
+        {"PNPDeviceID": "none", "Name": "BT none"},
+        {"PNPDeviceID": "XYZ", "Name": "Audio XYZ"},
+    ])
+
+    def session(backend):
+        # первый скан — пакетные пробы, второй — постоянный воркер и отрицательный кэш
+        probed = sorted(d["id"] for d in backend.discover())
+        first_scan = dict(backend.last_scan)
+        refreshed = sorted(d["id"] for d in backend.discover())
+        return {
+            "probed": probed, "first_scan": first_scan,
+            "refreshed": refreshed, "second_scan": dict(backend.last_scan),
+            "levels": backend.read_many(["AB", "XYZ"]),
+            "garbled": backend.read_many(["garble", "AB"]),
+            "crashes": backend.worker._crashes,
+        }
+
+    recorder = TrayBTB.TraceRecorder(trace, run=stand_in_probe)
+    backend = recorder.backend(wmi=wmi, command=[sys.executable, str(script)])
+    try:
+        recorded = session(backend)
+    finally:
+        backend.close()
+        recorder.close()
+    assert recorded["probed"] == ["AB", "XYZ"]
+    assert recorded["second_scan"]["skipped_no_battery"] == 1
+    assert recorded["levels"] == {"AB": 2, "XYZ": 3}
+    assert recorded["garbled"] == {"garble": None, "AB": None}
+    assert recorded["crashes"] == 1
+
+    replayer = TrayBTB.TraceReplayer(trace, speed=0)
+    replayed_backend = replayer.backend()
+    try:
+        assert replayed_backend.event_source() is None
+        replayed = session(replayed_backend)
+    finally:
+        replayed_backend.close()
+    assert replayed == recorded
+    assert replayer.misses == 0
+    assert replayer.runs == 3 and replayer.worker_requests == 3
+
+
+# --- BLE (user-021) ---
+
+def ble_backend(*devices, **kwargs) -> TrayBTB.BleBatteryBackend:
+    by_address = {d.address: d for d in devices}
+    return TrayBTB.BleBatteryBackend(
+        client_factory=lambda address, callback: by_address[address].client(callback),
+        scanner=lambda _timeout: asyncio.sleep(0, result=[(d.address, d.name) for d in devices]),
+        **kwargs,
+    )
+
+
+def test_ble_read_waits_for_a_connecting_device_and_fails_only_after_a_failed_connect():
+    headset = TrayBTB.FakeBleDevice("AA", "Headset", level=70)
+    flaky = TrayBTB.FakeBleDevice("BB", "Flaky", level=40, connect_failures=1)
+    backend = ble_backend(headset, flaky, min_backoff=0.3)
+    try:
+        started = time.perf_counter()
+        # новое устройство: ждём первого уровня, а не отвечаем None
+        assert backend.read_many(["AA"]) == {"AA": 70}
+        # подключение не удалось — None без ожидания connect_timeout
+        assert backend.read_many(["BB"]) == {"BB": None}
+        assert time.perf_counter() - started < 2.0
+        time.sleep(0.6)
+        assert backend.read_many(["AA", "BB"]) == {"AA": 70, "BB": 40}
+        assert headset.connects == 1
+    finally:
+        backend.close()
+
+
+def test_ble_idle_limit_outlasts_the_longest_poll_interval():
+    backend = ble_backend(idle_disconnect_s=300.0)
+    app = TrayBTB.TrayApplication(backend=fake_backend(), headless=True, ble_backend=backend)
+    app.notifier.stop(timeout=2.0)
+    app.menu_updater.stop()
+    assert backend.idle_disconnect_s >= 3 * app.scheduler.max_interval
+
+
+def test_cache_revalidation_reads_ble_devices_through_the_ble_backend():
+    headset = TrayBTB.FakeBleDevice("AA", "Headset", level=70)
+    pnp = fake_backend()
+    backend = ble_backend(headset)
+    app = TrayBTB.TrayApplication(backend=pnp, headless=True, ble_backend=backend)
+    requested = []
+    read_many = pnp.read_many
+    pnp.read_many = lambda ids: requested.append(list(ids)) or read_many(ids)
+    app.store.update(devices=(
+        {"name": "Fake Mouse", "id": "FAKE\\MOUSE", "id_type": "pnp", "battery": 50},
+        {"name": "Headset", "id": "AA", "id_type": "ble", "battery": 60},
+        {"name": "Gone", "id": "FAKE\\GONE", "id_type": "pnp", "battery": 10},
+    ))
+    app._cached_ids = [(d["id"], d["id_type"]) for d in app.devices]
+    try:
+        app._bg_revalidate_cache()
+    finally:
+        backend.close()
+        app.notifier.stop(timeout=2.0)
+        app.menu_updater.stop()
+    # MAC-адрес не уходит в PnP-воркер
+    assert requested == [["FAKE\\MOUSE", "FAKE\\GONE"]]
+    assert {d["id"]: d["battery"] for d in app.devices} == {"FAKE\\MOUSE": 55, "AA": 70}
+
+
+def test_ble_notification_updates_tray_without_resetting_the_poll_schedule():
+    pnp = fake_backend()
+    backend = ble_backend()
+    app = TrayBTB.TrayApplication(backend=pnp, headless=True, ble_backend=backend)
+    app.select_device("Headset", "AA", "ble", announce=False)
+
+    async def run():
+        app._loop = asyncio.get_running_loop()
+        app._wake = asyncio.Event()
+        app.scheduler.record_success(70)
+        due = app.scheduler.next_due
+        # уведомление приходит из потока BLE
+        threading.Thread(target=backend._set_level, args=("AA", 65)).start()
+        await asyncio.wait_for(app._wake.wait(), 5)
+        return due
+
+    due = asyncio.run(run())
+    backend.close()
+    app.notifier.stop(timeout=2.0)
+    app.menu_updater.stop()
+    assert app.battery_status.level == 65
+    assert len(app.engine.get("AA").history) == 1  # уровень попал в историю
+    assert app.scheduler.next_due == due
+    assert pnp.read_calls == 0
+
+
+class SilentWorker:
+    """PowerShellWorker stand-in that never answers, like a worker in crash backoff."""
+
+    def __init__(self):
+        self.requests = 0
+
+    def query_many(self, instance_ids, timeout=None):
+        self.requests += 1
+        return {inst: None for inst in instance_ids}
+
+    def close(self):
+        pass
+
+
+def test_known_devices_are_reprobed_when_the_worker_does_not_answer():
+    worker = SilentWorker()
+    probes = []
+    backend = TrayBTB.PowerShellBackend(
+        worker=worker, run=lambda args, **kw: probes.append(kw["input"]) or stand_in_probe(args, **kw),
+        wmi=StubWmi([{"PNPDeviceID": "AB", "Name": "Headphones AB"}, {"PNPDeviceID": "XYZ", "Name": "Audio XYZ"}]),
+        watch_events=False,
+    )
+    assert sorted(d["id"] for d in backend.discover()) == ["AB", "XYZ"]
+    probes.clear()
+    # воркер молчит — известные устройства не пропадают из скана, а допрашиваются пробой
+    assert sorted(d["id"] for d in backend.discover()) == ["AB", "XYZ"]
+    assert worker.requests == 1
+    assert sorted(probes) == ["AB\n", "XYZ\n"]
+    assert backend.last_scan == {"candidates": 2, "refreshed": 0, "probed": 2, "skipped_no_battery": 0, "found": 2}
+
+
+def probing_backend(ids, **kwargs):
+    runs = []
+    backend = TrayBTB.PowerShellBackend(
+        worker=SilentWorker(), watch_events=False,
+        run=lambda args, **kw: runs.append(kw["input"].split()) or stand_in_probe(args, **kw),
+        wmi=StubWmi([{"PNPDeviceID": inst, "Name": f"BT {inst}"} for inst in ids]), **kwargs,
+    )
+    return backend, runs
+
+
+@pytest.mark.parametrize("count", [4, 16, 64, 256])
+def test_batch_discovery_needs_a_constant_number_of_powershell_runs(count):
+    ids = [f"DEV{i:03d}" for i in range(count)]
+    batch, batch_runs = probing_backend(ids, discovery_mode="batch", batch_workers=4, batch_size=64)
+    fanout, fanout_runs = probing_backend(ids, discovery_mode="fanout")
+    assert sorted(d["id"] for d in batch.discover()) == sorted(d["id"] for d in fanout.discover()) == ids
+    # пакеты делятся между batch_workers, пока не упрутся в batch_size
+    assert len(batch_runs) == max(4, -(-count // 64))
+    assert len(fanout_runs) == count
+    assert sorted(i for run in batch_runs for i in run) == ids
+
+
+def test_batch_discovery_reprobes_singly_only_the_ids_that_errored():
+    ids = ["A1", "err1", "none1", "B22", "err2", "none2"]
+    backend, runs = probing_backend(ids, batch_workers=1)
+    found = {d["id"]: d["battery"] for d in backend.discover()}
+    assert runs[0] == ids
+    # «error» — поштучно ещё раз, «none» — нет: батареи нет, ушло в отрицательный кэш
+    assert sorted(runs[1:]) == [["err1"], ["err2"]]
+    assert found == {"A1": 2, "B22": 3, "err1": 4, "err2": 4}
+    assert backend.last_scan["probed"] == 6
+    runs.clear()
+    backend.discover()
+    # «none» в отрицательном кэше и не допрашиваются; остальных воркер не прочитал — снова проба
+    assert runs[0] == ["A1", "err1", "B22", "err2"]
+    assert backend.last_scan["skipped_no_battery"] == 2